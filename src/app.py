@@ -14,10 +14,20 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with TellerBot.  If not, see <https://www.gnu.org/licenses/>.
+import argparse
 import asyncio
+import logging
+import multiprocessing
+import os
 import secrets
+import sys
+import typing
+from datetime import datetime
 
 from aiogram.utils import executor
+from aiohttp import web
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
 
 from src import bot
 from src import handlers  # noqa: F401
@@ -26,8 +36,104 @@ from src.bot import dp
 from src.bot import tg
 from src.config import config
 from src.database import database
+from src.database import user_cache
 from src.escrow import close_blockchains
 from src.escrow import connect_to_blockchains
+from src.escrow import restore_blockchain_queues
+from src.escrow import run_history_scanners
+from src.escrow import SUPPORTED_BLOCKCHAINS
+from src.geocoding import geocoder
+from src.indexes import index_registry
+from src.lease import LeaderLease
+from src.log_sink import log_sink
+from src.money import currency_fields
+from src.subscriptions import change_streams_available
+from src.subscriptions import subscription_index
+from src.throttling import send_governor
+from src.workers import UpdateRouter
+
+log = logging.getLogger(__name__)
+
+#: Path of webhooks of worker processes.
+WORKER_WEBHOOK_PATH = "/update"
+
+
+async def backfill_currency_fields(batch_size: int = 1000):
+    """Set base currency and gateway fields of orders created without them.
+
+    Completed backfill is recorded in ``migrations`` collection, so that
+    orders aren't scanned on every startup.
+    """
+    if await database.migrations.find_one({"_id": "currency_fields"}):
+        return
+    cursor = database.orders.find(
+        {"buy_base": {"$exists": False}}, projection={"buy": True, "sell": True}
+    )
+    requests = []
+    async for order in cursor:
+        requests.append(
+            UpdateOne({"_id": order["_id"]}, {"$set": currency_fields(order)})
+        )
+        if len(requests) == batch_size:
+            await database.orders.bulk_write(requests, ordered=False)
+            requests = []
+    if requests:
+        await database.orders.bulk_write(requests, ordered=False)
+    try:
+        await database.migrations.insert_one(
+            {"_id": "currency_fields", "date": datetime.utcnow()}
+        )
+    except DuplicateKeyError:
+        # Concurrent process has completed the same backfill
+        pass
+
+
+async def log_statistics():
+    """Log statistics of bot's components in infinite loop."""
+    while True:
+        await asyncio.sleep(config.STATISTICS_LOG_INTERVAL)
+        interactive, bulk = send_governor.queue_depth
+        log.info(
+            "Messages waiting to be sent: %d interactive, %d bulk", interactive, bulk
+        )
+        log.info(
+            "Geocode cache hit rate: %.1f%%, average lookup time: %.1f ms",
+            geocoder.cache.hit_rate * 100,
+            geocoder.cache.average_lookup_time * 1000,
+        )
+        for bc in SUPPORTED_BLOCKCHAINS:
+            lag = bc.irreversible_blocks.lag
+            if lag is not None:
+                log.info("Last irreversible block of %s lags %d blocks", bc.name, lag)
+
+
+async def start_background_tasks(lease: typing.Optional[LeaderLease] = None):
+    """Prepare database and run background tasks.
+
+    :param lease: Lease which must be held to run tasks that should
+        run in only one process. If it's None, these tasks are run
+        unconditionally.
+    """
+    await backfill_currency_fields()
+    await index_registry.reconcile()
+    await subscription_index.load()
+    if config.SUBSCRIPTIONS_CHANGE_STREAM:
+        asyncio.create_task(subscription_index.watch())
+    asyncio.create_task(user_cache.run_loop())
+    asyncio.create_task(log_statistics())
+    if config.DATABASE_LOGGING_ENABLED:
+        asyncio.create_task(log_sink.run_loop())
+    if lease is None:
+        asyncio.create_task(notifications.run_loop())
+        asyncio.create_task(connect_to_blockchains())
+        asyncio.create_task(run_history_scanners())
+    else:
+        asyncio.create_task(connect_to_blockchains(restore_queues=False))
+        asyncio.create_task(
+            lease.run(
+                notifications.run_loop, restore_blockchain_queues, run_history_scanners
+            )
+        )
 
 
 async def on_startup(webhook_path=None, *args):
@@ -38,9 +144,98 @@ async def on_startup(webhook_path=None, *args):
     await tg.delete_webhook()
     if webhook_path is not None:
         await tg.set_webhook("https://" + config.SERVER_HOST + webhook_path)
-    await database.users.create_index("referral_code", unique=True, sparse=True)
-    asyncio.create_task(notifications.run_loop())
-    asyncio.create_task(connect_to_blockchains())
+    await start_background_tasks()
+
+
+async def on_worker_startup(*args):
+    """Prepare worker process and run background tasks."""
+    await start_background_tasks(LeaderLease("background"))
+
+
+async def on_shutdown(*args):
+    """Write pending changes and close connections."""
+    await user_cache.flush()
+    await log_sink.flush()
+    await geocoder.close()
+    await close_blockchains()
+
+
+def run_worker(index: int):
+    """Process updates forwarded by router in worker process # ``index``.
+
+    Worker is a spawned process, so bot, dispatcher and database client
+    of this module are created in it anew and bound to its own event
+    loop.
+    """
+    bot.setup()
+    executor.start_webhook(
+        dispatcher=dp,
+        webhook_path=WORKER_WEBHOOK_PATH,
+        on_startup=on_worker_startup,
+        on_shutdown=on_shutdown,
+        host="127.0.0.1",
+        port=config.WORKER_BASE_PORT + index,
+    )
+
+
+def run_workers(webhook_path: str):
+    """Start ``config.WORKERS`` worker processes and route updates to them.
+
+    Updates are routed by chat ID, so updates of the same chat are
+    processed in order by the same worker.
+
+    Workers don't share their memory, so:
+
+    * subscriptions are synchronized through change stream, which is
+      enabled in workers regardless of
+      ``config.SUBSCRIPTIONS_CHANGE_STREAM``;
+    * global limit of Telegram messages is divided between workers
+      equally, while per-chat limits are enforced only by the worker
+      sending to chat;
+    * cached user documents aren't invalidated in other workers, so
+      changes of user made in one worker can be seen by another one only
+      after ``config.USER_CACHE_TTL`` seconds.
+    """
+    loop = asyncio.get_event_loop()
+    if not loop.run_until_complete(change_streams_available()):
+        log.error("Workers require database with change streams (replica set)")
+        sys.exit(1)
+    if not config.SUBSCRIPTIONS_CHANGE_STREAM:
+        log.warning("Enabling subscriptions change stream to synchronize workers")
+        # Spawned workers read configuration from environment
+        os.environ["SUBSCRIPTIONS_CHANGE_STREAM"] = "true"
+    # Forked workers would share event loop of this process created on
+    # import of src.bot together with its epoll and wake-up descriptors
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=run_worker, args=(index,), name=f"worker-{index}")
+        for index in range(config.WORKERS)
+    ]
+    for process in processes:
+        process.start()
+
+    router = UpdateRouter(
+        f"http://127.0.0.1:{config.WORKER_BASE_PORT + index}{WORKER_WEBHOOK_PATH}"
+        for index in range(config.WORKERS)
+    )
+    app = router.app(webhook_path)
+
+    async def set_webhook(app):
+        await tg.delete_webhook()
+        await tg.set_webhook("https://" + config.SERVER_HOST + webhook_path)
+
+    async def close_bot(app):
+        await tg.close()
+
+    app.on_startup.append(set_webhook)
+    app.on_cleanup.append(close_bot)
+    try:
+        web.run_app(app, host=config.INTERNAL_HOST, port=config.SERVER_PORT)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
 
 
 def main():
@@ -48,16 +243,33 @@ def main():
 
     Bot's main entry point.
     """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--check-indexes",
+        action="store_true",
+        help="explain canonical queries and exit with error if any scans collection",
+    )
+    args = parser.parse_args()
+    if args.check_indexes:
+        logging.basicConfig(level=config.LOGGER_LEVEL)
+        loop = asyncio.get_event_loop()
+        scanning = loop.run_until_complete(index_registry.check_queries())
+        sys.exit(1 if scanning else 0)
+
     bot.setup()
     if config.SET_WEBHOOK:
         url_token = secrets.token_urlsafe()
         webhook_path = config.WEBHOOK_PATH + "/" + url_token
 
+        if config.WORKERS > 1:
+            run_workers(webhook_path)
+            return
+
         executor.start_webhook(
             dispatcher=dp,
             webhook_path=webhook_path,
             on_startup=lambda *args: on_startup(webhook_path, *args),
-            on_shutdown=lambda *args: close_blockchains(),
+            on_shutdown=on_shutdown,
             host=config.INTERNAL_HOST,
             port=config.SERVER_PORT,
         )
@@ -65,7 +277,7 @@ def main():
         executor.start_polling(
             dispatcher=dp,
             on_startup=lambda *args: on_startup(None, *args),
-            on_shutdown=lambda *args: close_blockchains(),
+            on_shutdown=on_shutdown,
         )
     print()  # noqa: T001  Executor stopped with ^C
 
@@ -0,0 +1,563 @@
+# Copyright (C) 2019  alfred richardsn
+#
+# This file is part of TellerBot.
+#
+# TellerBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with TellerBot.  If not, see <https://www.gnu.org/licenses/>.
+"""End-to-end benchmark of update processing.
+
+Synthetic user sessions are replayed against the bot connected to
+``FakeTelegramServer`` and the in-memory database unless configured
+otherwise. Throughput, latency percentiles of handlers and database
+operations per update are reported.
+
+Run with ``python -m src.benchmark``.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sys
+import typing
+from contextvars import ContextVar
+from dataclasses import dataclass
+from time import perf_counter
+from time import time
+
+from aiogram import Bot
+from aiogram import types
+from aiogram.dispatcher import Dispatcher
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.utils.emoji import emojize
+from aiohttp import web
+
+from src.fake_telegram import FakeTelegramServer
+
+#: Configuration used by benchmark unless it's set in environment.
+#: Message quotas are disabled to measure bot rather than Telegram limits.
+BENCHMARK_CONFIG = {
+    "DATABASE_BACKEND": "memory",
+    "DATABASE_LOGGING_ENABLED": "false",
+    "LOGGER_LEVEL": "WARNING",
+    "ESCROW_FEE_PERCENTS": "1",
+    "ORDERS_COUNT": "10",
+    "ORDERS_LIMIT_HOURS": "24",
+    "ORDERS_LIMIT_COUNT": "1000000",
+    "ORDER_DURATION_LIMIT": "100",
+    "CHECK_TIMEOUT_HOURS": "24",
+    "SUPPORT_CHAT_ID": "-1",
+    "EXCEPTIONS_CHAT_ID": "-1",
+    "TELEGRAM_GLOBAL_LIMIT": "1000000",
+    "TELEGRAM_CHAT_LIMIT": "1000000",
+    "TELEGRAM_GROUP_LIMIT": "1000000",
+}
+
+#: Database methods counted as operations.
+DATABASE_OPERATIONS = frozenset(
+    (
+        "find",
+        "find_one",
+        "find_one_and_update",
+        "find_one_and_replace",
+        "find_one_and_delete",
+        "insert_one",
+        "insert_many",
+        "update_one",
+        "update_many",
+        "replace_one",
+        "delete_one",
+        "delete_many",
+        "count_documents",
+        "aggregate",
+        "bulk_write",
+    )
+)
+
+#: Currency pairs of created orders as (buy, sell).
+PAIRS = (
+    ("USD", "BTC"),
+    ("RUB", "GOLOS"),
+    ("EUR", "USDT"),
+    ("BTC", "EOS"),
+    ("CNY", "BTS"),
+    ("GOLOS", "RUB"),
+)
+
+PERCENTILES = (50, 95, 99)
+
+
+@dataclass
+class UpdateSample:
+    """Measurements of processing of one update."""
+
+    #: Name of handler which processed update.
+    handler: str = "unhandled"
+    #: Processing time in seconds.
+    latency: float = 0.0
+    #: Number of database operations.
+    database_operations: int = 0
+    #: Whether processing raised an exception.
+    failed: bool = False
+
+
+current_sample: ContextVar[typing.Optional[UpdateSample]] = ContextVar(
+    "current_sample", default=None
+)
+
+
+class CountingCollection:
+    """Proxy of collection counting operations of processed updates."""
+
+    def __init__(self, collection: typing.Any):
+        """Wrap ``collection``."""
+        self._collection = collection
+
+    def __getattr__(self, name: str) -> typing.Any:
+        """Get attribute of collection counting calls of operations."""
+        attribute = getattr(self._collection, name)
+        if name not in DATABASE_OPERATIONS:
+            return attribute
+
+        def counted(*args, **kwargs):
+            sample = current_sample.get()
+            if sample is not None:
+                sample.database_operations += 1
+            return attribute(*args, **kwargs)
+
+        return counted
+
+
+class CountingDatabase:
+    """Proxy of database returning ``CountingCollection`` proxies."""
+
+    def __init__(self, database: typing.Any):
+        """Wrap ``database``."""
+        self._database = database
+        self._collections: typing.Dict[str, CountingCollection] = {}
+
+    def __getitem__(self, name: str) -> CountingCollection:
+        """Get proxy of collection ``name``."""
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = CountingCollection(self._database[name])
+            self._collections[name] = collection
+        return collection
+
+    def __getattr__(self, name: str) -> CountingCollection:
+        """Get proxy of collection ``name``."""
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+
+class HandlerRecorderMiddleware(BaseMiddleware):
+    """Middleware recording name of handler processing current update."""
+
+    async def trigger(self, action, args):
+        """Set handler name of current sample before handler is called."""
+        sample = current_sample.get()
+        if sample is None or not action.startswith("process_"):
+            return
+        if action == "process_error":
+            # Errors handler reports exception instead of raising it
+            sample.failed = True
+        elif action != "process_update":
+            handler = current_handler.get(None)
+            if handler is not None:
+                sample.handler = handler.__name__
+
+
+def percentile(values: typing.Sequence[float], percent: float) -> float:
+    """Get ``percent`` percentile of sorted ``values`` by nearest rank."""
+    if not values:
+        return 0.0
+    rank = max(0, min(len(values) - 1, round(percent / 100 * len(values)) - 1))
+    return values[rank]
+
+
+class Client:
+    """Telegram user sending updates to the bot.
+
+    :param benchmark: Benchmark which processes updates.
+    :param user_id: Telegram ID of user.
+    """
+
+    def __init__(self, benchmark: "Benchmark", user_id: int):
+        """Create client of new user."""
+        self.benchmark = benchmark
+        self.user = {
+            "id": user_id,
+            "is_bot": False,
+            "first_name": f"User {user_id}",
+            "username": f"user{user_id}",
+            "language_code": "en",
+        }
+        self.chat = {"id": user_id, "type": "private"}
+        self._message_ids = itertools.count(1)
+
+    @property
+    def id(self) -> int:
+        """Get Telegram ID of user."""
+        return self.user["id"]
+
+    def _message(self, **fields) -> typing.Dict[str, typing.Any]:
+        return {
+            "message_id": next(self._message_ids),
+            "from": self.user,
+            "chat": self.chat,
+            "date": int(time()),
+            **fields,
+        }
+
+    async def text(self, text: str) -> None:
+        """Send message with ``text``."""
+        entities = []
+        if text.startswith("/"):
+            command_length = len(text.split()[0])
+            entities.append(
+                {"type": "bot_command", "offset": 0, "length": command_length}
+            )
+        await self.benchmark.process(
+            {"message": self._message(text=text, entities=entities)}
+        )
+
+    async def location(self, latitude: float, longitude: float) -> None:
+        """Send location."""
+        await self.benchmark.process(
+            {
+                "message": self._message(
+                    location={"latitude": latitude, "longitude": longitude}
+                )
+            }
+        )
+
+    async def callback(self, data: str, message: typing.Mapping[str, typing.Any]):
+        """Press button with callback ``data`` attached to ``message``."""
+        await self.benchmark.process(
+            {
+                "callback_query": {
+                    "id": str(next(self.benchmark.update_ids)),
+                    "from": self.user,
+                    "message": message,
+                    "chat_instance": str(self.id),
+                    "data": data,
+                }
+            }
+        )
+
+    def buttons(
+        self, prefix: str
+    ) -> typing.Tuple[typing.Optional[typing.Dict[str, typing.Any]], typing.List[str]]:
+        """Get the last message with buttons starting with ``prefix`` and their data."""
+        return self.benchmark.server.buttons(self.id, prefix)
+
+    async def press(self, prefix: str, index: typing.Optional[int] = 0) -> bool:
+        """Press button with callback data starting with ``prefix``.
+
+        :param index: Index of button among matching buttons of the last
+            message having them. If it's None, random button is pressed.
+        :return: Whether button was found.
+        """
+        message, data = self.buttons(prefix)
+        if message is None:
+            return False
+        if index is None:
+            choice = self.benchmark.random.choice(data)
+        else:
+            choice = data[index]
+        await self.callback(choice, message)
+        return True
+
+
+async def onboarding(client: Client) -> None:
+    """Register user and choose language."""
+    await client.text("/start")
+    await client.press("locale en")
+
+
+async def create_order(client: Client) -> None:
+    """Go through all steps of order creation."""
+    from src import whitelist
+
+    rng = client.benchmark.random
+    buy, sell = rng.choice(PAIRS)
+    await client.text("/create")
+    for currency in (buy, sell):
+        await client.text(currency)
+        gateways = whitelist.CRYPTOCURRENCY.get(currency)
+        if gateways:
+            if rng.random() < 0.5:
+                await client.text(rng.choice(gateways))
+            else:
+                await client.text(emojize(":fast_forward: ") + "Without gateway")
+    await client.text(str(rng.randint(1, 1000)))
+    await client.press("sum ", rng.randint(0, 1))
+    await client.text(str(rng.randint(1, 1000)))
+    if buy in whitelist.FIAT or sell in whitelist.FIAT:
+        await client.text(rng.choice(("Bank transfer", "PayPal", "Cash")))
+    await client.location(rng.uniform(-90, 90), rng.uniform(-180, 180))
+    await client.text(str(rng.randint(1, 30)))
+    await client.text("Benchmark order")
+
+
+async def browse_book(client: Client) -> None:
+    """Browse order book, open order and browse orders matching it."""
+    rng = client.benchmark.random
+    await client.text("/book")
+    for _ in range(rng.randint(0, 3)):
+        # The last button moves to the next page
+        if not await client.press("orders ", -1):
+            break
+    if not await client.press("get_order ", None):
+        return
+    if rng.random() < 0.5:
+        await client.press("invert ")
+    if await client.press("match "):
+        for _ in range(rng.randint(0, 2)):
+            if not await client.press("matched_orders ", -1):
+                break
+
+
+async def manage_subscriptions(client: Client) -> None:
+    """Subscribe to currency pair, list subscriptions and unsubscribe."""
+    buy, sell = client.benchmark.random.choice(PAIRS)
+    await client.text(f"/subscribe {sell} {buy}")
+    await client.text("/subscribe")
+    await client.text(f"/unsubscribe {sell} {buy}")
+
+
+async def start_escrow(client: Client) -> None:
+    """Open order from order book, start escrow exchange and cancel it.
+
+    Exchange goes beyond the first step only if escrow is enabled and
+    the order's currency is supported by a connected blockchain.
+    """
+    rng = client.benchmark.random
+    await client.text("/book")
+    message, data = client.buttons("get_order ")
+    if message is None:
+        return
+    order_id = rng.choice(data).split()[1]
+    await client.callback(f"get_order {order_id}", message)
+    message, _ = client.buttons("hide ")
+    if message is None:
+        return
+    await client.callback(f"escrow {order_id} sum_buy 0", message)
+    if not client.buttons("init_cancel ")[1]:
+        return
+    await client.text(str(rng.randint(1, 10)))
+    if not await client.press("decline_fee "):
+        await client.press("init_cancel ")
+
+
+#: Sessions replayed by users with their weights.
+SESSIONS: typing.Tuple[
+    typing.Tuple[typing.Callable[[Client], typing.Awaitable[None]], int], ...
+] = (
+    (create_order, 3),
+    (browse_book, 4),
+    (manage_subscriptions, 2),
+    (start_escrow, 1),
+)
+
+
+class Benchmark:
+    """Replay of user sessions collecting samples of processed updates.
+
+    :param server: Fake Telegram server bot is connected to.
+    :param seed: Seed of random choices made by users.
+    """
+
+    def __init__(self, server: FakeTelegramServer, seed: int):
+        """Create benchmark without samples."""
+        self.server = server
+        self.random = random.Random(seed)
+        self.update_ids = itertools.count(1)
+        self.samples: typing.List[UpdateSample] = []
+        self.recording = False
+        self.dispatcher: typing.Optional[Dispatcher] = None
+
+    async def process(self, update: typing.Mapping[str, typing.Any]) -> None:
+        """Process ``update`` by the bot and record its sample.
+
+        Update is processed in its own task like executor does it, so
+        that context variables set by handlers don't leak to next updates.
+        """
+        update = types.Update.to_object({"update_id": next(self.update_ids), **update})
+        sample = UpdateSample()
+        token = current_sample.set(sample)
+        started = perf_counter()
+        try:
+            await asyncio.create_task(self.dispatcher.process_update(update))
+        except Exception:
+            sample.failed = True
+        finally:
+            sample.latency = perf_counter() - started
+            current_sample.reset(token)
+        if self.recording:
+            self.samples.append(sample)
+
+    async def run_user(self, client: Client, sessions: int) -> None:
+        """Replay ``sessions`` random sessions of ``client``."""
+        functions, weights = zip(*SESSIONS)
+        for function in self.random.choices(functions, weights, k=sessions):
+            await function(client)
+
+    def report(self, elapsed: float, api_requests: int) -> typing.Dict[str, typing.Any]:
+        """Get statistics of recorded samples."""
+        by_handler: typing.Dict[str, typing.List[UpdateSample]] = {}
+        for sample in self.samples:
+            by_handler.setdefault(sample.handler, []).append(sample)
+        handlers = {
+            name: self._statistics(samples)
+            for name, samples in sorted(
+                by_handler.items(), key=lambda item: -len(item[1])
+            )
+        }
+        return {
+            "updates": len(self.samples),
+            "elapsed": elapsed,
+            "updates_per_second": len(self.samples) / elapsed if elapsed else 0.0,
+            "api_requests_per_update": (
+                api_requests / len(self.samples) if self.samples else 0.0
+            ),
+            **self._statistics(self.samples),
+            "handlers": handlers,
+        }
+
+    @staticmethod
+    def _statistics(samples: typing.List[UpdateSample]) -> typing.Dict[str, typing.Any]:
+        latencies = sorted(sample.latency * 1000 for sample in samples)
+        operations = sum(sample.database_operations for sample in samples)
+        statistics = {
+            "count": len(samples),
+            "failed": sum(sample.failed for sample in samples),
+            "database_operations_per_update": (
+                operations / len(samples) if samples else 0.0
+            ),
+        }
+        for percent in PERCENTILES:
+            statistics[f"p{percent}_ms"] = percentile(latencies, percent)
+        return statistics
+
+
+def format_report(report: typing.Mapping[str, typing.Any]) -> str:
+    """Format ``report`` as text table."""
+    lines = [
+        "{updates} updates in {elapsed:.2f} s: {updates_per_second:.1f} updates/s, "
+        "{api_requests_per_update:.2f} API requests/update".format(**report),
+        "",
+        "{:<32} {:>7} {:>6} {:>9} {:>9} {:>9} {:>8}".format(
+            "handler", "updates", "failed", "p50 ms", "p95 ms", "p99 ms", "db ops"
+        ),
+    ]
+    rows = [("all", report)] + list(report["handlers"].items())
+    for name, statistics in rows:
+        lines.append(
+            "{:<32} {count:>7} {failed:>6} {p50_ms:>9.2f} {p95_ms:>9.2f} "
+            "{p99_ms:>9.2f} {database_operations_per_update:>8.2f}".format(
+                name[:32], **statistics
+            )
+        )
+    return "\n".join(lines) + "\n"
+
+
+async def run(args: argparse.Namespace) -> typing.Dict[str, typing.Any]:
+    """Run benchmark with command line ``args`` and get its report."""
+    server = FakeTelegramServer(args.telegram_latency)
+    runner = web.AppRunner(server.app())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    os.environ.setdefault("TELEGRAM_API_URL", f"http://{host}:{port}")
+    for name, value in BENCHMARK_CONFIG.items():
+        os.environ.setdefault(name, value)
+
+    # Bot modules read configuration and connect to database on import,
+    # so they are imported when configuration is set
+    from src import database
+
+    database.database = CountingDatabase(database.database)
+    from src import app
+    from src import bot
+
+    bot.setup("0:benchmark")
+    bot.dp.middleware.setup(HandlerRecorderMiddleware())
+    Bot.set_current(bot.tg)
+    Dispatcher.set_current(bot.dp)
+    await app.start_background_tasks()
+
+    benchmark = Benchmark(server, args.seed)
+    benchmark.dispatcher = bot.dp
+    clients = [Client(benchmark, 1000000 + index) for index in range(args.users)]
+    await asyncio.gather(*(onboarding(client) for client in clients))
+    # Order book is filled before measuring
+    for client in clients[: args.warmup_orders]:
+        await create_order(client)
+
+    server.reset()
+    benchmark.recording = True
+    started = perf_counter()
+    await asyncio.gather(
+        *(benchmark.run_user(client, args.sessions) for client in clients)
+    )
+    elapsed = perf_counter() - started
+    benchmark.recording = False
+    report = benchmark.report(elapsed, sum(server.method_counts.values()))
+
+    await app.on_shutdown()
+    await bot.tg.close()
+    await runner.cleanup()
+    return report
+
+
+def main():
+    """Run benchmark and print its report."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--users", type=int, default=100, help="concurrent users")
+    parser.add_argument(
+        "--sessions", type=int, default=10, help="sessions replayed by every user"
+    )
+    parser.add_argument(
+        "--warmup-orders",
+        type=int,
+        default=50,
+        help="orders created before measuring",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="seed of random choices")
+    parser.add_argument(
+        "--telegram-latency",
+        type=float,
+        default=0.0,
+        help="delay of fake Telegram responses in seconds",
+    )
+    parser.add_argument("--json", help="write report as JSON to this file")
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    report = loop.run_until_complete(run(args))
+    for task in asyncio.all_tasks(loop):
+        task.cancel()
+    sys.stdout.write(format_report(report))
+    if args.json:
+        with open(args.json, "w") as report_file:
+            json.dump(report, report_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -17,6 +17,7 @@
 import asyncio
 import logging
 import typing
+from contextlib import asynccontextmanager
 from time import time
 
 from aiogram import Bot
@@ -25,26 +26,38 @@ from aiogram.bot import api
 from aiogram.contrib.middlewares.logging import LoggingMiddleware
 from aiogram.dispatcher import Dispatcher
 from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.utils.exceptions import RetryAfter
 from pymongo import ReturnDocument
 
 from src.config import config
 from src.database import database
 from src.database import database_user
 from src.database import MongoStorage
+from src.database import profile_cache
+from src.database import user_cache
 from src.i18n import i18n
+from src.indexes import index_registry
+from src.log_sink import log_sink
+from src.throttling import send_governor
+
+index_registry.add("users", "id", query={"id": 0}, unique=True)
+index_registry.add("users", "mention", query={"mention": "@", "id": {"$ne": 0}})
+
+#: Prefixes of API methods which are subject to message limits.
+SENDING_METHODS_PREFIXES = ("send", "edit", "forward", "copy")
 
 
 class IncomingHistoryMiddleware(BaseMiddleware):
     """Middleware for storing incoming history."""
 
     async def trigger(self, action, args):
-        """Save incoming data in the database."""
+        """Queue incoming data for saving in the database."""
         if (
             "update" not in action
             and "error" not in action
             and action.startswith("pre_process_")
         ):
-            await database.logs.insert_one(
+            log_sink.put(
                 {
                     "direction": "in",
                     "type": action.split("pre_process_", 1)[1],
@@ -57,8 +70,30 @@ class TellerBot(Bot):
     """Custom bot class."""
 
     async def request(self, method, data=None, *args, **kwargs):
-        """Make a request and save it in the database."""
-        result = await super().request(method, data, *args, **kwargs)
+        """Make a request and queue it for saving in the database.
+
+        Requests sending messages wait for ``send_governor`` to stay in
+        Telegram limits and are repeated if flood control is exceeded.
+        """
+        chat_id = None
+        if method.startswith(SENDING_METHODS_PREFIXES) and data:
+            chat_id = data.get("chat_id")
+        retries = 0
+        while True:
+            if isinstance(chat_id, int):
+                await send_governor.acquire(chat_id)
+            try:
+                result = await super().request(method, data, *args, **kwargs)
+            except RetryAfter as exception:
+                retries += 1
+                if retries > config.TELEGRAM_MAX_RETRIES:
+                    raise
+                if isinstance(chat_id, int):
+                    send_governor.retry_after(chat_id, exception.timeout)
+                else:
+                    await asyncio.sleep(exception.timeout)
+            else:
+                break
         if (
             config.DATABASE_LOGGING_ENABLED
             and result
@@ -74,7 +109,7 @@ class TellerBot(Bot):
             # On requests Telegram either returns True on success or relevant object.
             # To store only useful information, method's payload is saved if result is
             # a boolean and result is saved otherwise.
-            await database.logs.insert_one(
+            log_sink.put(
                 {
                     "direction": "out",
                     "type": method,
@@ -84,13 +119,89 @@ class TellerBot(Bot):
         return result
 
 
+class UpdateScheduler:
+    """Scheduler processing updates of the same chat one at a time.
+
+    Updates of different chats are processed concurrently, but no more
+    than ``limit`` at once.
+
+    :param limit: Maximum number of updates processed concurrently.
+    """
+
+    def __init__(self, limit: int):
+        """Create scheduler without waiting updates."""
+        self._semaphore = asyncio.Semaphore(limit)
+        self._locks: typing.Dict[int, asyncio.Lock] = {}
+        #: Number of updates waiting or being processed by chat ID.
+        self._queued: typing.Dict[int, int] = {}
+
+    @asynccontextmanager
+    async def slot(self, chat_id: typing.Optional[int]):
+        """Wait until update of chat with ID ``chat_id`` can be processed.
+
+        Updates without chat are only limited by overall limit.
+        """
+        if chat_id is None:
+            async with self._semaphore:
+                yield
+            return
+        lock = self._locks.get(chat_id)
+        if lock is None:
+            lock = self._locks[chat_id] = asyncio.Lock()
+        self._queued[chat_id] = self._queued.get(chat_id, 0) + 1
+        try:
+            # Chat lock is acquired first, so that waiting updates of
+            # busy chat don't occupy slots of other chats
+            async with lock:
+                async with self._semaphore:
+                    yield
+        finally:
+            self._queued[chat_id] -= 1
+            if not self._queued[chat_id]:
+                del self._queued[chat_id]
+                del self._locks[chat_id]
+
+
 class DispatcherManual(Dispatcher):
-    """Dispatcher with user availability in database check."""
+    """Dispatcher with user availability in database check.
+
+    Updates of the same chat are processed in order of arrival.
+    Callback query repeating query on the same message with the same
+    data which is still waiting or being processed is dropped.
+    """
+
+    def __init__(self, *args, **kwargs):
+        """Create dispatcher with update scheduler."""
+        super().__init__(*args, **kwargs)
+        self.scheduler = UpdateScheduler(config.UPDATES_CONCURRENCY)
+        self._pending_callbacks: typing.Set[typing.Tuple[int, int, str]] = set()
 
     async def process_update(self, update: types.Update):
+        """Process update after preceding updates of the same chat."""
+        chat_id = None
+        callback_key = None
+        if update.message:
+            chat_id = update.message.chat.id
+        elif update.callback_query and update.callback_query.message:
+            message = update.callback_query.message
+            chat_id = message.chat.id
+            callback_key = (chat_id, message.message_id, update.callback_query.data)
+            if callback_key in self._pending_callbacks:
+                await self.bot.answer_callback_query(update.callback_query.id)
+                return None
+            self._pending_callbacks.add(callback_key)
+        try:
+            async with self.scheduler.slot(chat_id):
+                return await self._process_update(update)
+        finally:
+            if callback_key is not None:
+                self._pending_callbacks.discard(callback_key)
+
+    async def _process_update(self, update: types.Update):
         """Process update object with user availability in database check.
 
         If bot doesn't know the user, it pretends they sent /start message.
+        Known users are served from ``user_cache``.
         """
         user = None
         if update.message:
@@ -100,21 +211,30 @@ class DispatcherManual(Dispatcher):
             user = update.callback_query.from_user
             chat = update.callback_query.message.chat
         if user:
-            await database.users.update_many(
-                {"id": {"$ne": user.id}, "mention": user.mention},
-                {"$set": {"has_username": False}},
-            )
-            document = await database.users.find_one_and_update(
-                {"id": user.id, "chat": chat.id},
-                {
-                    "$set": {
-                        "mention": user.mention,
-                        "has_username": bool(user.username),
-                    }
-                },
-                return_document=ReturnDocument.AFTER,
-            )
-            if document is None:
+            document = user_cache.get(user.id)
+            if document is not None and document["chat"] == chat.id:
+                user_cache.update_presence(document, user.mention, bool(user.username))
+            else:
+                await database.users.update_many(
+                    {"id": {"$ne": user.id}, "mention": user.mention},
+                    {"$set": {"has_username": False}},
+                )
+                user_cache.release_mention(user.id, user.mention)
+                document = await database.users.find_one_and_update(
+                    {"id": user.id, "chat": chat.id},
+                    {
+                        "$set": {
+                            "mention": user.mention,
+                            "has_username": bool(user.username),
+                        }
+                    },
+                    return_document=ReturnDocument.AFTER,
+                )
+                if document is not None:
+                    user_cache.set(document)
+            if document is not None:
+                profile_cache.set(document)
+            else:
                 if update.message:
                     if not update.message.text.startswith("/start "):
                         update.message.text = "/start"
@@ -131,17 +251,31 @@ class DispatcherManual(Dispatcher):
                         },
                     )
             database_user.set(document)
-        return await super().process_update(update)
+        self.storage.begin_session()
+        try:
+            return await super().process_update(update)
+        finally:
+            await self.storage.commit_session()
 
 
+# aiogram builds URLs of API methods from module constants
+api.API_URL = config.TELEGRAM_API_URL.rstrip("/") + "/bot{token}/{method}"
+api.FILE_URL = config.TELEGRAM_API_URL.rstrip("/") + "/file/bot{token}/{path}"
+
 tg = TellerBot(None, loop=asyncio.get_event_loop(), validate_token=False)
 dp = DispatcherManual(tg)
 
 
-def setup():
-    """Set API token from config to bot and setup dispatcher."""
-    with open(config.TOKEN_FILENAME, "r") as token_file:
-        tg._ctx_token.set(token_file.read().strip())
+def setup(token: typing.Optional[str] = None):
+    """Set API token to bot and setup dispatcher.
+
+    :param token: API token. If it's None, token is read from file
+        ``config.TOKEN_FILENAME``.
+    """
+    if token is None:
+        with open(config.TOKEN_FILENAME, "r") as token_file:
+            token = token_file.read().strip()
+    tg._ctx_token.set(token)
 
     dp.storage = MongoStorage()
 
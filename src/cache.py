@@ -0,0 +1,81 @@
+# Copyright (C) 2019  alfred richardsn
+#
+# This file is part of TellerBot.
+#
+# TellerBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with TellerBot.  If not, see <https://www.gnu.org/licenses/>.
+"""In-process caches."""
+import typing
+from collections import OrderedDict
+from time import monotonic
+
+KT = typing.TypeVar("KT")
+VT = typing.TypeVar("VT")
+
+
+class TTLCache(typing.Generic[KT, VT]):
+    """Bounded mapping with least recently used eviction and expiration.
+
+    :param maxsize: Maximum number of stored items. Least recently used
+        item is evicted when it is exceeded.
+    :param ttl: Lifetime of item in seconds or None if items don't expire.
+    """
+
+    def __init__(self, maxsize: int, ttl: typing.Optional[float] = None):
+        """Create empty cache."""
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items: "OrderedDict[KT, typing.Tuple[float, VT]]" = OrderedDict()
+
+    def get(self, key: KT, default: typing.Optional[VT] = None) -> typing.Optional[VT]:
+        """Return unexpired value of ``key`` and mark it as recently used."""
+        try:
+            expires, value = self._items[key]
+        except KeyError:
+            return default
+        if expires < monotonic():
+            del self._items[key]
+            return default
+        self._items.move_to_end(key)
+        return value
+
+    def set(self, key: KT, value: VT, ttl: typing.Optional[float] = None) -> None:
+        """Store ``value`` of ``key`` for ``ttl`` seconds or default lifetime."""
+        if ttl is None:
+            ttl = self.ttl
+        expires = monotonic() + ttl if ttl is not None else float("inf")
+        self._items[key] = (expires, value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def pop(self, key: KT, default: typing.Optional[VT] = None) -> typing.Optional[VT]:
+        """Remove ``key`` and return its value if it is unexpired."""
+        try:
+            expires, value = self._items.pop(key)
+        except KeyError:
+            return default
+        return value if expires >= monotonic() else default
+
+    def clear(self) -> None:
+        """Remove all items."""
+        self._items.clear()
+
+    def __contains__(self, key: object) -> bool:
+        """Check if ``key`` has unexpired value."""
+        item = self._items.get(key)  # type: ignore
+        return item is not None and item[0] >= monotonic()
+
+    def __len__(self) -> int:
+        """Get number of stored items including expired ones."""
+        return len(self._items)
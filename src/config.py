@@ -23,7 +23,58 @@ DEFAULT_VALUES = {
     "DATABASE_HOST": "127.0.0.1",
     "DATABASE_PORT": 27017,
     "DATABASE_NAME": "tellerbot",
+    "DATABASE_BACKEND": "mongodb",
+    "TELEGRAM_API_URL": "https://api.telegram.org",
     "ESCROW_ENABLED": False,
+    "USER_CACHE_SIZE": 10000,
+    "USER_CACHE_TTL": 300,
+    "USER_CACHE_FLUSH_INTERVAL": 1,
+    "USER_CACHE_FLUSH_BATCH": 100,
+    "PROFILE_CACHE_SIZE": 10000,
+    "PROFILE_CACHE_TTL": 600,
+    "DATABASE_LOGGING_QUEUE_SIZE": 10000,
+    "DATABASE_LOGGING_BATCH_SIZE": 500,
+    "DATABASE_LOGGING_INTERVAL": 1,
+    "EXPIRATION_SCHEDULER_SIZE": 1000,
+    "EXPIRATION_BATCH_SIZE": 100,
+    "EXPIRATION_SCHEDULER_RELOAD_INTERVAL": 60,
+    "EXPIRATION_CLAIM_TIMEOUT": 600,
+    "TELEGRAM_GLOBAL_LIMIT": 30,
+    "TELEGRAM_CHAT_LIMIT": 60,
+    "TELEGRAM_GROUP_LIMIT": 20,
+    "TELEGRAM_CHAT_BURST": 3,
+    "TELEGRAM_MAX_RETRIES": 3,
+    "STATISTICS_LOG_INTERVAL": 60,
+    "NOTIFICATION_WORKERS": 30,
+    "NOTIFICATION_ARCHIVE_CHECK_INTERVAL": 10,
+    "SUBSCRIPTIONS_CHANGE_STREAM": False,
+    "SUBSCRIPTIONS_WATCH_RETRY_DELAY": 5,
+    "ORDER_BOOK_CACHE_SIZE": 10000,
+    "ORDER_BOOK_TTL": 3600,
+    "ORDER_BOOK_COUNT_TTL": 60,
+    "WORKERS": 1,
+    "UPDATES_CONCURRENCY": 100,
+    "WORKER_BASE_PORT": 8100,
+    "LEASE_TTL": 30,
+    "ORDER_RENDER_CACHE_SIZE": 10000,
+    "ORDER_RENDER_CACHE_TTL": 300,
+    "ORDER_RENDER_VARIANTS": 64,
+    "GEOCODER_URL": "https://nominatim.openstreetmap.org/search",
+    "GEOCODER_TIMEOUT": 10,
+    "GEOCODER_RETRIES": 2,
+    "GEOCODER_CONNECTIONS": 10,
+    "GEOCODER_RESULTS_LIMIT": 10,
+    "GEOCODE_CACHE_SIZE": 10000,
+    "GEOCODE_CACHE_TTL": 30 * 24 * 60 * 60,
+    "GEOCODE_NEGATIVE_CACHE_TTL": 24 * 60 * 60,
+    "GOLOS_STREAM_HEARTBEAT": 30,
+    "GOLOS_STREAM_RECONNECT_DELAY": 3,
+    "GOLOS_STREAM_BACKFILL_LIMIT": 1200,
+    "BLOCK_CONFIRMATION_INTERVAL": 3,
+    "CONFIRMED_BLOCK_CACHE_SIZE": 100,
+    "CONFIRMED_BLOCK_CACHE_TTL": 600,
+    "CYBER_HISTORY_PAGE_SIZE": 100,
+    "CYBER_HISTORY_SCAN_INTERVAL": 10,
 }
 
 
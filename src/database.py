@@ -14,39 +14,346 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with TellerBot.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import logging
 import typing
 from contextvars import ContextVar
 
 from aiogram.dispatcher.storage import BaseStorage
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateMany
+from pymongo import UpdateOne
 
+from src.cache import TTLCache
 from src.config import config
+from src.memory_database import MemoryClient
 
+log = logging.getLogger(__name__)
 
-try:
-    with open(config.DATABASE_PASSWORD_FILENAME, "r") as password_file:
-        client = AsyncIOMotorClient(
-            "mongodb://{username}:{password}@{host}:{port}/{name}".format(
-                host=config.DATABASE_HOST,
-                port=config.DATABASE_PORT,
-                username=config.DATABASE_USERNAME,
-                password=password_file.read().strip(),
-                name=config.DATABASE_NAME,
+
+def connect() -> typing.Union[AsyncIOMotorClient, MemoryClient]:
+    """Create client of database backend chosen by ``config.DATABASE_BACKEND``."""
+    if config.DATABASE_BACKEND == "memory":
+        log.warning("Using in-memory database, data will be lost on exit")
+        return MemoryClient()
+    try:
+        with open(config.DATABASE_PASSWORD_FILENAME, "r") as password_file:
+            return AsyncIOMotorClient(
+                "mongodb://{username}:{password}@{host}:{port}/{name}".format(
+                    host=config.DATABASE_HOST,
+                    port=config.DATABASE_PORT,
+                    username=config.DATABASE_USERNAME,
+                    password=password_file.read().strip(),
+                    name=config.DATABASE_NAME,
+                )
             )
-        )
-except (AttributeError, FileNotFoundError):
-    client = AsyncIOMotorClient(config.DATABASE_HOST)
+    except (AttributeError, FileNotFoundError):
+        return AsyncIOMotorClient(config.DATABASE_HOST)
+
+
+client = connect()
 database = client[config.DATABASE_NAME]
 
 database_user: ContextVar[typing.Mapping[str, typing.Any]] = ContextVar("database_user")
 
 
+def apply_update(
+    document: typing.MutableMapping[str, typing.Any],
+    update: typing.Mapping[str, typing.Mapping[str, typing.Any]],
+) -> None:
+    """Apply ``$set`` and ``$unset`` operators of ``update`` to ``document``.
+
+    Dotted field names are resolved to embedded documents the same way
+    MongoDB does it.
+    """
+    for operator, fields in update.items():
+        for path, value in fields.items():
+            *parents, key = path.split(".")
+            embedded = document
+            for parent in parents:
+                if operator == "$unset" and parent not in embedded:
+                    break
+                embedded = embedded.setdefault(parent, {})
+            else:
+                if operator == "$set":
+                    embedded[key] = value
+                elif operator == "$unset":
+                    embedded.pop(key, None)
+                else:
+                    raise ValueError(f"Unsupported update operator: {operator}")
+
+
+class UserCache:
+    """Cache of user documents with write-behind of presence fields.
+
+    Documents are served from memory while they are fresh. Changes of
+    user's mention are applied to cached document immediately and
+    written to the database in batches by a background task.
+    """
+
+    def __init__(self):
+        """Create empty cache."""
+        self._documents: TTLCache[int, typing.Dict[str, typing.Any]] = TTLCache(
+            config.USER_CACHE_SIZE, config.USER_CACHE_TTL
+        )
+        #: Telegram IDs of cached users by their mentions.
+        self._mentions: TTLCache[str, int] = TTLCache(
+            config.USER_CACHE_SIZE, config.USER_CACHE_TTL
+        )
+        self._pending: typing.Dict[int, typing.List[typing.Any]] = {}
+        self._flush_event = asyncio.Event()
+
+    def get(self, user_id: int) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        """Get cached document of user with Telegram ID ``user_id``."""
+        return self._documents.get(user_id)
+
+    def set(self, document: typing.Dict[str, typing.Any]) -> None:
+        """Cache user ``document``."""
+        self._documents.set(document["id"], document)
+        self._mentions.set(document["mention"], document["id"])
+
+    def patch(
+        self,
+        user_id: int,
+        update: typing.Mapping[str, typing.Mapping[str, typing.Any]],
+    ) -> None:
+        """Apply ``update`` already written to the database to cached document.
+
+        Cached profile of user is invalidated.
+        """
+        profile_cache.invalidate(user_id)
+        document = self._documents.get(user_id)
+        if document is not None:
+            apply_update(document, update)
+
+    def invalidate(self, user_id: int) -> None:
+        """Remove document of user with Telegram ID ``user_id`` from cache."""
+        self._documents.pop(user_id)
+
+    def release_mention(self, user_id: int, mention: str) -> None:
+        """Mark cached user with ``mention`` other than ``user_id`` as renamed.
+
+        Should be called when ``has_username`` of such users is unset in
+        the database because user with Telegram ID ``user_id`` took
+        their mention.
+        """
+        owner_id = self._mentions.get(mention)
+        if owner_id is None or owner_id == user_id:
+            return
+        document = self._documents.get(owner_id)
+        if document is not None and document["mention"] == mention:
+            document["has_username"] = False
+            profile_cache.invalidate(owner_id)
+
+    def update_presence(
+        self, document: typing.Dict[str, typing.Any], mention: str, has_username: bool
+    ) -> None:
+        """Update mention of cached user and schedule writing it if it changed."""
+        if document["mention"] == mention and document["has_username"] == has_username:
+            return
+        document["mention"] = mention
+        document["has_username"] = has_username
+        self.release_mention(document["id"], mention)
+        self._mentions.set(mention, document["id"])
+        self._pending[document["id"]] = [
+            UpdateMany(
+                {"id": {"$ne": document["id"]}, "mention": mention},
+                {"$set": {"has_username": False}},
+            ),
+            UpdateOne(
+                {"id": document["id"]},
+                {"$set": {"mention": mention, "has_username": has_username}},
+            ),
+        ]
+        if len(self._pending) >= config.USER_CACHE_FLUSH_BATCH:
+            self._flush_event.set()
+
+    async def flush(self) -> None:
+        """Write pending changes to the database in one bulk operation."""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        requests = [request for requests in pending.values() for request in requests]
+        try:
+            await database.users.bulk_write(requests, ordered=True)
+        except Exception:
+            log.exception("Failed to write %d cached users", len(pending))
+            for user_id, requests in pending.items():
+                self._pending.setdefault(user_id, requests)
+
+    async def run_loop(self) -> None:
+        """Flush pending changes periodically or when batch is full."""
+        while True:
+            try:
+                await asyncio.wait_for(
+                    self._flush_event.wait(), config.USER_CACHE_FLUSH_INTERVAL
+                )
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            await self.flush()
+
+
+user_cache = UserCache()
+
+#: Fields of user documents kept in ``profile_cache``.
+PROFILE_FIELDS = (
+    "id",
+    "chat",
+    "mention",
+    "locale",
+    "referrer",
+    "referrer_of_referrer",
+    "invert_order",
+)
+
+
+class ProfileCache:
+    """Read-through cache of lightweight user profiles.
+
+    Profiles are user documents projected to ``PROFILE_FIELDS``. They are
+    taken from ``user_cache`` if possible and queried from the database
+    otherwise. Returned profiles are shared and must not be mutated.
+    """
+
+    def __init__(self):
+        """Create empty cache."""
+        self._profiles: TTLCache[int, typing.Dict[str, typing.Any]] = TTLCache(
+            config.PROFILE_CACHE_SIZE, config.PROFILE_CACHE_TTL
+        )
+
+    def set(self, document: typing.Mapping[str, typing.Any]) -> None:
+        """Cache profile from user ``document``."""
+        profile = {
+            field: document[field] for field in PROFILE_FIELDS if field in document
+        }
+        self._profiles.set(document["id"], profile)
+
+    def invalidate(self, user_id: int) -> None:
+        """Remove profile of user with Telegram ID ``user_id`` from cache."""
+        self._profiles.pop(user_id)
+
+    async def get(
+        self, user_id: int
+    ) -> typing.Optional[typing.Mapping[str, typing.Any]]:
+        """Get profile of user with Telegram ID ``user_id``."""
+        profiles = await self.get_many([user_id])
+        return profiles.get(user_id)
+
+    async def get_many(
+        self, user_ids: typing.Iterable[int]
+    ) -> typing.Dict[int, typing.Mapping[str, typing.Any]]:
+        """Get profiles of users with Telegram IDs ``user_ids`` by their IDs.
+
+        Uncached profiles are queried with one request.
+        """
+        profiles: typing.Dict[int, typing.Mapping[str, typing.Any]] = {}
+        missing = []
+        for user_id in user_ids:
+            profile = self._profiles.get(user_id)
+            if profile is None:
+                document = user_cache.get(user_id)
+                if document is not None:
+                    self.set(document)
+                    profile = self._profiles.get(user_id)
+            if profile is not None:
+                profiles[user_id] = profile
+            else:
+                missing.append(user_id)
+        if missing:
+            cursor = database.users.find(
+                {"id": {"$in": missing}},
+                projection={field: True for field in PROFILE_FIELDS},
+            )
+            async for document in cursor:
+                self.set(document)
+                profiles[document["id"]] = self._profiles.get(document["id"])
+        return profiles
+
+
+profile_cache = ProfileCache()
+
+
+class StorageSession:
+    """Changes of FSM storage made during processing of one update."""
+
+    def __init__(self):
+        """Start session without changes."""
+        #: Top-level fields of user document changed during the session.
+        self.fields: typing.Set[str] = set()
+        #: Whether changes were already written to the database.
+        self.closed = False
+
+
+storage_session: ContextVar[typing.Optional[StorageSession]] = ContextVar(
+    "storage_session", default=None
+)
+
+
 class MongoStorage(BaseStorage):
-    """MongoDB asynchronous storage for FSM using motor."""
+    """MongoDB asynchronous storage for FSM using motor.
+
+    State and data of the user whose update is being processed are
+    taken from ``database_user`` and changed in memory. The changes are
+    written to the database in one request by ``commit_session``.
+    """
+
+    def begin_session(self) -> None:
+        """Start collecting changes made during processing of current update."""
+        storage_session.set(StorageSession())
+
+    async def commit_session(self) -> None:
+        """Write changes collected during processing of current update."""
+        session = storage_session.get()
+        if session is None or session.closed:
+            return
+        session.closed = True
+        document = database_user.get(None)
+        if not session.fields or document is None:
+            return
+        update: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+        for field in session.fields:
+            if field in document:
+                update.setdefault("$set", {})[field] = document[field]
+            else:
+                update.setdefault("$unset", {})[field] = True
+        await database.users.update_one({"id": document["id"]}, update)
+
+    def _session_document(
+        self, user: int
+    ) -> typing.Optional[typing.MutableMapping[str, typing.Any]]:
+        session = storage_session.get()
+        if session is None or session.closed:
+            return None
+        document = database_user.get(None)
+        if document is None or document["id"] != user:
+            return None
+        return document
+
+    async def _get_document(
+        self, user: int
+    ) -> typing.Optional[typing.Mapping[str, typing.Any]]:
+        document = self._session_document(user)
+        if document is None:
+            document = await database.users.find_one({"id": user})
+        return document
+
+    async def _update(
+        self, user: int, update: typing.Mapping[str, typing.Mapping[str, typing.Any]]
+    ) -> None:
+        document = self._session_document(user)
+        if document is None:
+            await database.users.update_one({"id": user}, update)
+            user_cache.patch(user, update)
+            return
+        apply_update(document, update)
+        session = storage_session.get()
+        for fields in update.values():
+            session.fields.update(path.split(".", 1)[0] for path in fields)
 
     async def get_state(self, user: int, **kwargs) -> typing.Optional[str]:
         """Get current state of user with Telegram ID ``user``."""
-        document = await database.users.find_one({"id": user})
+        document = await self._get_document(user)
         return document.get("state") if document else None
 
     async def set_state(
@@ -54,23 +361,23 @@ class MongoStorage(BaseStorage):
     ) -> None:
         """Set new state ``state`` of user with Telegram ID ``user``."""
         if state is None:
-            await database.users.update_one({"id": user}, {"$unset": {"state": True}})
+            await self._update(user, {"$unset": {"state": True}})
         else:
-            await database.users.update_one({"id": user}, {"$set": {"state": state}})
+            await self._update(user, {"$set": {"state": state}})
 
     async def get_data(self, user: int, **kwargs) -> typing.Dict:
         """Get state data of user with Telegram ID ``user``."""
-        document = await database.users.find_one({"id": user})
-        return document.get("data", {})
+        document = await self._get_document(user)
+        return dict(document.get("data", {}))
 
     async def set_data(
         self, user: int, data: typing.Optional[typing.Dict] = None, **kwargs
     ) -> None:
         """Set state data ``data`` of user with Telegram ID ``user``."""
         if data is None:
-            await database.users.update_one({"id": user}, {"$unset": {"data": True}})
+            await self._update(user, {"$unset": {"data": True}})
         else:
-            await database.users.update_one({"id": user}, {"$set": {"data": data}})
+            await self._update(user, {"$set": {"data": dict(data)}})
 
     async def update_data(
         self, user: int, data: typing.Optional[typing.Dict] = None, **kwargs
@@ -79,9 +386,8 @@ class MongoStorage(BaseStorage):
         if data is None:
             data = {}
         data.update(kwargs)
-        await database.users.update_one(
-            {"id": user},
-            {"$set": {f"data.{key}": value for key, value in data.items()}},
+        await self._update(
+            user, {"$set": {f"data.{key}": value for key, value in data.items()}}
         )
 
     async def reset_state(self, user: int, with_data: bool = True, **kwargs):
@@ -89,7 +395,7 @@ class MongoStorage(BaseStorage):
         update = {"$unset": {"state": True}}
         if with_data:
             update["$unset"]["data"] = True
-        await database.users.update_one({"id": user}, update)
+        await self._update(user, update)
 
     async def finish(self, user: int, **kwargs):
         """Finish conversation with user."""
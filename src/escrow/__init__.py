@@ -14,6 +14,8 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with TellerBot.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+
 from src.config import config
 from src.escrow.blockchain import StreamBlockchain
 
@@ -37,14 +39,39 @@ def get_escrow_instance(asset: str):
             return bc
 
 
-async def connect_to_blockchains():
-    """Run ``connect()`` method on every blockchain instance."""
+#: Event set when all blockchain instances are connected.
+blockchains_connected = asyncio.Event()
+
+
+async def connect_to_blockchains(restore_queues: bool = True):
+    """Run ``connect()`` method on every blockchain instance.
+
+    :param restore_queues: Restore queues of unconfirmed transactions
+        after connecting.
+    """
     for bc in SUPPORTED_BLOCKCHAINS:
         await bc.connect()
+    blockchains_connected.set()
+    if restore_queues:
+        await restore_blockchain_queues()
+
+
+async def restore_blockchain_queues():
+    """Run ``restore_queue()`` method on every connected blockchain instance."""
+    await blockchains_connected.wait()
+    for bc in SUPPORTED_BLOCKCHAINS:
+        await bc.restore_queue()
         if isinstance(bc, StreamBlockchain) and bc._queue:
             bc.start_streaming()
 
 
+async def run_history_scanners():
+    """Run ``run_scanner()`` method of every blockchain instance having it."""
+    await blockchains_connected.wait()
+    scanners = [bc for bc in SUPPORTED_BLOCKCHAINS if hasattr(bc, "run_scanner")]
+    await asyncio.gather(*(bc.run_scanner() for bc in scanners))
+
+
 async def close_blockchains():
     """Run ``close()`` method on every blockchain instance."""
     for bc in SUPPORTED_BLOCKCHAINS:
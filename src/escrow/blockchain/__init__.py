@@ -14,12 +14,16 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with TellerBot.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import heapq
 import json
+import logging
 import typing
 from abc import ABC
 from abc import abstractmethod
 from asyncio import create_task
 from asyncio import get_running_loop
+from asyncio import Task
 from decimal import Decimal
 from time import time
 
@@ -30,9 +34,23 @@ from aiogram.utils import markdown
 from bson.objectid import ObjectId
 
 from src.bot import tg
+from src.cache import TTLCache
 from src.config import config
 from src.database import database
 from src.i18n import i18n
+from src.indexes import index_registry
+
+log = logging.getLogger(__name__)
+
+index_registry.add(
+    "escrow",
+    [("escrow", 1), ("memo", 1), ("trx_id", 1)],
+    query={
+        "escrow": {"$in": ["GOLOS"]},
+        "memo": {"$exists": True},
+        "trx_id": {"$exists": False},
+    },
+)
 
 
 class InsuranceLimits(typing.NamedTuple):
@@ -44,6 +62,97 @@ class InsuranceLimits(typing.NamedTuple):
     total: Decimal
 
 
+class IrreversibleBlockWatcher:
+    """Shared tracker of the last irreversible block of blockchain.
+
+    Node is polled by one background task while there are waiters, so
+    that any number of concurrent confirmations costs one request per
+    ``interval`` seconds.
+
+    :param get_block_numbers: Coroutine function returning numbers of
+        head block and the last irreversible block.
+    :param interval: Delay between requests in seconds.
+    :param name: Name of blockchain used in logs.
+    """
+
+    def __init__(
+        self,
+        get_block_numbers: typing.Callable[
+            [], typing.Awaitable[typing.Tuple[int, int]]
+        ],
+        interval: float,
+        name: str,
+    ):
+        """Create watcher without starting polling."""
+        self._get_block_numbers = get_block_numbers
+        self._interval = interval
+        self._name = name
+        #: Number of head block.
+        self.head_block_num: typing.Optional[int] = None
+        #: Number of the last irreversible block.
+        self.last_irreversible_block_num: typing.Optional[int] = None
+        self._waiters: typing.Dict[int, typing.List[asyncio.Future]] = {}
+        self._heap: typing.List[int] = []
+        self._task: typing.Optional[Task] = None
+
+    @property
+    def lag(self) -> typing.Optional[int]:
+        """Get number of blocks which are not irreversible yet."""
+        if self.head_block_num is None or self.last_irreversible_block_num is None:
+            return None
+        return self.head_block_num - self.last_irreversible_block_num
+
+    async def wait(self, block_num: int) -> None:
+        """Wait until block # ``block_num`` becomes irreversible."""
+        last = self.last_irreversible_block_num
+        if last is not None and block_num <= last:
+            return
+        future = get_running_loop().create_future()
+        if block_num not in self._waiters:
+            self._waiters[block_num] = []
+            heapq.heappush(self._heap, block_num)
+        self._waiters[block_num].append(future)
+        if self._task is None or self._task.done():
+            self._task = create_task(self._run())
+        await future
+
+    def _release(self) -> None:
+        last = self.last_irreversible_block_num
+        while self._heap and self._heap[0] <= last:
+            block_num = heapq.heappop(self._heap)
+            for future in self._waiters.pop(block_num):
+                if not future.done():
+                    future.set_result(None)
+
+    async def _run(self) -> None:
+        while self._waiters:
+            try:
+                head, last = await self._get_block_numbers()
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                log.warning(
+                    "Failed to get irreversible block of %s: %s", self._name, error
+                )
+            else:
+                self.head_block_num = head
+                self.last_irreversible_block_num = last
+                self._release()
+                if not self._waiters:
+                    return
+            await asyncio.sleep(self._interval)
+
+    def close(self) -> None:
+        """Stop polling and cancel waiters."""
+        if self._task is not None:
+            self._task.cancel()
+        for futures in self._waiters.values():
+            for future in futures:
+                future.cancel()
+        self._waiters.clear()
+        self._heap.clear()
+
+
 class BaseBlockchain(ABC):
     """Abstract class to represent blockchain node client for escrow exchange."""
 
@@ -57,10 +166,28 @@ class BaseBlockchain(ABC):
     #: contain ``{}`` which gets replaced with transaction id.
     explorer: str = "{}"
 
+    def __init__(self):
+        """Create client with tracker of irreversible blocks."""
+        self.irreversible_blocks = IrreversibleBlockWatcher(
+            self.get_block_numbers, config.BLOCK_CONFIRMATION_INTERVAL, self.name
+        )
+        self._confirmed_blocks: TTLCache[int, typing.Any] = TTLCache(
+            config.CONFIRMED_BLOCK_CACHE_SIZE, config.CONFIRMED_BLOCK_CACHE_TTL
+        )
+        self._blocks_in_flight: typing.Dict[int, Task] = {}
+
     @abstractmethod
     async def connect(self) -> None:
         """Establish connection with blockchain node."""
 
+    @abstractmethod
+    async def restore_queue(self) -> None:
+        """Check transactions which were unconfirmed when bot stopped.
+
+        Confirmed transactions are processed immediately and the rest
+        is checked in the same way as new transactions.
+        """
+
     @abstractmethod
     async def get_limits(self, asset: str) -> InsuranceLimits:
         """Get maximum amounts of ``asset`` which will be insured during escrow exchange.
@@ -104,19 +231,55 @@ class BaseBlockchain(ABC):
         """
 
     @abstractmethod
+    async def get_block_numbers(self) -> typing.Tuple[int, int]:
+        """Get numbers of head block and the last irreversible block."""
+
+    @abstractmethod
+    async def get_block(self, block_num: int) -> typing.Any:
+        """Get block # ``block_num`` or None if it isn't found."""
+
+    @abstractmethod
+    def block_has_op(
+        self, block: typing.Any, op: typing.Mapping[str, typing.Any]
+    ) -> bool:
+        """Check if ``block`` returned by ``get_block`` contains ``op``."""
+
+    async def _get_confirmed_block(self, block_num: int) -> typing.Any:
+        block = self._confirmed_blocks.get(block_num)
+        if block is not None:
+            return block
+        task = self._blocks_in_flight.get(block_num)
+        if task is None:
+            task = create_task(self.get_block(block_num))
+            self._blocks_in_flight[block_num] = task
+            task.add_done_callback(
+                lambda task: self._blocks_in_flight.pop(block_num, None)
+            )
+        # Cancellation of one waiter must not cancel request of others
+        block = await asyncio.shield(task)
+        if block is not None:
+            self._confirmed_blocks.set(block_num, block)
+        return block
+
     async def is_block_confirmed(
         self, block_num: int, op: typing.Mapping[str, typing.Any]
     ) -> bool:
         """Check if block # ``block_num`` has ``op`` after confirmation.
 
-        Check block on blockchain-specific conditions to consider it confirmed.
+        Block is requested once when it becomes irreversible and
+        operations of all confirmations waiting for it are looked up in
+        the same block.
 
         :param block_num: Number of block to check.
         :param op: Operation to check.
         """
+        await self.irreversible_blocks.wait(block_num)
+        block = await self._get_confirmed_block(block_num)
+        return block is not None and self.block_has_op(block, op)
 
     async def close(self):
         """Close connection with blockchain node."""
+        self.irreversible_blocks.close()
 
     @property
     def nodes(self) -> typing.List[str]:
@@ -348,10 +511,84 @@ class BaseBlockchain(ABC):
         await tg.send_message(user["id"], answer, parse_mode=ParseMode.MARKDOWN)
 
 
+class WatchRegistry:
+    """Transactions watched in blockchain stream.
+
+    Queue members are indexed by ``offer_id`` and by pair of receiving
+    and sending addresses, so that operations are matched only against
+    queue members expecting transfer between their addresses.
+    Addresses are compared case-insensitively.
+    """
+
+    def __init__(self):
+        """Create empty registry."""
+        self._by_offer: typing.Dict[ObjectId, typing.Dict[str, typing.Any]] = {}
+        self._by_addresses: typing.Dict[
+            typing.Tuple[str, str], typing.Dict[ObjectId, typing.Dict[str, typing.Any]]
+        ] = {}
+        self._keys: typing.Dict[ObjectId, typing.Tuple[str, str]] = {}
+
+    def __len__(self) -> int:
+        """Get number of watched transactions."""
+        return len(self._by_offer)
+
+    def __iter__(self) -> typing.Iterator[typing.Dict[str, typing.Any]]:
+        """Iterate over queue members in order of addition."""
+        return iter(list(self._by_offer.values()))
+
+    def __contains__(self, offer_id: ObjectId) -> bool:
+        """Check if transaction of offer with ``offer_id`` is watched."""
+        return offer_id in self._by_offer
+
+    def add(self, to_address: str, queue_member: typing.Dict[str, typing.Any]) -> None:
+        """Watch transfer to ``to_address`` described by ``queue_member``.
+
+        Queue member with the same ``offer_id`` is replaced.
+        """
+        offer_id = queue_member["offer_id"]
+        self.remove(offer_id)
+        key = (to_address.lower(), queue_member["from_address"].lower())
+        self._by_offer[offer_id] = queue_member
+        self._by_addresses.setdefault(key, {})[offer_id] = queue_member
+        self._keys[offer_id] = key
+
+    def get(self, offer_id: ObjectId) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        """Get queue member with ``offer_id``."""
+        return self._by_offer.get(offer_id)
+
+    def remove(
+        self, offer_id: ObjectId
+    ) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        """Stop watching transaction of offer with ``offer_id``.
+
+        :return: Removed queue member or None if it wasn't watched.
+        """
+        queue_member = self._by_offer.pop(offer_id, None)
+        if queue_member is None:
+            return None
+        key = self._keys.pop(offer_id)
+        members = self._by_addresses[key]
+        del members[offer_id]
+        if not members:
+            del self._by_addresses[key]
+        return queue_member
+
+    def find(
+        self, to_address: str, from_address: str
+    ) -> typing.List[typing.Dict[str, typing.Any]]:
+        """Get queue members expecting transfer between addresses."""
+        members = self._by_addresses.get((to_address.lower(), from_address.lower()))
+        return list(members.values()) if members else []
+
+
 class StreamBlockchain(BaseBlockchain):
     """Blockchain node client supporting continuous stream to check transaction."""
 
-    _queue: typing.List[typing.Dict[str, typing.Any]] = []
+    def __init__(self):
+        """Create client without watched transactions."""
+        super().__init__()
+        self._queue = WatchRegistry()
+        self._stream_task: typing.Optional[Task] = None
 
     def remove_from_queue(
         self, offer_id: ObjectId
@@ -359,15 +596,12 @@ class StreamBlockchain(BaseBlockchain):
         """Remove transaction with specified ``offer_id`` value from ``self._queue``.
 
         :param offer_id: ``_id`` of escrow offer.
-        :return: True if transaction was found and False otherwise.
+        :return: Removed queue member or None if it wasn't found.
         """
-        for queue_member in self._queue:
-            if queue_member["offer_id"] == offer_id:
-                if "timeout_handler" in queue_member:
-                    queue_member["timeout_handler"].cancel()
-                self._queue.remove(queue_member)
-                return queue_member
-        return None
+        queue_member = self._queue.remove(offer_id)
+        if queue_member is not None and "timeout_handler" in queue_member:
+            queue_member["timeout_handler"].cancel()
+        return queue_member
 
     def check_timeout(self, offer_id: ObjectId) -> None:
         self.remove_from_queue(offer_id)
@@ -381,26 +615,26 @@ class StreamBlockchain(BaseBlockchain):
         otherwise get new blocks in blockchain-specific time interval between blocks.
 
         If block contains desired transaction, call ``self._confirmation_callback``.
-        If it returns True, remove transaction from ``self._queue`` and stop
-        streaming if ``self._queue`` is empty.
+        If it returns True, remove transaction from ``self._queue``. Streaming
+        may stop when ``self._queue`` is empty or keep subscription idle.
         """
 
     def start_streaming(self) -> None:
-        """Start streaming in background asynchronous task."""
-        create_task(self.stream())
+        """Start streaming in background asynchronous task if it isn't running."""
+        if self._stream_task is None or self._stream_task.done():
+            self._stream_task = create_task(self.stream())
 
     async def add_to_queue(self, **kwargs):
         """Add transaction to self._queue to be checked.
 
         Same parameters as in ``self.check_transaction``.
         """
+        self.remove_from_queue(kwargs["offer_id"])
         queue_member = await self.schedule_timeout(kwargs)
         if not queue_member:
             return
-        self._queue.append(queue_member)
-        # Start streaming if not already streaming
-        if len(self._queue) == 1:
-            self.start_streaming()
+        self._queue.add(self.address, queue_member)
+        self.start_streaming()
 
 
 class BlockchainConnectionError(Exception):
@@ -14,13 +14,16 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with TellerBot.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
 import json
+import logging
 import typing
-from asyncio import sleep
 from calendar import timegm
 from datetime import datetime
 from datetime import timedelta
 from decimal import Decimal
+from time import monotonic
+from time import time
 from urllib.parse import urljoin
 
 import aiohttp
@@ -28,16 +31,33 @@ from eospy import schema
 from eospy import types
 from eospy.keys import EOSKey
 from eospy.utils import sig_digest
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
 
 from src.config import config
+from src.database import database
 from src.escrow.blockchain import BaseBlockchain
 from src.escrow.blockchain import BlockchainConnectionError
 from src.escrow.blockchain import InsuranceLimits
 from src.escrow.blockchain import TransferError
+from src.indexes import index_registry
 
+log = logging.getLogger(__name__)
 
 TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
 
+index_registry.add("transfers", [("blockchain", 1), ("seq", 1)], unique=True)
+index_registry.add(
+    "transfers",
+    [("blockchain", 1), ("from", 1), ("timestamp", 1)],
+    query={"blockchain": "cyber", "from": {"$in": []}, "timestamp": {"$gte": 0}},
+    sort=[("timestamp", -1)],
+)
+# Transfers older than check timeout can't belong to any escrow offer
+index_registry.add(
+    "transfers", "date", expireAfterSeconds=config.CHECK_TIMEOUT_HOURS * 60 * 60
+)
+
 
 class MaxRamKbytesSchema(schema.IntSchema):
     """RAM as an additional CyberWay resource."""
@@ -105,6 +125,13 @@ class CyberBlockchain(BaseBlockchain):
     address = "usr11jwlrakn"
     explorer = "https://explorer.cyberway.io/trx/{}"
 
+    def __init__(self):
+        """Create client without running history scan."""
+        super().__init__()
+        self._scan_task: typing.Optional[asyncio.Task] = None
+        #: Monotonic time of the last completed history scan.
+        self._scanned_at: typing.Optional[float] = None
+
     async def connect(self):
         self._session = aiohttp.ClientSession(
             raise_for_status=True, timeout=aiohttp.ClientTimeout(total=30)
@@ -121,6 +148,7 @@ class CyberBlockchain(BaseBlockchain):
         else:
             raise BlockchainConnectionError("Couldn't connect to any node")
 
+    async def restore_queue(self):
         queue = await self.create_queue()
         if not queue:
             return
@@ -180,26 +208,29 @@ class CyberBlockchain(BaseBlockchain):
             raise TransferError
         return self.trx_url(result["transaction_id"])
 
-    async def is_block_confirmed(self, block_num, op):
-        while True:
-            try:
-                info = await self._api("v1/chain/get_info")
-            except aiohttp.ClientResponseError:
-                continue
-            if block_num <= info["last_irreversible_block_num"]:
-                break
-            await sleep(3)
+    async def get_block_numbers(self):
+        info = await self._api("v1/chain/get_info")
+        return info["head_block_num"], info["last_irreversible_block_num"]
+
+    async def get_block(self, block_num):
         try:
-            await self._api(
-                "v1/history/get_transaction",
-                data={"id": op["trx_id"], "block_num_hint": block_num},
+            return await self._api(
+                "v1/chain/get_block", data={"block_num_or_id": block_num}
             )
         except aiohttp.ClientResponseError:
-            return False
-        else:
-            return True
+            return None
+
+    def block_has_op(self, block, op):
+        for transaction in block["transactions"]:
+            trx = transaction["trx"]
+            # Deferred transactions are represented only by ID
+            trx_id = trx if isinstance(trx, str) else trx["id"]
+            if trx_id == op["trx_id"]:
+                return True
+        return False
 
     async def close(self):
+        await super().close()
         if hasattr(self, "_session"):
             await self._session.close()
 
@@ -246,42 +277,183 @@ class CyberBlockchain(BaseBlockchain):
         addresses = await self._resolve_addresses([address])
         return addresses[address]
 
-    async def _check_queue_in_history(
-        self,
-        queue: typing.List[typing.Dict[str, typing.Any]],
-    ) -> bool:
-        addresses = [queue_member["from_address"].lower() for queue_member in queue]
-        resolved = await self._resolve_addresses(addresses)
-        for queue_member, address in zip(queue, addresses):
-            queue_member["from_address"] = resolved[address]
+    @property
+    def _cursor_id(self) -> str:
+        return f"{self.name}:{self.address}"
 
+    async def scan_history(self) -> None:
+        """Index transfers to ``self.address`` made since the last scan.
+
+        Concurrent calls wait for the same scan.
+        """
+        if self._scan_task is None or self._scan_task.done():
+            self._scan_task = asyncio.create_task(self._scan_history())
+        # Cancellation of one waiter must not cancel scan of others
+        await asyncio.shield(self._scan_task)
+
+    async def run_scanner(self) -> None:
+        """Scan history periodically."""
+        while True:
+            try:
+                await self.scan_history()
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                log.warning("Failed to scan history of %s: %s", self.address, error)
+            await asyncio.sleep(config.CYBER_HISTORY_SCAN_INTERVAL)
+
+    async def _initial_seq(self) -> int:
+        """Find sequence number of the last action before checked transfers.
+
+        Transfers older than ``config.CHECK_TIMEOUT_HOURS`` can't belong
+        to unconfirmed offers, so they are not indexed.
+        """
+        min_time = time() - config.CHECK_TIMEOUT_HOURS * 60 * 60
         pos = -1
-        min_time = self.get_min_time(queue)
         while True:
             history = await self._api(
                 "v1/history/get_actions",
-                data={"account_name": self.address, "pos": pos, "offset": -20},
+                data={
+                    "account_name": self.address,
+                    "pos": pos,
+                    "offset": 1 - config.CYBER_HISTORY_PAGE_SIZE,
+                },
             )
             if not history["actions"]:
-                return False
-            for act in reversed(history["actions"]):
-                if act["action_trace"]["act"]["name"] != "transfer":
+                return -1
+            first = history["actions"][0]
+            date = datetime.strptime(first["block_time"], TIME_FORMAT)
+            if timegm(date.timetuple()) < min_time or first["account_action_seq"] == 0:
+                return first["account_action_seq"] - 1
+            pos = first["account_action_seq"] - 1
+
+    async def _scan_history(self) -> None:
+        cursor = await database.cursors.find_one({"_id": self._cursor_id})
+        seq = cursor["seq"] if cursor else await self._initial_seq()
+        while True:
+            history = await self._api(
+                "v1/history/get_actions",
+                data={
+                    "account_name": self.address,
+                    "pos": seq + 1,
+                    "offset": config.CYBER_HISTORY_PAGE_SIZE - 1,
+                },
+            )
+            actions = [
+                act for act in history["actions"] if act["account_action_seq"] > seq
+            ]
+            if not actions:
+                break
+            requests = []
+            for act in actions:
+                try:
+                    transfer = self._incoming_transfer(act)
+                except (KeyError, TypeError, ValueError) as error:
+                    log.warning(
+                        "Skipping malformed action %s of %s: %r",
+                        act["account_action_seq"],
+                        self.address,
+                        error,
+                    )
                     continue
-                date = datetime.strptime(act["block_time"], TIME_FORMAT)
-                if timegm(date.timetuple()) < min_time:
-                    return False
-                op = act["action_trace"]["act"]["data"]
-                op["timestamp"] = act["block_time"]
-                op["trx_id"] = act["action_trace"]["trx_id"]
-                req = await self._check_operation(op, act["block_num"], queue)
-                if not req:
+                if transfer is None:
                     continue
-                await self._confirmation_callback(
-                    req["offer_id"], op, op["trx_id"], act["block_num"]
+                requests.append(
+                    UpdateOne(
+                        {"blockchain": self.name, "seq": transfer["seq"]},
+                        {"$setOnInsert": transfer},
+                        upsert=True,
+                    )
                 )
-                if len(queue) == 1:
-                    return True
-            pos = history["actions"][0]["account_action_seq"] - 1
+            if requests:
+                await database.transfers.bulk_write(requests, ordered=False)
+            seq = actions[-1]["account_action_seq"]
+            await self._save_cursor(seq)
+            if len(history["actions"]) < config.CYBER_HISTORY_PAGE_SIZE:
+                break
+        self._scanned_at = monotonic()
+
+    def _incoming_transfer(
+        self, act: typing.Mapping[str, typing.Any]
+    ) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        op = act["action_trace"]["act"]
+        if (
+            op["account"] != "cyber.token"
+            or op["name"] != "transfer"
+            or op["data"].get("to") != self.address
+        ):
+            return None
+        date = datetime.strptime(act["block_time"], TIME_FORMAT)
+        return {
+            "blockchain": self.name,
+            "seq": act["account_action_seq"],
+            "trx_id": act["action_trace"]["trx_id"],
+            "block_num": act["block_num"],
+            "block_time": act["block_time"],
+            "timestamp": timegm(date.timetuple()),
+            "date": date,
+            "from": op["data"]["from"],
+            "to": op["data"]["to"],
+            "quantity": op["data"]["quantity"],
+            "memo": op["data"]["memo"],
+        }
+
+    async def _save_cursor(self, seq: int) -> None:
+        try:
+            await database.cursors.update_one(
+                {"_id": self._cursor_id, "seq": {"$lt": seq}},
+                {"$set": {"seq": seq}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            # Concurrent process has already scanned further
+            pass
+
+    async def _check_queue_in_history(
+        self,
+        queue: typing.List[typing.Dict[str, typing.Any]],
+    ) -> bool:
+        addresses = [queue_member["from_address"].lower() for queue_member in queue]
+        resolved = await self._resolve_addresses(addresses)
+        for queue_member, address in zip(queue, addresses):
+            queue_member["from_address"] = resolved[address]
+
+        if (
+            self._scanned_at is None
+            or monotonic() - self._scanned_at > config.CYBER_HISTORY_SCAN_INTERVAL
+        ):
+            try:
+                await self.scan_history()
+            except aiohttp.ClientError as error:
+                # Transfers indexed before are checked anyway
+                log.warning("Failed to scan history of %s: %s", self.address, error)
+        cursor = database.transfers.find(
+            {
+                "blockchain": self.name,
+                "from": {
+                    "$in": [queue_member["from_address"] for queue_member in queue]
+                },
+                "timestamp": {"$gte": self.get_min_time(queue)},
+            }
+        ).sort("timestamp", -1)
+        async for transfer in cursor:
+            op = {
+                "from": transfer["from"],
+                "to": transfer["to"],
+                "quantity": transfer["quantity"],
+                "memo": transfer["memo"],
+                "timestamp": transfer["block_time"],
+                "trx_id": transfer["trx_id"],
+            }
+            req = await self._check_operation(op, transfer["block_num"], queue)
+            if not req:
+                continue
+            await self._confirmation_callback(
+                req["offer_id"], op, op["trx_id"], transfer["block_num"]
+            )
+            if len(queue) == 1:
+                return True
+        return False
 
     async def _check_operation(
         self,
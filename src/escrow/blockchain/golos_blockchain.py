@@ -14,8 +14,10 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with TellerBot.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
 import functools
-import json
+import itertools
+import logging
 import typing
 from asyncio import get_running_loop
 from asyncio import sleep
@@ -24,15 +26,105 @@ from datetime import datetime
 from decimal import Decimal
 from time import time
 
+import aiohttp
 from golos import Api
 from golos.exceptions import GolosException
 from golos.exceptions import RetriesExceeded
-from golos.exceptions import TransactionNotFound
 
+from src.config import config
 from src.escrow.blockchain import BlockchainConnectionError
 from src.escrow.blockchain import InsuranceLimits
 from src.escrow.blockchain import StreamBlockchain
 from src.escrow.blockchain import TransferError
+from src.escrow.blockchain import WatchRegistry
+
+log = logging.getLogger(__name__)
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+def block_number(block: typing.Mapping[str, typing.Any]) -> int:
+    """Get number of ``block`` from ID of previous block."""
+    return int(block["previous"][:8], 16) + 1
+
+
+class BlockSubscription:
+    """Subscription to applied blocks on Golos node over WebSocket.
+
+    Responses are read by background task, so that API methods can be
+    called while blocks are received.
+
+    :param websocket: Connection to node.
+    """
+
+    def __init__(self, websocket: aiohttp.ClientWebSocketResponse):
+        """Start reading responses from ``websocket``."""
+        self._websocket = websocket
+        self._ids = itertools.count(1)
+        self._subscription_id: typing.Optional[int] = None
+        self._requests: typing.Dict[int, asyncio.Future] = {}
+        self._blocks: "asyncio.Queue[typing.Optional[typing.Dict]]" = asyncio.Queue()
+        self._reader = asyncio.create_task(self._read())
+
+    async def _send(
+        self, request_id: int, method: str, params: typing.List[typing.Any]
+    ) -> None:
+        await self._websocket.send_json(
+            {
+                "id": request_id,
+                "method": "call",
+                "params": ["database_api", method, params],
+            }
+        )
+
+    async def call(self, method: str, *params: typing.Any) -> typing.Any:
+        """Call method of database API and return its result."""
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        # Future is registered before sending so that response isn't missed
+        self._requests[request_id] = future
+        await self._send(request_id, method, list(params))
+        return await future
+
+    async def subscribe(self) -> None:
+        """Subscribe to applied blocks."""
+        self._subscription_id = next(self._ids)
+        await self._send(self._subscription_id, "set_block_applied_callback", [0])
+
+    async def next_block(self) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        """Wait for next applied block.
+
+        :return: Block or None if connection is closed.
+        """
+        return await self._blocks.get()
+
+    async def _read(self) -> None:
+        try:
+            async for message in self._websocket:
+                if message.type != aiohttp.WSMsgType.TEXT:
+                    break
+                response = message.json()
+                future = self._requests.pop(response.get("id"), None)
+                if future is not None:
+                    if "error" in response:
+                        future.set_exception(GolosException(response["error"]))
+                    else:
+                        future.set_result(response["result"])
+                elif response.get("id") == self._subscription_id:
+                    # Errors of subscription are skipped until next block
+                    if "error" not in response:
+                        self._blocks.put_nowait(response["result"])
+        finally:
+            for future in self._requests.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Connection is closed"))
+            self._requests.clear()
+            self._blocks.put_nowait(None)
+
+    async def close(self) -> None:
+        """Close connection to node."""
+        self._reader.cancel()
+        await self._websocket.close()
 
 
 class GolosBlockchain(StreamBlockchain):
@@ -48,16 +140,29 @@ class GolosBlockchain(StreamBlockchain):
         connect_to_node = functools.partial(Api, nodes=self.nodes)
         try:
             self._golos = await loop.run_in_executor(None, connect_to_node)
-            self._stream = await loop.run_in_executor(None, connect_to_node)
-            self._stream.rpc.api_total["set_block_applied_callback"] = "database_api"
         except RetriesExceeded as exception:
             raise BlockchainConnectionError(exception)
+        self._session = aiohttp.ClientSession()
+        #: Number and timestamp of the last processed block.
+        self._last_block: typing.Optional[typing.Tuple[int, float]] = None
 
-        queue = await self.create_queue()
-        if not queue:
+    async def restore_queue(self):
+        members = await self.create_queue()
+        if not members:
             return
-        min_time = self.get_min_time(queue)
+        min_time = self.get_min_time(members)
+        queue = WatchRegistry()
+        for queue_member in members:
+            queue.add(self.address, queue_member)
+        await self._check_history(queue, min_time)
+        for queue_member in queue:
+            self._queue.add(self.address, queue_member)
+
+    async def _check_history(self, queue: WatchRegistry, min_time: float) -> None:
+        """Check transfers to ``self.address`` since ``min_time`` for ``queue``.
 
+        Confirmed transactions are removed from ``queue``.
+        """
         func = functools.partial(
             self._golos.get_account_history,
             self.address,
@@ -73,10 +178,9 @@ class GolosBlockchain(StreamBlockchain):
                 req["offer_id"], op, op["trx_id"], op["block"]
             )
             if is_confirmed:
-                queue.remove(req)
+                queue.remove(req["offer_id"])
                 if not queue:
                     return
-        self._queue.extend(queue)
 
     async def get_limits(self, asset: str):
         limits = {"GOLOS": InsuranceLimits(Decimal("10000"), Decimal("100000"))}
@@ -98,81 +202,146 @@ class GolosBlockchain(StreamBlockchain):
             raise TransferError
         return self.trx_url(transaction["id"])
 
-    async def is_block_confirmed(self, block_num, op):
-        loop = get_running_loop()
-        while True:
-            properties = await loop.run_in_executor(
-                None, self._golos.get_dynamic_global_properties
-            )
-            if properties:
-                head_block_num = properties["last_irreversible_block_num"]
-                if block_num <= head_block_num:
-                    break
-            await sleep(3)
-        op = {
-            "block": block_num,
-            "type_op": "transfer",
-            "to": op["to"],
-            "from": op["from"],
-            "amount": op["amount"],
-            "memo": op["memo"],
-        }
-        try:
-            await loop.run_in_executor(None, self._golos.find_op_transaction, op)
-        except TransactionNotFound:
-            return False
-        else:
-            return True
+    async def get_block_numbers(self):
+        properties = await get_running_loop().run_in_executor(
+            None, self._golos.get_dynamic_global_properties
+        )
+        if not properties:
+            raise GolosException("Empty dynamic global properties")
+        return (
+            properties["head_block_number"],
+            properties["last_irreversible_block_num"],
+        )
 
-    async def stream(self):
-        loop = get_running_loop()
-        block = await loop.run_in_executor(
-            None, self._stream.rpc.call, "set_block_applied_callback", [0]
+    async def get_block(self, block_num):
+        return await get_running_loop().run_in_executor(
+            None, self._golos.rpc.call, "get_block", block_num
         )
+
+    def block_has_op(self, block, op):
+        for trx in block["transactions"]:
+            for op_type, block_op in trx["operations"]:
+                if op_type == "transfer" and all(
+                    block_op[field] == op[field]
+                    for field in ("to", "from", "amount", "memo")
+                ):
+                    return True
+        return False
+
+    async def close(self):
+        await super().close()
+        if self._stream_task is not None:
+            self._stream_task.cancel()
+        if hasattr(self, "_session"):
+            await self._session.close()
+
+    async def stream(self):
+        """Stream applied blocks while bot is running.
+
+        Subscription is kept when queue is empty, so that next escrow
+        doesn't wait for connection. Blocks missed while connection was
+        lost are requested from node after reconnection.
+        """
+        for node in itertools.cycle(self.nodes):
+            try:
+                async with self._session.ws_connect(
+                    node, heartbeat=config.GOLOS_STREAM_HEARTBEAT
+                ) as websocket:
+                    subscription = BlockSubscription(websocket)
+                    try:
+                        await self._stream_blocks(subscription)
+                    finally:
+                        await subscription.close()
+            except (aiohttp.ClientError, ConnectionError, GolosException) as error:
+                log.warning("Golos stream from %s failed: %s", node, error)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("Golos stream from %s failed", node)
+            await sleep(config.GOLOS_STREAM_RECONNECT_DELAY)
+
+    async def _stream_blocks(self, subscription: BlockSubscription) -> None:
+        await subscription.subscribe()
         while True:
-            for trx in block["transactions"]:
-                for op_type, op in trx["operations"]:
-                    if op_type != "transfer":
-                        continue
-                    block_num = int(block["previous"][:8], 16) + 1
-                    req = await self._check_operation(op, block_num)
-                    if not req:
-                        continue
-                    trx_id = await loop.run_in_executor(
-                        None, self._golos.get_transaction_id, trx
-                    )
-                    is_confirmed = await self._confirmation_callback(
-                        req["offer_id"], op, trx_id, block_num
-                    )
-                    if is_confirmed:
-                        self._queue.remove(req)
-            if not self._queue:
-                await loop.run_in_executor(None, self._stream.rpc.close)
+            block = await subscription.next_block()
+            if block is None:
+                log.warning("Golos stream connection is closed")
                 return
-            while True:
-                response = await loop.run_in_executor(None, self._stream.rpc.ws.recv)
-                response_json = json.loads(response)
-                if "error" not in response_json:
-                    break
-            block = response_json["result"]
+            block_num = block_number(block)
+            if self._last_block is not None:
+                last_block_num, last_block_time = self._last_block
+                if block_num <= last_block_num:
+                    continue
+                if self._queue and block_num > last_block_num + 1:
+                    await self._backfill(
+                        subscription, last_block_num, last_block_time, block_num
+                    )
+            await self._process_block(block, block_num)
+
+    async def _backfill(
+        self,
+        subscription: BlockSubscription,
+        last_block_num: int,
+        last_block_time: float,
+        block_num: int,
+    ) -> None:
+        """Process blocks between ``last_block_num`` and ``block_num``.
+
+        If too many blocks are missed, account history since
+        ``last_block_time`` is checked instead.
+        """
+        missed = block_num - last_block_num - 1
+        if missed > config.GOLOS_STREAM_BACKFILL_LIMIT:
+            log.warning("Missed %d Golos blocks, checking account history", missed)
+            await self._check_history(self._queue, last_block_time)
+            return
+        for missed_num in range(last_block_num + 1, block_num):
+            missed_block = await subscription.call("get_block", missed_num)
+            if missed_block:
+                await self._process_block(missed_block, missed_num)
+
+    async def _process_block(
+        self, block: typing.Mapping[str, typing.Any], block_num: int
+    ) -> None:
+        date = datetime.strptime(block["timestamp"], TIME_FORMAT)
+        self._last_block = (block_num, timegm(date.timetuple()))
+        if not self._queue:
+            return
+        loop = get_running_loop()
+        for trx in block["transactions"]:
+            for op_type, op in trx["operations"]:
+                if op_type != "transfer":
+                    continue
+                req = await self._check_operation(op, block_num)
+                if not req:
+                    continue
+                trx_id = await loop.run_in_executor(
+                    None, self._golos.get_transaction_id, trx
+                )
+                is_confirmed = await self._confirmation_callback(
+                    req["offer_id"], op, trx_id, block_num
+                )
+                if is_confirmed:
+                    self._queue.remove(req["offer_id"])
 
     async def _check_operation(
         self,
         op: typing.Mapping[str, typing.Any],
         block_num: int,
-        queue: typing.Optional[typing.List] = None,
+        queue: typing.Optional[WatchRegistry] = None,
     ):
         if queue is None:
             queue = self._queue
+        candidates = queue.find(op["to"], op["from"])
+        if not candidates:
+            return None
         op_amount, asset = op["amount"].split()
         amount = Decimal(op_amount)
-        for req in queue:
+        for req in candidates:
             if "timestamp" in op:
-                date = datetime.strptime(op["timestamp"], "%Y-%m-%dT%H:%M:%S")
+                date = datetime.strptime(op["timestamp"], TIME_FORMAT)
                 if timegm(date.timetuple()) < req["transaction_time"]:
                     continue
-            if op["to"] != self.address or op["from"] != req["from_address"].lower():
-                continue
             if "timeout_handler" in req:
                 req["timeout_handler"].cancel()
             refund_reasons = set()
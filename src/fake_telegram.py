@@ -0,0 +1,264 @@
+# Copyright (C) 2019  alfred richardsn
+#
+# This file is part of TellerBot.
+#
+# TellerBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with TellerBot.  If not, see <https://www.gnu.org/licenses/>.
+"""Local stand-in of Telegram Bot API for load tests.
+
+Bot is pointed at the server by setting ``TELEGRAM_API_URL`` to its
+address.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import typing
+from collections import Counter
+from collections import defaultdict
+from collections import deque
+from time import time
+
+from aiohttp import web
+
+Result = typing.Union[bool, typing.Dict[str, typing.Any], typing.List[typing.Any]]
+
+#: Fields of requests which are sent as JSON strings.
+JSON_FIELDS = ("reply_markup", "entities", "allowed_updates", "commands")
+
+
+def _parse_field(name: str, value: str) -> typing.Any:
+    if name in JSON_FIELDS:
+        return json.loads(value)
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+class FakeTelegramServer:
+    """Web application answering Bot API requests like Telegram does.
+
+    Messages are not delivered anywhere, but requests are counted by
+    method and last ones are kept in ``history``. Last messages of every
+    chat are kept too, so that clients can press their buttons. Updates
+    put with ``put_update`` are returned by ``getUpdates``.
+
+    :param latency: Delay of every response in seconds.
+    :param history_size: Number of last requests kept in ``history``.
+    :param chat_history_size: Number of last messages kept for every chat.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        history_size: int = 1000,
+        chat_history_size: int = 10,
+    ):
+        """Create server without requests."""
+        self.latency = latency
+        #: Number of requests by method name.
+        self.method_counts: typing.Counter[str] = Counter()
+        #: Last requests as (method, data) pairs.
+        self.history: typing.Deque[typing.Tuple[str, typing.Dict[str, typing.Any]]] = (
+            deque(maxlen=history_size)
+        )
+        #: Last sent or edited messages by chat ID.
+        self.chat_messages: typing.DefaultDict[
+            typing.Union[int, str], typing.Deque[typing.Dict[str, typing.Any]]
+        ] = defaultdict(lambda: deque(maxlen=chat_history_size))
+        self.webhook_url = ""
+        self.bot_user = {
+            "id": 1,
+            "is_bot": True,
+            "first_name": "TellerBot",
+            "username": "TellerBot",
+        }
+        self._message_ids = itertools.count(1)
+        self._updates: "asyncio.Queue[typing.Dict[str, typing.Any]]" = asyncio.Queue()
+        self._methods: typing.Dict[
+            str, typing.Callable[[typing.Dict[str, typing.Any]], typing.Any]
+        ] = {
+            "getme": lambda data: self.bot_user,
+            "getupdates": self._get_updates,
+            "setwebhook": self._set_webhook,
+            "deletewebhook": self._delete_webhook,
+            "getwebhookinfo": self._get_webhook_info,
+            "getchat": lambda data: self._chat(data["chat_id"]),
+            "sendmessage": self._send_message,
+            "sendlocation": self._send_message,
+            "sendphoto": self._send_message,
+            "senddocument": self._send_message,
+            "forwardmessage": self._send_message,
+            "editmessagetext": self._edit_message,
+            "editmessagereplymarkup": self._edit_message,
+            "editmessagecaption": self._edit_message,
+        }
+
+    def put_update(self, update: typing.Dict[str, typing.Any]) -> None:
+        """Queue ``update`` to be returned by ``getUpdates``."""
+        self._updates.put_nowait(update)
+
+    def reset(self) -> None:
+        """Forget counted requests."""
+        self.method_counts.clear()
+        self.history.clear()
+
+    def buttons(
+        self, chat_id: int, prefix: str = ""
+    ) -> typing.Tuple[typing.Optional[typing.Dict[str, typing.Any]], typing.List[str]]:
+        """Find buttons with callback data starting with ``prefix``.
+
+        :return: The last message in chat with ``chat_id`` having such
+            buttons and list of their callback data.
+        """
+        for message in reversed(self.chat_messages.get(chat_id, ())):
+            markup = message.get("reply_markup") or {}
+            data = [
+                button["callback_data"]
+                for row in markup.get("inline_keyboard", [])
+                for button in row
+                if button.get("callback_data", "").startswith(prefix)
+            ]
+            if data:
+                return message, data
+        return None, []
+
+    @staticmethod
+    def _chat(chat_id: typing.Union[int, str]) -> typing.Dict[str, typing.Any]:
+        if isinstance(chat_id, int):
+            return {"id": chat_id, "type": "private" if chat_id > 0 else "group"}
+        return {"id": -1, "type": "channel", "username": chat_id.lstrip("@")}
+
+    def _message(
+        self, data: typing.Dict[str, typing.Any], message_id: int
+    ) -> typing.Dict[str, typing.Any]:
+        message: typing.Dict[str, typing.Any] = {
+            "message_id": message_id,
+            "from": self.bot_user,
+            "chat": self._chat(data["chat_id"]),
+            "date": int(time()),
+        }
+        for field in ("text", "reply_markup"):
+            if field in data:
+                message[field] = data[field]
+        if "latitude" in data:
+            message["location"] = {
+                "latitude": float(data["latitude"]),
+                "longitude": float(data["longitude"]),
+            }
+        return message
+
+    def _send_message(self, data: typing.Dict[str, typing.Any]) -> Result:
+        message = self._message(data, next(self._message_ids))
+        self.chat_messages[data["chat_id"]].append(message)
+        return message
+
+    def _edit_message(self, data: typing.Dict[str, typing.Any]) -> Result:
+        if "inline_message_id" in data:
+            return True
+        message = self._message(data, data["message_id"])
+        messages = self.chat_messages[data["chat_id"]]
+        for index, sent in enumerate(messages):
+            if sent["message_id"] == message["message_id"]:
+                if "text" not in message and "text" in sent:
+                    message["text"] = sent["text"]
+                messages[index] = message
+                break
+        return message
+
+    async def _get_updates(self, data: typing.Dict[str, typing.Any]) -> Result:
+        updates = []
+        try:
+            update = await asyncio.wait_for(
+                self._updates.get(), min(data.get("timeout", 0), 1) or 0.01
+            )
+        except asyncio.TimeoutError:
+            return updates
+        updates.append(update)
+        limit = data.get("limit", 100)
+        while len(updates) < limit and not self._updates.empty():
+            updates.append(self._updates.get_nowait())
+        return updates
+
+    def _set_webhook(self, data: typing.Dict[str, typing.Any]) -> Result:
+        self.webhook_url = data.get("url", "")
+        return True
+
+    def _delete_webhook(self, data: typing.Dict[str, typing.Any]) -> Result:
+        self.webhook_url = ""
+        return True
+
+    def _get_webhook_info(self, data: typing.Dict[str, typing.Any]) -> Result:
+        return {
+            "url": self.webhook_url,
+            "has_custom_certificate": False,
+            "pending_update_count": self._updates.qsize(),
+        }
+
+    async def handle(self, request: web.Request) -> web.Response:
+        """Answer request to API method."""
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            data = await request.json()
+        else:
+            form = await request.post()
+            data = {
+                name: _parse_field(name, value)
+                for name, value in form.items()
+                if isinstance(value, str)
+            }
+        self.method_counts[method] += 1
+        self.history.append((method, data))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        # Methods which aren't emulated succeed without result object
+        handler = self._methods.get(method.lower(), lambda data: True)
+        try:
+            result = handler(data)
+            if asyncio.iscoroutine(result):
+                result = await result
+        except (KeyError, ValueError) as error:
+            return web.json_response(
+                {
+                    "ok": False,
+                    "error_code": 400,
+                    "description": f"Bad Request: {error}",
+                },
+                status=400,
+            )
+        return web.json_response({"ok": True, "result": result})
+
+    def app(self) -> web.Application:
+        """Create web application serving API methods."""
+        application = web.Application()
+        application.router.add_route("*", "/bot{token}/{method}", self.handle)
+        return application
+
+
+def main():
+    """Run fake Telegram Bot API server."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="delay of responses in seconds"
+    )
+    args = parser.parse_args()
+    server = FakeTelegramServer(args.latency)
+    web.run_app(server.app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
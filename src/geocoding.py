@@ -0,0 +1,248 @@
+# Copyright (C) 2019  alfred richardsn
+#
+# This file is part of TellerBot.
+#
+# TellerBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with TellerBot.  If not, see <https://www.gnu.org/licenses/>.
+"""Asynchronous geocoding of location names."""
+import asyncio
+import typing
+import unicodedata
+from abc import ABC
+from abc import abstractmethod
+from datetime import datetime
+from datetime import timedelta
+from time import monotonic
+
+import aiohttp
+from pymongo.errors import DuplicateKeyError
+
+from src.cache import TTLCache
+from src.config import config
+from src.database import database
+from src.indexes import index_registry
+
+Location = typing.Dict[str, str]
+
+index_registry.add("locations", "key", query={"key": ""}, unique=True, sparse=True)
+index_registry.add("locations", "date", expireAfterSeconds=config.GEOCODE_CACHE_TTL)
+
+
+def cache_key(query: str, language: str) -> str:
+    """Get cache key of ``query`` ignoring case and whitespace differences."""
+    normalized = " ".join(unicodedata.normalize("NFKC", query).casefold().split())
+    return f"{language}:{normalized}"
+
+
+class GeocodeCache:
+    """Two-tier cache of geocoding results.
+
+    Results are looked up in memory first and in ``locations`` collection
+    then. Database entries are removed by TTL index on ``date``. Empty
+    results are cached too, but expire after
+    ``config.GEOCODE_NEGATIVE_CACHE_TTL`` seconds.
+    """
+
+    def __init__(self):
+        """Create empty cache."""
+        self._memory: TTLCache[str, typing.List[Location]] = TTLCache(
+            config.GEOCODE_CACHE_SIZE, config.GEOCODE_CACHE_TTL
+        )
+        #: Number of lookups found in memory.
+        self.memory_hits = 0
+        #: Number of lookups found in database.
+        self.database_hits = 0
+        #: Number of lookups not found in cache.
+        self.misses = 0
+        #: Total time of lookups in seconds.
+        self.lookup_time = 0.0
+
+    @property
+    def hit_rate(self) -> float:
+        """Get fraction of lookups found in cache."""
+        lookups = self.memory_hits + self.database_hits + self.misses
+        if not lookups:
+            return 0.0
+        return (self.memory_hits + self.database_hits) / lookups
+
+    @property
+    def average_lookup_time(self) -> float:
+        """Get average time of lookup in seconds."""
+        lookups = self.memory_hits + self.database_hits + self.misses
+        return self.lookup_time / lookups if lookups else 0.0
+
+    async def get(self, key: str) -> typing.Optional[typing.List[Location]]:
+        """Get cached results of ``key`` or None if they aren't cached."""
+        started = monotonic()
+        try:
+            results = self._memory.get(key)
+            if results is not None:
+                self.memory_hits += 1
+                return results
+            document = await database.locations.find_one({"key": key})
+            if document is not None:
+                negative_ttl = timedelta(seconds=config.GEOCODE_NEGATIVE_CACHE_TTL)
+                age = datetime.utcnow() - document["date"]
+                if document["results"] or age < negative_ttl:
+                    self.database_hits += 1
+                    self._set_memory(key, document["results"])
+                    return document["results"]
+            self.misses += 1
+            return None
+        finally:
+            self.lookup_time += monotonic() - started
+
+    def _set_memory(self, key: str, results: typing.List[Location]) -> None:
+        ttl = None if results else config.GEOCODE_NEGATIVE_CACHE_TTL
+        self._memory.set(key, results, ttl)
+
+    async def set(
+        self, key: str, query: str, language: str, results: typing.List[Location]
+    ) -> None:
+        """Cache ``results`` of ``query`` in ``language`` by ``key``."""
+        self._set_memory(key, results)
+        try:
+            await database.locations.replace_one(
+                {"key": key},
+                {
+                    "key": key,
+                    "q": query,
+                    "lang": language,
+                    "results": results,
+                    "date": datetime.utcnow(),
+                },
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            # Concurrent process has cached the same query
+            pass
+
+
+class GeocodingError(Exception):
+    """Geocoding service is unavailable."""
+
+
+class GeocodingBackend(ABC):
+    """Abstract geocoding service."""
+
+    @abstractmethod
+    async def search(
+        self, session: aiohttp.ClientSession, query: str, language: str
+    ) -> typing.List[Location]:
+        """Find locations by ``query`` with names in ``language``.
+
+        Every location is a dictionary with ``display_name``, ``lat``
+        and ``lon`` keys.
+        """
+
+
+class NominatimBackend(GeocodingBackend):
+    """Geocoding with Nominatim search API.
+
+    :param url: URL of search endpoint.
+    """
+
+    def __init__(self, url: str):
+        """Set search endpoint."""
+        self.url = url
+
+    async def search(
+        self, session: aiohttp.ClientSession, query: str, language: str
+    ) -> typing.List[Location]:
+        params = {"q": query, "format": "json", "accept-language": language}
+        async with session.get(self.url, params=params) as response:
+            results = await response.json()
+        return [
+            {
+                "display_name": result["display_name"],
+                "lat": result["lat"],
+                "lon": result["lon"],
+            }
+            for result in results[: config.GEOCODER_RESULTS_LIMIT]
+        ]
+
+
+class Geocoder:
+    """Geocoding client sharing connection pool between requests.
+
+    Results are cached in ``cache``. Failed requests are retried
+    ``config.GEOCODER_RETRIES`` times with exponential backoff.
+    Concurrent requests with the same query and language wait for the
+    result of the first one.
+
+    :param backend: Geocoding service.
+    """
+
+    def __init__(self, backend: GeocodingBackend):
+        """Create client without opening connections."""
+        self.backend = backend
+        self.cache = GeocodeCache()
+        self._session: typing.Optional[aiohttp.ClientSession] = None
+        self._in_flight: typing.Dict[str, "asyncio.Task[typing.List[Location]]"] = {}
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """Get shared session creating it on first use."""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                headers={"User-Agent": "TellerBot"},
+                raise_for_status=True,
+                timeout=aiohttp.ClientTimeout(total=config.GEOCODER_TIMEOUT),
+                connector=aiohttp.TCPConnector(limit=config.GEOCODER_CONNECTIONS),
+            )
+        return self._session
+
+    async def _request(self, query: str, language: str) -> typing.List[Location]:
+        for attempt in range(config.GEOCODER_RETRIES + 1):
+            try:
+                return await self.backend.search(self.session, query, language)
+            except aiohttp.ClientResponseError as error:
+                if error.status < 500 and error.status != 429:
+                    raise GeocodingError(error) from error
+                last_error: Exception = error
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                last_error = error
+            if attempt < config.GEOCODER_RETRIES:
+                await asyncio.sleep(2 ** attempt)
+        raise GeocodingError(last_error) from last_error
+
+    async def _search(
+        self, key: str, query: str, language: str
+    ) -> typing.List[Location]:
+        results = await self.cache.get(key)
+        if results is None:
+            results = await self._request(query, language)
+            await self.cache.set(key, query, language, results)
+        return results
+
+    async def search(self, query: str, language: str) -> typing.List[Location]:
+        """Find locations by ``query`` with names in ``language``.
+
+        :raises GeocodingError: If service is unavailable.
+        """
+        key = cache_key(query, language)
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._search(key, query, language))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda task: self._in_flight.pop(key, None))
+        # Cancellation of one waiter must not cancel request of others
+        return await asyncio.shield(task)
+
+    async def close(self) -> None:
+        """Close connections of shared session."""
+        if self._session is not None:
+            await self._session.close()
+
+
+geocoder = Geocoder(NominatimBackend(config.GEOCODER_URL))
@@ -15,16 +15,19 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with TellerBot.  If not, see <https://www.gnu.org/licenses/>.
 import math
+import secrets
 import typing
 from datetime import datetime
 from decimal import Decimal
+from time import monotonic
 from time import time
 
+import pymongo
 from aiogram import types
 from aiogram.utils import markdown
 from aiogram.utils.emoji import emojize
-from pymongo.cursor import Cursor
 
+from src.cache import TTLCache
 from src.config import config
 from src.escrow import get_escrow_instance
 
@@ -35,13 +38,25 @@ from src.bot import (  # noqa: F401, noreorder
     state_handlers,
 )
 from src.bot import tg
-from src.database import database, database_user
+from src.database import database, database_user, profile_cache, user_cache
 from src.i18n import i18n
 from src.money import normalize
 
 
-def start_keyboard() -> types.ReplyKeyboardMarkup:
-    """Create reply keyboard with main menu."""
+#: Fields of order listed in edit mode.
+ORDER_FIELDS = (
+    "sum_buy",
+    "sum_sell",
+    "price",
+    "payment_system",
+    "duration",
+    "comments",
+)
+
+
+@i18n.cache
+def start_keyboard() -> str:
+    """Create serialized reply keyboard with main menu."""
     keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
     keyboard.add(
         types.KeyboardButton(emojize(":heavy_plus_sign: ") + i18n("create_order")),
@@ -52,17 +67,16 @@ def start_keyboard() -> types.ReplyKeyboardMarkup:
         types.KeyboardButton(emojize(":abcd: ") + i18n("language")),
         types.KeyboardButton(emojize(":question: ") + i18n("support")),
     )
-    return keyboard
+    return keyboard.as_json()
 
 
-async def inline_control_buttons(
-    back: bool = True, skip: bool = True, cancel: bool = True
-) -> typing.List[types.InlineKeyboardButton]:
-    """Create inline button row with translated labels to control current state."""
+@i18n.cache
+def _control_buttons(
+    state_name: typing.Optional[str], back: bool, skip: bool, cancel: bool
+) -> typing.Tuple[typing.Tuple[types.InlineKeyboardButton, ...], ...]:
     buttons = []
     if back or skip:
         row = []
-        state_name = await dp.current_state().get_state()
         if back:
             row.append(
                 types.InlineKeyboardButton(
@@ -75,60 +89,206 @@ async def inline_control_buttons(
                     i18n("skip"), callback_data=f"state {state_name} skip"
                 )
             )
-        buttons.append(row)
+        buttons.append(tuple(row))
     if cancel:
         buttons.append(
-            [types.InlineKeyboardButton(i18n("cancel"), callback_data="cancel")]
+            (types.InlineKeyboardButton(i18n("cancel"), callback_data="cancel"),)
         )
-    return buttons
+    return tuple(buttons)
+
+
+async def inline_control_buttons(
+    back: bool = True, skip: bool = True, cancel: bool = True
+) -> typing.List[typing.List[types.InlineKeyboardButton]]:
+    """Create inline button row with translated labels to control current state."""
+    state_name = await dp.current_state().get_state() if back or skip else None
+    return [list(row) for row in _control_buttons(state_name, back, skip, cancel)]
+
+
+class OrderBook:
+    """Orders matching query browsed page by page.
+
+    Order book is kept in ``order_books`` during browsing session and
+    referenced in callback data by ``token``. Sort keys of page
+    boundaries are remembered, so visited pages and the pages next to
+    them are queried with keyset pagination.
+
+    :param query: MongoDB query to orders.
+    :param by_price: Sort orders by price instead of creation time.
+    :param unexpired: Include only orders which haven't expired by the
+        time of query.
+    """
+
+    def __init__(
+        self,
+        query: typing.Mapping[str, typing.Any],
+        by_price: bool = False,
+        unexpired: bool = False,
+    ):
+        """Create order book and save it in ``order_books``."""
+        self._query = query
+        self.by_price = by_price
+        self.unexpired = unexpired
+        self.token = secrets.token_urlsafe(6)
+        self._quantity: typing.Optional[int] = None
+        self._counted = 0.0
+        self._boundaries: typing.Dict[int, typing.Tuple[typing.Any, ...]] = {}
+        order_books.set(self.token, self)
+
+    @property
+    def query(self) -> typing.Mapping[str, typing.Any]:
+        """Get MongoDB query to orders at current time."""
+        if not self.unexpired:
+            return self._query
+        return {"$and": [self._query, {"expiration_time": {"$gt": time()}}]}
+
+    async def count(self, start: int = 0) -> int:
+        """Get quantity of orders for page beginning from index ``start``.
+
+        Quantity is counted again only if it was counted more than
+        ``config.ORDER_BOOK_COUNT_TTL`` seconds ago or if ``start`` is
+        past it, so that turning pages doesn't require counting orders.
+        """
+        if (
+            self._quantity is None
+            or start >= self._quantity
+            or monotonic() - self._counted >= config.ORDER_BOOK_COUNT_TTL
+        ):
+            self._quantity = await database.orders.count_documents(self.query)
+            self._counted = monotonic()
+        return self._quantity
+
+    def _sort_key(self, order: typing.Mapping[str, typing.Any]):
+        if self.by_price:
+            return (order["price_buy"], order["start_time"], order["_id"])
+        return (order["start_time"], order["_id"])
+
+    def _after(
+        self, key: typing.Tuple[typing.Any, ...]
+    ) -> typing.Dict[str, typing.Any]:
+        if self.by_price:
+            price, start_time, _id = key
+            conditions: typing.List[typing.Dict[str, typing.Any]] = [
+                {"price_buy": price, "start_time": {"$lt": start_time}},
+                {"price_buy": price, "start_time": start_time, "_id": {"$lt": _id}},
+            ]
+            # Orders without price have empty string instead of it and
+            # strings are sorted after numbers
+            if price != "":
+                conditions.insert(0, {"price_buy": {"$gt": price}})
+                conditions.append({"price_buy": ""})
+            return {"$or": conditions}
+        start_time, _id = key
+        return {
+            "$or": [
+                {"start_time": {"$lt": start_time}},
+                {"start_time": start_time, "_id": {"$lt": _id}},
+            ]
+        }
+
+    async def page(self, start: int) -> typing.List[typing.Mapping[str, typing.Any]]:
+        """Get ``config.ORDERS_COUNT`` orders beginning from index ``start``."""
+        key = self._boundaries.get(start)
+        skip = start if key is None else 0
+        if self.by_price:
+            pipeline: typing.List[typing.Dict[str, typing.Any]] = [
+                {"$match": self.query},
+                {"$addFields": {"price_buy": {"$ifNull": ["$price_buy", ""]}}},
+            ]
+            if key is not None:
+                pipeline.append({"$match": self._after(key)})
+            pipeline.append(
+                {
+                    "$sort": {
+                        "price_buy": pymongo.ASCENDING,
+                        "start_time": pymongo.DESCENDING,
+                        "_id": pymongo.DESCENDING,
+                    }
+                }
+            )
+            if skip:
+                pipeline.append({"$skip": skip})
+            pipeline.append({"$limit": config.ORDERS_COUNT})
+            cursor = database.orders.aggregate(pipeline)
+        else:
+            query = self.query
+            if key is not None:
+                query = {"$and": [query, self._after(key)]}
+            cursor = (
+                database.orders.find(query)
+                .sort([("start_time", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)])
+                .skip(skip)
+                .limit(config.ORDERS_COUNT)
+            )
+        orders = await cursor.to_list(length=config.ORDERS_COUNT)
+        if len(orders) == config.ORDERS_COUNT:
+            self._boundaries[start + config.ORDERS_COUNT] = self._sort_key(orders[-1])
+        return orders
+
+
+#: Order books of current browsing sessions.
+order_books: TTLCache[str, OrderBook] = TTLCache(
+    config.ORDER_BOOK_CACHE_SIZE, config.ORDER_BOOK_TTL
+)
 
 
 async def orders_list(
-    cursor: Cursor,
+    book: OrderBook,
     chat_id: int,
     start: int,
-    quantity: int,
     buttons_data: str,
     user_id: typing.Optional[int] = None,
     message_id: typing.Optional[int] = None,
     invert: typing.Optional[bool] = None,
+    quantity: typing.Optional[int] = None,
 ) -> None:
     """Send list of orders.
 
-    :param cursor: Cursor of MongoDB query to orders.
+    :param book: Order book.
     :param chat_id: Telegram ID of current chat.
     :param start: Start index.
-    :param quantity: Quantity of orders in cursor.
     :param buttons_data: Beginning of callback data of left/right buttons.
-    :param user_id: Telegram ID of current user if cursor is not user-specific.
+    :param user_id: Telegram ID of current user if order book is not
+        user-specific.
     :param message_id: Telegram ID of message to edit.
     :param invert: Invert all prices.
+    :param quantity: Quantity of orders in order book if it's already
+        counted.
     """
     user = database_user.get()
     if invert is None:
         invert = user.get("invert_book", False)
     else:
-        await database.users.update_one(
-            {"_id": user["_id"]}, {"$set": {"invert_book": invert}}
-        )
+        update = {"$set": {"invert_book": invert}}
+        await database.users.update_one({"_id": user["_id"]}, update)
+        user_cache.patch(user["id"], update)
 
     keyboard = types.InlineKeyboardMarkup(row_width=min(config.ORDERS_COUNT // 2, 8))
 
     inline_orders_buttons = (
         types.InlineKeyboardButton(
             emojize(":arrow_left:"),
-            callback_data="{} {} {}".format(
-                buttons_data, start - config.ORDERS_COUNT, 1 if invert else 0
+            callback_data="{} {} {} {}".format(
+                buttons_data,
+                start - config.ORDERS_COUNT,
+                1 if invert else 0,
+                book.token,
             ),
         ),
         types.InlineKeyboardButton(
             emojize(":arrow_right:"),
-            callback_data="{} {} {}".format(
-                buttons_data, start + config.ORDERS_COUNT, 1 if invert else 0
+            callback_data="{} {} {} {}".format(
+                buttons_data,
+                start + config.ORDERS_COUNT,
+                1 if invert else 0,
+                book.token,
             ),
         ),
     )
 
+    if quantity is None:
+        quantity = await book.count(start)
+
     if quantity == 0:
         keyboard.row(*inline_orders_buttons)
         text = i18n("no_orders")
@@ -138,8 +298,7 @@ async def orders_list(
             await tg.edit_message_text(text, chat_id, message_id, reply_markup=keyboard)
         return
 
-    all_orders = await cursor.to_list(length=start + config.ORDERS_COUNT)
-    orders = all_orders[start:]
+    orders = await book.page(start)
 
     lines = []
     buttons = []
@@ -190,7 +349,9 @@ async def orders_list(
     keyboard.row(
         types.InlineKeyboardButton(
             i18n("invert"),
-            callback_data="{} {} {}".format(buttons_data, start, int(not invert)),
+            callback_data="{} {} {} {}".format(
+                buttons_data, start, int(not invert), book.token
+            ),
         )
     )
     keyboard.add(*buttons)
@@ -225,73 +386,23 @@ async def orders_list(
         )
 
 
-async def show_order(
+def order_text(
     order: typing.Mapping[str, typing.Any],
-    chat_id: int,
-    user_id: int,
-    message_id: typing.Optional[int] = None,
-    location_message_id: typing.Optional[int] = None,
-    show_id: bool = False,
-    invert: typing.Optional[bool] = None,
-    edit: bool = False,
-    locale: typing.Optional[str] = None,
-):
-    """Send detailed order.
+    creator: typing.Mapping[str, typing.Any],
+    show_id: bool,
+    invert: bool,
+    edit: bool,
+    locale: str,
+) -> str:
+    """Get text of detailed order.
 
     :param order: Order document.
-    :param chat_id: Telegram ID of chat to send message to.
-    :param user_id: Telegram user ID of message receiver.
-    :param message_id: Telegram ID of message to edit.
-    :param location_message_id: Telegram ID of message with location object.
-        It is deleted when **Hide** inline button is pressed.
+    :param creator: User document of order's creator.
     :param show_id: Add ID of order to the top.
     :param invert: Invert price.
-    :param edit: Enter edit mode.
+    :param edit: Show numbered list of fields for edit mode.
     :param locale: Locale of message receiver.
     """
-    if locale is None:
-        locale = i18n.ctx_locale.get()
-
-    new_edit_msg = None
-    if invert is None:
-        try:
-            user = database_user.get()
-        except LookupError:
-            user = await database.users.find_one({"id": user_id})
-        invert = user.get("invert_order", False)
-    else:
-        user = await database.users.find_one_and_update(
-            {"id": user_id}, {"$set": {"invert_order": invert}}
-        )
-        if "edit" in user:
-            if edit:
-                if user["edit"]["field"] == "price":
-                    new_edit_msg = i18n(
-                        "new_price {of_currency} {per_currency}", locale=locale
-                    )
-                    if invert:
-                        new_edit_msg = new_edit_msg.format(
-                            of_currency=order["buy"], per_currency=order["sell"]
-                        )
-                    else:
-                        new_edit_msg = new_edit_msg.format(
-                            of_currency=order["sell"], per_currency=order["buy"]
-                        )
-            elif user["edit"]["order_message_id"] == message_id:
-                await tg.delete_message(user["chat"], user["edit"]["message_id"])
-                await database.users.update_one(
-                    {"_id": user["_id"]}, {"$unset": {"edit": True, "state": True}}
-                )
-
-    if location_message_id is None:
-        if order.get("lat") is not None and order.get("lon") is not None:
-            location_message = await tg.send_location(
-                chat_id, order["lat"], order["lon"]
-            )
-            location_message_id = location_message.message_id
-        else:
-            location_message_id = -1
-
     header = ""
     if show_id:
         header += "ID: {}\n".format(markdown.code(order["_id"]))
@@ -299,7 +410,6 @@ async def show_order(
     if order.get("archived"):
         header += markdown.bold(i18n("archived", locale=locale)) + "\n"
 
-    creator = await database.users.find_one({"id": order["user_id"]})
     header += "{} ({}) ".format(
         markdown.link(creator["mention"], types.User(id=creator["id"]).url),
         markdown.code(creator["id"]),
@@ -346,6 +456,37 @@ async def show_order(
     if "comments" in order:
         lines_format["comments"] = "«{}»".format(order["comments"])
 
+    if edit:
+        for i, (field, value) in enumerate(lines_format.items()):
+            if value is not None:
+                lines.append(f"{i + 1}. {field_names[field]} {value}")
+            else:
+                lines.append(f"{i + 1}. {field_names[field]} -")
+    else:
+        for field, value in lines_format.items():
+            if value is not None:
+                lines.append(field_names[field] + " " + value)
+
+    return "\n".join(lines)
+
+
+def order_keyboard(
+    order: typing.Mapping[str, typing.Any],
+    location_message_id: int,
+    invert: bool,
+    edit: bool,
+    is_creator: bool,
+    locale: str,
+) -> types.InlineKeyboardMarkup:
+    """Get inline keyboard of detailed order.
+
+    :param order: Order document.
+    :param location_message_id: Telegram ID of message with location object.
+    :param invert: Invert price.
+    :param edit: Edit mode is entered.
+    :param is_creator: Message receiver is order's creator.
+    :param locale: Locale of message receiver.
+    """
     keyboard = types.InlineKeyboardMarkup(row_width=6)
 
     keyboard.row(
@@ -360,13 +501,9 @@ async def show_order(
         )
     )
 
-    if edit and creator["id"] == user_id:
+    if edit and is_creator:
         buttons = []
-        for i, (field, value) in enumerate(lines_format.items()):
-            if value is not None:
-                lines.append(f"{i + 1}. {field_names[field]} {value}")
-            else:
-                lines.append(f"{i + 1}. {field_names[field]} -")
+        for i, field in enumerate(ORDER_FIELDS):
             buttons.append(
                 types.InlineKeyboardButton(
                     f"{i + 1}",
@@ -387,10 +524,6 @@ async def show_order(
         )
 
     else:
-        for field, value in lines_format.items():
-            if value is not None:
-                lines.append(field_names[field] + " " + value)
-
         keyboard.row(
             types.InlineKeyboardButton(
                 i18n("similar", locale=locale),
@@ -402,7 +535,7 @@ async def show_order(
             ),
         )
 
-        if creator["id"] == user_id:
+        if is_creator:
             keyboard.row(
                 types.InlineKeyboardButton(
                     i18n("edit", locale=locale),
@@ -454,14 +587,154 @@ async def show_order(
             )
         )
 
-    answer = "\n".join(lines)
+    return keyboard
+
+
+class RenderedOrder(typing.NamedTuple):
+    """Text and serialized inline keyboard of detailed order."""
+
+    text: str
+    markup: str
+
+
+#: Rendered variants of detailed orders grouped by order ID.
+order_renders: TTLCache[
+    typing.Any, typing.Dict[typing.Tuple, RenderedOrder]
+] = TTLCache(config.ORDER_RENDER_CACHE_SIZE, config.ORDER_RENDER_CACHE_TTL)
+
+
+def invalidate_order_render(order_id: typing.Any) -> None:
+    """Remove rendered variants of order with ID ``order_id``."""
+    order_renders.pop(order_id)
+
+
+async def render_order(
+    order: typing.Mapping[str, typing.Any],
+    user_id: int,
+    location_message_id: int,
+    show_id: bool,
+    invert: bool,
+    edit: bool,
+    locale: str,
+) -> RenderedOrder:
+    """Get rendered detailed order from cache or render it.
+
+    Parameters are the same as of ``show_order``. Variants are
+    distinguished by ``version`` field of order and mention of its
+    creator, so that orders and profiles changed by other processes are
+    rendered again. Keyboards with location message ID are unique to
+    message and aren't cached.
+    """
+    is_creator = order["user_id"] == user_id
+    creator = await profile_cache.get(order["user_id"])
+    key = (
+        order.get("version", 0),
+        creator["mention"],
+        locale,
+        invert,
+        is_creator,
+        edit,
+        show_id,
+    )
+    variants = order_renders.get(order["_id"])
+    if variants is None:
+        variants = {}
+        order_renders.set(order["_id"], variants)
+    rendered = variants.get(key)
+    if rendered is None:
+        rendered = RenderedOrder(
+            order_text(order, creator, show_id, invert, edit and is_creator, locale),
+            order_keyboard(order, -1, invert, edit, is_creator, locale).as_json(),
+        )
+        if len(variants) >= config.ORDER_RENDER_VARIANTS:
+            variants.clear()
+        variants[key] = rendered
+    if location_message_id != -1:
+        rendered = rendered._replace(
+            markup=order_keyboard(
+                order, location_message_id, invert, edit, is_creator, locale
+            ).as_json()
+        )
+    return rendered
+
+
+async def show_order(
+    order: typing.Mapping[str, typing.Any],
+    chat_id: int,
+    user_id: int,
+    message_id: typing.Optional[int] = None,
+    location_message_id: typing.Optional[int] = None,
+    show_id: bool = False,
+    invert: typing.Optional[bool] = None,
+    edit: bool = False,
+    locale: typing.Optional[str] = None,
+):
+    """Send detailed order.
+
+    :param order: Order document.
+    :param chat_id: Telegram ID of chat to send message to.
+    :param user_id: Telegram user ID of message receiver.
+    :param message_id: Telegram ID of message to edit.
+    :param location_message_id: Telegram ID of message with location object.
+        It is deleted when **Hide** inline button is pressed.
+    :param show_id: Add ID of order to the top.
+    :param invert: Invert price.
+    :param edit: Enter edit mode.
+    :param locale: Locale of message receiver.
+    """
+    if locale is None:
+        locale = i18n.ctx_locale.get()
+
+    new_edit_msg = None
+    if invert is None:
+        try:
+            user = database_user.get()
+        except LookupError:
+            user = await database.users.find_one({"id": user_id})
+        invert = user.get("invert_order", False)
+    else:
+        update = {"$set": {"invert_order": invert}}
+        user = await database.users.find_one_and_update({"id": user_id}, update)
+        user_cache.patch(user_id, update)
+        if "edit" in user:
+            if edit:
+                if user["edit"]["field"] == "price":
+                    new_edit_msg = i18n(
+                        "new_price {of_currency} {per_currency}", locale=locale
+                    )
+                    if invert:
+                        new_edit_msg = new_edit_msg.format(
+                            of_currency=order["buy"], per_currency=order["sell"]
+                        )
+                    else:
+                        new_edit_msg = new_edit_msg.format(
+                            of_currency=order["sell"], per_currency=order["buy"]
+                        )
+            elif user["edit"]["order_message_id"] == message_id:
+                await tg.delete_message(user["chat"], user["edit"]["message_id"])
+                update = {"$unset": {"edit": True, "state": True}}
+                await database.users.update_one({"_id": user["_id"]}, update)
+                user_cache.patch(user["id"], update)
+
+    if location_message_id is None:
+        if order.get("lat") is not None and order.get("lon") is not None:
+            location_message = await tg.send_location(
+                chat_id, order["lat"], order["lon"]
+            )
+            location_message_id = location_message.message_id
+        else:
+            location_message_id = -1
+
+    rendered = await render_order(
+        order, user_id, location_message_id, show_id, invert, edit, locale
+    )
 
     if message_id is not None:
         await tg.edit_message_text(
-            answer,
+            rendered.text,
             chat_id,
             message_id,
-            reply_markup=keyboard,
+            reply_markup=rendered.markup,
             parse_mode=types.ParseMode.MARKDOWN,
             disable_web_page_preview=True,
         )
@@ -481,8 +754,8 @@ async def show_order(
     else:
         await tg.send_message(
             chat_id,
-            answer,
-            reply_markup=keyboard,
+            rendered.text,
+            reply_markup=rendered.markup,
             parse_mode=types.ParseMode.MARKDOWN,
             disable_web_page_preview=True,
         )
@@ -35,6 +35,18 @@ from src.escrow.blockchain import TransferError
 from src.handlers.base import private_handler
 from src.handlers.base import start_keyboard
 from src.i18n import i18n
+from src.indexes import index_registry
+
+index_registry.add(
+    "cashback",
+    [
+        ("id", pymongo.ASCENDING),
+        ("currency", pymongo.ASCENDING),
+        ("time", pymongo.DESCENDING),
+    ],
+    query={"id": 0, "currency": "", "address": {"$ne": None}},
+    sort=[("time", pymongo.DESCENDING)],
+)
 
 
 @dp.callback_query_handler(
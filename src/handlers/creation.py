@@ -22,15 +22,14 @@ corresponding step using back/skip inline buttons. Handlers decorated
 with ``private_handler`` are called when user sends value.
 """
 import asyncio
+import logging
 import re
-from datetime import datetime
 from decimal import Decimal
 from time import time
 from typing import Any
 from typing import Mapping
 from typing import MutableMapping
 
-import requests
 from aiogram import types
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import any_state
@@ -46,6 +45,8 @@ from src.bot import dp
 from src.bot import tg
 from src.config import config
 from src.database import database
+from src.geocoding import geocoder
+from src.geocoding import GeocodingError
 from src.handlers.base import inline_control_buttons
 from src.handlers.base import private_handler
 from src.handlers.base import show_order
@@ -53,12 +54,19 @@ from src.handlers.base import start_keyboard
 from src.handlers.base import state_handler
 from src.handlers.base import state_handlers
 from src.i18n import i18n
+from src.indexes import index_registry
+from src.money import currency_fields
 from src.money import money
 from src.money import MoneyValueError
 from src.money import normalize
+from src.notifications import expiration_scheduler
 from src.notifications import order_notification
 from src.states import OrderCreation
 
+log = logging.getLogger(__name__)
+
+index_registry.add("creation", "user_id", query={"user_id": 0}, unique=True)
+
 
 CURRENCY_REGEXP = re.compile(r"^(?:([A-Z]+)\.)?([A-Z]+)$")
 
@@ -704,37 +712,12 @@ async def text_location(message: types.Message, state: FSMContext):
     """
     query = message.text
 
-    language = i18n.ctx_locale.get()
-    location_cache = await database.locations.find_one({"q": query, "lang": language})
-
-    if location_cache:
-        results = location_cache["results"]
-    else:
-        params = {"q": query, "format": "json", "accept-language": language}
-        request = requests.get(
-            "https://nominatim.openstreetmap.org/search",
-            params=params,
-            headers={"User-Agent": "TellerBot"},
-        )
-
-        results = [
-            {
-                "display_name": result["display_name"],
-                "lat": result["lat"],
-                "lon": result["lon"],
-            }
-            for result in request.json()[:10]
-        ]
-
-        # Cache results to reduce dublicate requests
-        await database.locations.insert_one(
-            {
-                "q": query,
-                "lang": language,
-                "results": results,
-                "date": datetime.utcnow(),
-            }
-        )
+    try:
+        results = await geocoder.search(query, i18n.ctx_locale.get())
+    except GeocodingError as error:
+        log.warning("Failed to geocode %r: %s", query, error)
+        await tg.send_message(message.chat.id, i18n("location_not_found"))
+        return
 
     if not results:
         await tg.send_message(message.chat.id, i18n("location_not_found"))
@@ -860,6 +843,7 @@ async def set_order(order: MutableMapping[str, Any], chat_id: int):
         order["duration"] = config.ORDER_DURATION_LIMIT
     order["expiration_time"] = time() + order["duration"] * 24 * 60 * 60
     order["notify"] = True
+    order.update(currency_fields(order))
     if "price_sell" not in order and "sum_buy" in order and "sum_sell" in order:
         order["price_sell"] = Decimal128(
             normalize(order["sum_sell"].to_decimal() / order["sum_buy"].to_decimal())
@@ -870,6 +854,7 @@ async def set_order(order: MutableMapping[str, Any], chat_id: int):
 
     inserted_order = await database.orders.insert_one(order)
     order["_id"] = inserted_order.inserted_id
+    expiration_scheduler.schedule(order)
     await tg.send_message(chat_id, i18n("order_set"), reply_markup=start_keyboard())
     await show_order(order, chat_id, order["user_id"], show_id=True)
     asyncio.create_task(order_notification(order))
@@ -46,10 +46,15 @@ from src.escrow.escrow_offer import EscrowOffer
 from src.handlers.base import private_handler
 from src.handlers.base import start_keyboard
 from src.i18n import i18n
+from src.indexes import index_registry
 from src.money import money
 from src.money import MoneyValueError
 from src.money import normalize
 
+index_registry.add(
+    "escrow", "pending_input_from", query={"pending_input_from": 0}, sparse=True
+)
+
 
 async def get_card_number(
     text: str, chat_id: int
@@ -28,7 +28,6 @@ from aiogram.utils.exceptions import MessageCantBeDeleted
 from aiogram.utils.exceptions import MessageNotModified
 from bson.decimal128 import Decimal128
 from bson.objectid import ObjectId
-from motor.core import AgnosticBaseCursor as Cursor
 
 from src import money
 from src import states
@@ -37,16 +36,34 @@ from src.bot import tg
 from src.config import config
 from src.database import database
 from src.database import database_user
+from src.database import profile_cache
+from src.database import user_cache
 from src.escrow import get_escrow_instance
 from src.escrow.escrow_offer import EscrowOffer
+from src.handlers.base import invalidate_order_render
+from src.handlers.base import order_books
+from src.handlers.base import OrderBook
 from src.handlers.base import orders_list
 from src.handlers.base import private_handler
 from src.handlers.base import show_order
 from src.i18n import i18n
 from src.i18n import plural_i18n
+from src.indexes import index_registry
+from src.notifications import expiration_scheduler
 
 OrderType = typing.Mapping[str, typing.Any]
 
+index_registry.add(
+    "orders",
+    [
+        ("sell_base", pymongo.ASCENDING),
+        ("buy_base", pymongo.ASCENDING),
+        ("expiration_time", pymongo.ASCENDING),
+        ("price_buy", pymongo.ASCENDING),
+    ],
+    query={"sell_base": "", "buy_base": "", "expiration_time": {"$gt": 0}},
+)
+
 
 def order_handler(
     handler: typing.Callable[[types.CallbackQuery, OrderType], typing.Any]
@@ -71,24 +88,22 @@ def order_handler(
 
 async def show_orders(
     call: types.CallbackQuery,
-    cursor: Cursor,
+    book: OrderBook,
     start: int,
-    quantity: int,
     buttons_data: str,
     invert: bool,
     user_id: typing.Optional[int] = None,
 ):
     """Send list of orders.
 
-    :param cursor: Cursor of MongoDB query to orders.
-    :param chat_id: Telegram chat ID.
+    :param book: Order book.
     :param start: Start index.
-    :param quantity: Quantity of orders in cursor.
     :param buttons_data: Beginning of callback data of left/right buttons.
-    :param user_id: If cursor is user-specific, Telegram ID of user
-        who created all orders in cursor.
+    :param user_id: If order book is user-specific, Telegram ID of user
+        who created all orders in it.
     :param invert: Invert all prices.
     """
+    quantity = await book.count(start)
     if start >= quantity > 0:
         await call.answer(i18n("no_more_orders"))
         return
@@ -96,19 +111,26 @@ async def show_orders(
     try:
         await call.answer()
         await orders_list(
-            cursor,
+            book,
             call.message.chat.id,
             start,
-            quantity,
             buttons_data,
             user_id=user_id,
             message_id=call.message.message_id,
             invert=invert,
+            quantity=quantity,
         )
     except MessageNotModified:
         await call.answer(i18n("no_previous_orders"))
 
 
+def session_order_book(token: typing.Optional[str]) -> typing.Optional[OrderBook]:
+    """Get order book of browsing session by ``token`` from callback data."""
+    if token is None:
+        return None
+    return order_books.get(token)
+
+
 @dp.callback_query_handler(
     lambda call: call.data.startswith("get_order "), state=any_state
 )
@@ -161,32 +183,18 @@ async def invert_button(call: types.CallbackQuery, order: OrderType):
     )
 
 
-async def aggregate_orders(buy: str, sell: str) -> typing.Tuple[Cursor, int]:
-    """Aggregate and query orders with specified currency pair.
+def aggregate_orders(buy: str, sell: str) -> OrderBook:
+    """Get order book of orders with specified currency pair.
 
-    Return cursor with unexpired orders sorted by price and creation
-    time and quantity of documents in it.
+    Order book contains unexpired orders sorted by price and creation
+    time.
     """
     query = {
-        "buy": money.gateway_currency_regexp(buy),
-        "sell": money.gateway_currency_regexp(sell),
+        **money.currency_query("buy", buy),
+        **money.currency_query("sell", sell),
         "$or": [{"archived": {"$exists": False}}, {"archived": False}],
-        "expiration_time": {"$gt": time()},
     }
-    cursor = database.orders.aggregate(
-        [
-            {"$match": query},
-            {"$addFields": {"price_buy": {"$ifNull": ["$price_buy", ""]}}},
-            {
-                "$sort": {
-                    "price_buy": pymongo.ASCENDING,
-                    "start_time": pymongo.DESCENDING,
-                }
-            },
-        ]
-    )
-    quantity = await database.orders.count_documents(query)
-    return cursor, quantity
+    return OrderBook(query, by_price=True, unexpired=True)
 
 
 @dp.callback_query_handler(
@@ -194,26 +202,14 @@ async def aggregate_orders(buy: str, sell: str) -> typing.Tuple[Cursor, int]:
 )
 async def orders_button(call: types.CallbackQuery):
     """React to left/right button query in order book."""
-    query = {
-        "$and": [
-            {
-                "$or": [
-                    {"expiration_time": {"$exists": False}},
-                    {"expiration_time": {"$gt": time()}},
-                ]
-            },
-            {"$or": [{"archived": {"$exists": False}}, {"archived": False}]},
-        ]
-    }
-    cursor = database.orders.find(query).sort("start_time", pymongo.DESCENDING)
-    quantity = await database.orders.count_documents(query)
-
     args = call.data.split()
     start = max(0, int(args[1]))
     invert = bool(int(args[2]))
-    await show_orders(
-        call, cursor, start, quantity, "orders", invert, user_id=call.from_user.id
-    )
+    book = session_order_book(args[3] if len(args) > 3 else None)
+    if book is None:
+        query = {"$or": [{"archived": {"$exists": False}}, {"archived": False}]}
+        book = OrderBook(query, unexpired=True)
+    await show_orders(call, book, start, "orders", invert, user_id=call.from_user.id)
 
 
 @dp.callback_query_handler(
@@ -221,14 +217,26 @@ async def orders_button(call: types.CallbackQuery):
 )
 async def my_orders_button(call: types.CallbackQuery):
     """React to left/right button query in list of user's orders."""
-    query = {"user_id": call.from_user.id}
-    cursor = database.orders.find(query).sort("start_time", pymongo.DESCENDING)
-    quantity = await database.orders.count_documents(query)
-
     args = call.data.split()
     start = max(0, int(args[1]))
     invert = bool(int(args[2]))
-    await show_orders(call, cursor, start, quantity, "my_orders", invert)
+    book = session_order_book(args[3] if len(args) > 3 else None)
+    if book is None:
+        book = OrderBook({"user_id": call.from_user.id})
+    await show_orders(call, book, start, "my_orders", invert)
+
+
+def matched_orders_data(order: OrderType, match: bool) -> str:
+    """Get beginning of callback data of list of orders matched with ``order``.
+
+    Order is referenced by its ID instead of currency pair to keep
+    callback data within 64 bytes limit of Telegram.
+
+    :param order: Order to match.
+    :param match: List orders with inverted currency pair instead of the
+        same one.
+    """
+    return "matched_orders {} {}".format(order["_id"], 1 if match else 0)
 
 
 @dp.callback_query_handler(
@@ -239,16 +247,27 @@ async def matched_orders_button(call: types.CallbackQuery):
     args = call.data.split()
     start = max(0, int(args[3]))
     invert = bool(int(args[4]))
-    cursor, quantity = await aggregate_orders(args[1], args[2])
+    book = session_order_book(args[5] if len(args) > 5 else None)
+    if not ObjectId.is_valid(args[1]):
+        # Legacy callback data with currency pair
+        buttons_data = "matched_orders {} {}".format(args[1], args[2])
+        if book is None:
+            book = aggregate_orders(args[1], args[2])
+    else:
+        order = await database.orders.find_one({"_id": ObjectId(args[1])})
+        if not order:
+            await call.answer(i18n("order_not_found"))
+            return
+        match = bool(int(args[2]))
+        buttons_data = matched_orders_data(order, match)
+        if book is None:
+            if match:
+                book = aggregate_orders(order["sell"], order["buy"])
+            else:
+                book = aggregate_orders(order["buy"], order["sell"])
     await call.answer()
     await show_orders(
-        call,
-        cursor,
-        start,
-        quantity,
-        "matched_orders {} {}".format(args[1], args[2]),
-        invert,
-        user_id=call.from_user.id,
+        call, book, start, buttons_data, invert, user_id=call.from_user.id
     )
 
 
@@ -261,14 +280,12 @@ async def similar_button(call: types.CallbackQuery, order: OrderType):
 
     Similar orders are ones that have the same currency pair.
     """
-    cursor, quantity = await aggregate_orders(order["buy"], order["sell"])
     await call.answer()
     await orders_list(
-        cursor,
+        aggregate_orders(order["buy"], order["sell"]),
         call.message.chat.id,
         0,
-        quantity,
-        "matched_orders {} {}".format(order["buy"], order["sell"]),
+        matched_orders_data(order, False),
         user_id=call.from_user.id,
     )
 
@@ -280,14 +297,12 @@ async def match_button(call: types.CallbackQuery, order: OrderType):
 
     Matched orders are ones that have the inverted currency pair.
     """
-    cursor, quantity = await aggregate_orders(order["sell"], order["buy"])
     await call.answer()
     await orders_list(
-        cursor,
+        aggregate_orders(order["sell"], order["buy"]),
         call.message.chat.id,
         0,
-        quantity,
-        "matched_orders {} {}".format(order["sell"], order["buy"]),
+        matched_orders_data(order, True),
         user_id=call.from_user.id,
     )
 
@@ -358,16 +373,12 @@ async def escrow_button(call: types.CallbackQuery, order: OrderType):
         }
         if "referrer" in user:
             init_user["referrer"] = user["referrer"]
-        counter_user = await database.users.find_one(
-            {"id": order["user_id"]},
-            projection={
-                "id": True,
-                "locale": True,
-                "mention": True,
-                "referrer": True,
-                "referrer_of_referrer": True,
-            },
-        )
+        counter_profile = await profile_cache.get(order["user_id"])
+        counter_user = {
+            field: counter_profile[field]
+            for field in ("id", "locale", "mention", "referrer", "referrer_of_referrer")
+            if field in counter_profile
+        }
         await database.escrow.delete_many({"init.send_address": {"$exists": False}})
         offer = EscrowOffer(
             **{
@@ -457,21 +468,20 @@ async def edit_button(call: types.CallbackQuery):
         answer,
         reply_markup=keyboard,
     )
-    await database.users.update_one(
-        {"_id": user["_id"]},
-        {
-            "$set": {
-                "edit.order_message_id": call.message.message_id,
-                "edit.message_id": result.message_id,
-                "edit.order_id": order["_id"],
-                "edit.field": field,
-                "edit.location_message_id": int(args[3]),
-                "edit.one_time": bool(int(args[4])),
-                "edit.show_id": call.message.text.startswith("ID"),
-                "state": states.field_editing.state,
-            }
-        },
-    )
+    update = {
+        "$set": {
+            "edit.order_message_id": call.message.message_id,
+            "edit.message_id": result.message_id,
+            "edit.order_id": order["_id"],
+            "edit.field": field,
+            "edit.location_message_id": int(args[3]),
+            "edit.one_time": bool(int(args[4])),
+            "edit.show_id": call.message.text.startswith("ID"),
+            "state": states.field_editing.state,
+        }
+    }
+    await database.users.update_one({"_id": user["_id"]}, update)
+    user_cache.patch(user["id"], update)
 
 
 async def finish_edit(user, update_dict):
@@ -479,7 +489,14 @@ async def finish_edit(user, update_dict):
     edit = user["edit"]
     result = await database.orders.update_one({"_id": edit["order_id"]}, update_dict)
     if result.modified_count:
-        order = await database.orders.find_one({"_id": edit["order_id"]})
+        order = await database.orders.find_one_and_update(
+            {"_id": edit["order_id"]},
+            {"$inc": {"version": 1}},
+            return_document=pymongo.ReturnDocument.AFTER,
+        )
+        invalidate_order_render(order["_id"])
+        if "expiration_time" in update_dict.get("$set", {}):
+            expiration_scheduler.schedule(order)
         try:
             await show_order(
                 order,
@@ -492,9 +509,9 @@ async def finish_edit(user, update_dict):
             )
         except MessageNotModified:
             pass
-    await database.users.update_one(
-        {"_id": user["_id"]}, {"$unset": {"edit": True, "state": True}}
-    )
+    update = {"$unset": {"edit": True, "state": True}}
+    await database.users.update_one({"_id": user["_id"]}, update)
+    user_cache.patch(user["id"], update)
 
 
 @dp.callback_query_handler(
@@ -677,6 +694,7 @@ async def archive_button(call: types.CallbackQuery, order: OrderType):
         update_dict = {"$unset": {"archived": True}, "$set": {"notify": True}}
     else:
         update_dict = {"$set": {"archived": True, "notify": False}}
+    update_dict["$inc"] = {"version": 1}
     order = await database.orders.find_one_and_update(
         {"_id": ObjectId(args[1]), "user_id": call.from_user.id},
         update_dict,
@@ -687,6 +705,9 @@ async def archive_button(call: types.CallbackQuery, order: OrderType):
             i18n("unarchive_order_error") if archived else i18n("archive_order_error")
         )
         return
+    invalidate_order_render(order["_id"])
+    if archived:
+        expiration_scheduler.schedule(order)
 
     await call.answer()
     await show_order(
@@ -747,6 +768,7 @@ async def confirm_delete_button(call: types.CallbackQuery):
     if not order:
         await call.answer(i18n("delete_order_error"))
         return
+    invalidate_order_render(order["_id"])
 
     location_message_id = int(call.data.split()[2])
     keyboard = types.InlineKeyboardMarkup()
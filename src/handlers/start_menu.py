@@ -40,15 +40,31 @@ from src.bot import tg
 from src.config import config
 from src.database import database
 from src.database import database_user
+from src.database import user_cache
+from src.handlers.base import OrderBook
 from src.handlers.base import orders_list
 from src.handlers.base import private_handler
 from src.handlers.base import start_keyboard
 from src.i18n import i18n
-from src.money import gateway_currency_regexp
+from src.indexes import index_registry
+from src.money import currency_query
+from src.subscriptions import subscription_index
 
+index_registry.add(
+    "users", "referral_code", query={"referral_code": ""}, unique=True, sparse=True
+)
+index_registry.add("subscriptions", "id", query={"id": 0}, unique=True)
+index_registry.add(
+    "orders",
+    [("user_id", pymongo.ASCENDING), ("start_time", pymongo.DESCENDING)],
+    query={"user_id": 0},
+    sort=[("start_time", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)],
+)
 
-def locale_keyboard():
-    """Get inline keyboard markup with available locales."""
+
+@i18n.cache
+def locale_keyboard() -> str:
+    """Get serialized inline keyboard markup with available locales."""
     keyboard = InlineKeyboardMarkup()
     for language in i18n.available_locales:
         keyboard.row(
@@ -57,7 +73,7 @@ def locale_keyboard():
                 callback_data="locale {}".format(language),
             )
         )
-    return keyboard
+    return keyboard.as_json()
 
 
 @private_handler(commands=["start"], state=any_state)
@@ -106,9 +122,10 @@ async def handle_start_command(message: types.Message, state: FSMContext):
 async def locale_button(call: types.CallbackQuery):
     """Choose language from list."""
     locale = call.data.split()[1]
-    await database.users.update_one(
-        {"id": call.from_user.id}, {"$set": {"locale": locale}}
-    )
+    update = {"$set": {"locale": locale}}
+    await database.users.update_one({"id": call.from_user.id}, update)
+    user_cache.patch(call.from_user.id, update)
+    subscription_index.set_locale(call.from_user.id, locale)
     i18n.ctx_locale.set(locale)
     await call.answer()
     await tg.send_message(
@@ -181,30 +198,32 @@ async def handle_book(
         =============  =================================================
 
     """
-    query = {
-        "$or": [{"archived": {"$exists": False}}, {"archived": False}],
-        "expiration_time": {"$gt": time()},
-    }
+    query = {"$or": [{"archived": {"$exists": False}}, {"archived": False}]}
 
     if command is not None:
         source = message.text.upper().split()
         if len(source) == 2:
             currency = source[1]
             if currency != "*":
-                regexp = gateway_currency_regexp(currency)
-                query = {"$and": [query, {"$or": [{"sell": regexp}, {"buy": regexp}]}]}
+                currency_or = [
+                    currency_query("sell", currency),
+                    currency_query("buy", currency),
+                ]
+                query = {"$and": [query, {"$or": currency_or}]}
         elif len(source) >= 3:
             sell, buy = source[1], source[2]
             if sell != "*":
-                query["sell"] = gateway_currency_regexp(sell)
+                query.update(currency_query("sell", sell))
             if buy != "*":
-                query["buy"] = gateway_currency_regexp(buy)
+                query.update(currency_query("buy", buy))
 
-    cursor = database.orders.find(query).sort("start_time", pymongo.DESCENDING)
-    quantity = await database.orders.count_documents(query)
     await state.finish()
     await orders_list(
-        cursor, message.chat.id, 0, quantity, "orders", user_id=message.from_user.id
+        OrderBook(query, unexpired=True),
+        message.chat.id,
+        0,
+        "orders",
+        user_id=message.from_user.id,
     )
 
 
@@ -215,10 +234,8 @@ async def handle_book(
 async def handle_my_orders(message: types.Message, state: FSMContext):
     """Show user's orders."""
     query = {"user_id": message.from_user.id}
-    cursor = database.orders.find(query).sort("start_time", pymongo.DESCENDING)
-    quantity = await database.orders.count_documents(query)
     await state.finish()
-    await orders_list(cursor, message.chat.id, 0, quantity, "my_orders")
+    await orders_list(OrderBook(query), message.chat.id, 0, "my_orders")
 
 
 @private_handler(commands=["link"], state=any_state)
@@ -233,13 +250,13 @@ async def get_referral_link(message: types.Message):
         while True:
             cryptogen = SystemRandom()
             code = "".join(cryptogen.choice(ascii_lowercase) for _ in range(7))
+            update = {"$set": {"referral_code": code}}
             try:
-                await database.users.update_one(
-                    {"_id": user["_id"]}, {"$set": {"referral_code": code}}
-                )
+                await database.users.update_one({"_id": user["_id"]}, update)
             except DuplicateKeyError:
                 continue
             else:
+                user_cache.patch(user["id"], update)
                 break
     me = await tg.me
     answer = i18n("referral_share {link}").format(
@@ -332,8 +349,7 @@ async def search_by_creator(message: types.Message, state: FSMContext):
     therefore not supported.
     """
     query: typing.Dict[str, typing.Any] = {
-        "$or": [{"archived": {"$exists": False}}, {"archived": False}],
-        "expiration_time": {"$gt": time()},
+        "$or": [{"archived": {"$exists": False}}, {"archived": False}]
     }
     source = message.text.split()
     try:
@@ -360,11 +376,13 @@ async def search_by_creator(message: types.Message, state: FSMContext):
         )
         return
 
-    cursor = database.orders.find(query).sort("start_time", pymongo.DESCENDING)
-    quantity = await database.orders.count_documents(query)
     await state.finish()
     await orders_list(
-        cursor, message.chat.id, 0, quantity, "orders", user_id=message.from_user.id
+        OrderBook(query, unexpired=True),
+        message.chat.id,
+        0,
+        "orders",
+        user_id=message.from_user.id,
     )
 
 
@@ -432,6 +450,11 @@ async def subcribe_to_pair(
             upsert=True,
         )
         if not update_result.matched_count or update_result.modified_count:
+            subscriber = {"id": message.from_user.id, "chat": message.chat.id}
+            user = database_user.get()
+            if user and "locale" in user:
+                subscriber["locale"] = user["locale"]
+            subscription_index.add(subscriber, sub)
             await tg.send_message(
                 message.chat.id,
                 i18n("subscription_added"),
@@ -448,6 +471,7 @@ async def subcribe_to_pair(
             {"id": message.from_user.id}, {"$pull": {"subscriptions": sub}}
         )
         if delete_result.modified_count:
+            subscription_index.remove(message.from_user.id, sub)
             await tg.send_message(
                 message.chat.id,
                 i18n("subscription_deleted"),
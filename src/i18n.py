@@ -14,6 +14,7 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with TellerBot.  If not, see <https://www.gnu.org/licenses/>.
+import functools
 import gettext
 import typing
 from pathlib import Path
@@ -23,6 +24,8 @@ from aiogram.contrib.middlewares.i18n import I18nMiddleware
 
 from src.database import database_user
 
+ResultType = typing.TypeVar("ResultType")
+
 
 class I18nMiddlewareManual(I18nMiddleware):
     """I18n middleware which gets user locale from database."""
@@ -34,6 +37,7 @@ class I18nMiddlewareManual(I18nMiddleware):
         self.domain = domain
         self.path = path
         self.default = default
+        self._caches: typing.List[typing.Dict[typing.Tuple, typing.Any]] = []
 
     def find_locales(self) -> typing.Dict[str, gettext.NullTranslations]:
         """Load all compiled locales from path and add default fallbacks."""
@@ -42,6 +46,33 @@ class I18nMiddlewareManual(I18nMiddleware):
             translation.add_fallback(translations[self.default])
         return translations
 
+    def reload(self):
+        """Reload locales and clear caches of localized results."""
+        super().reload()
+        for cache in self._caches:
+            cache.clear()
+
+    def cache(
+        self, function: typing.Callable[..., ResultType]
+    ) -> typing.Callable[..., ResultType]:
+        """Cache results of ``function`` by current locale and arguments.
+
+        Cached results are shared between calls and must not be mutated.
+        """
+        cache: typing.Dict[typing.Tuple, ResultType] = {}
+        self._caches.append(cache)
+
+        @functools.wraps(function)
+        def wrapper(*args):
+            key = (self.ctx_locale.get(), *args)
+            try:
+                return cache[key]
+            except KeyError:
+                result = cache[key] = function(*args)
+                return result
+
+        return wrapper
+
     async def get_user_locale(
         self, action: str, args: typing.Tuple[typing.Any]
     ) -> typing.Optional[str]:
@@ -0,0 +1,177 @@
+# Copyright (C) 2019  alfred richardsn
+#
+# This file is part of TellerBot.
+#
+# TellerBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with TellerBot.  If not, see <https://www.gnu.org/licenses/>.
+"""Declarative registry of database indexes."""
+import logging
+import typing
+
+from pymongo import IndexModel
+from pymongo.errors import OperationFailure
+
+from src.database import database
+
+log = logging.getLogger(__name__)
+
+IndexKeys = typing.List[typing.Tuple[str, int]]
+
+
+def _normalize_keys(keys: typing.Iterable[typing.Tuple[str, typing.Any]]) -> IndexKeys:
+    return [
+        (field, int(direction) if isinstance(direction, float) else direction)
+        for field, direction in keys
+    ]
+
+
+def _plan_stages(plan: typing.Mapping[str, typing.Any]) -> typing.Iterator[str]:
+    """Get names of all stages of query ``plan``."""
+    if "stage" in plan:
+        yield plan["stage"]
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            yield from _plan_stages(plan[key])
+    for input_stage in plan.get("inputStages", []):
+        yield from _plan_stages(input_stage)
+
+
+class CanonicalQuery(typing.NamedTuple):
+    """Query with representative values which must be covered by index."""
+
+    collection: str
+    filter: typing.Mapping[str, typing.Any]
+    sort: typing.Optional[IndexKeys]
+
+
+class IndexRegistry:
+    """Registry of indexes contributed by modules querying the collections.
+
+    Modules register indexes and canonical queries on import. Registered
+    indexes are reconciled with the database on startup and canonical
+    queries can be checked for collection scans with ``check_queries``.
+    """
+
+    def __init__(self):
+        """Create empty registry."""
+        self._indexes: typing.Dict[str, typing.List[IndexModel]] = {}
+        self._queries: typing.List[CanonicalQuery] = []
+
+    def add(
+        self,
+        collection: str,
+        keys: typing.Union[str, IndexKeys],
+        query: typing.Optional[typing.Mapping[str, typing.Any]] = None,
+        sort: typing.Optional[IndexKeys] = None,
+        **kwargs,
+    ) -> None:
+        """Register index on ``keys`` of ``collection``.
+
+        :param collection: Name of collection.
+        :param keys: Field name or list of (field, direction) pairs.
+        :param query: Canonical query filter which should use the index.
+        :param sort: Sort specification of canonical query.
+        :param kwargs: Index options passed to ``IndexModel``.
+        """
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        self._indexes.setdefault(collection, []).append(IndexModel(keys, **kwargs))
+        if query is not None:
+            self.add_query(collection, query, sort)
+
+    def add_query(
+        self,
+        collection: str,
+        query: typing.Mapping[str, typing.Any],
+        sort: typing.Optional[IndexKeys] = None,
+    ) -> None:
+        """Register canonical ``query`` to ``collection`` sorted by ``sort``."""
+        self._queries.append(CanonicalQuery(collection, query, sort))
+
+    async def reconcile(self) -> None:
+        """Create missing indexes and report unused and redundant ones."""
+        for collection, models in self._indexes.items():
+            existing = await database[collection].index_information()
+            existing_keys = [
+                _normalize_keys(info["key"]) for info in existing.values()
+            ]
+            missing = [
+                model
+                for model in models
+                if _normalize_keys(model.document["key"].items()) not in existing_keys
+            ]
+            if missing:
+                try:
+                    names = await database[collection].create_indexes(missing)
+                except OperationFailure as error:
+                    log.error("Failed to create indexes on %s: %s", collection, error)
+                else:
+                    log.info("Created indexes on %s: %s", collection, names)
+            await self._report(collection, models, existing)
+
+    async def _report(
+        self,
+        collection: str,
+        models: typing.List[IndexModel],
+        existing: typing.Mapping[str, typing.Mapping[str, typing.Any]],
+    ) -> None:
+        registered = [
+            _normalize_keys(model.document["key"].items()) for model in models
+        ]
+        for name, info in existing.items():
+            if name == "_id_":
+                continue
+            keys = _normalize_keys(info["key"])
+            if keys not in registered:
+                log.warning("Index %s on %s is not registered", name, collection)
+            if not info.get("unique") and any(
+                len(other) > len(keys) and other[: len(keys)] == keys
+                for other in registered
+            ):
+                log.warning(
+                    "Index %s on %s is a prefix of another index", name, collection
+                )
+        try:
+            stats = database[collection].aggregate([{"$indexStats": {}}])
+            async for stat in stats:
+                if stat["name"] != "_id_" and not stat["accesses"]["ops"]:
+                    log.warning(
+                        "Index %s on %s is unused since %s",
+                        stat["name"],
+                        collection,
+                        stat["accesses"]["since"],
+                    )
+        except OperationFailure:
+            log.debug("Index statistics of %s are unavailable", collection)
+
+    async def check_queries(self) -> typing.List[CanonicalQuery]:
+        """Explain canonical queries and get those which scan collection."""
+        scanning = []
+        for query in self._queries:
+            cursor = database[query.collection].find(query.filter)
+            if query.sort is not None:
+                cursor = cursor.sort(query.sort)
+            explanation = await cursor.explain()
+            stages = set(_plan_stages(explanation["queryPlanner"]["winningPlan"]))
+            if "COLLSCAN" in stages:
+                log.error(
+                    "Query %s on %s sorted by %s scans collection",
+                    query.filter,
+                    query.collection,
+                    query.sort,
+                )
+                scanning.append(query)
+        return scanning
+
+
+index_registry = IndexRegistry()
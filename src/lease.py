@@ -0,0 +1,109 @@
+# Copyright (C) 2019  alfred richardsn
+#
+# This file is part of TellerBot.
+#
+# TellerBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with TellerBot.  If not, see <https://www.gnu.org/licenses/>.
+"""Leadership of one process among bot workers."""
+import asyncio
+import logging
+import os
+import socket
+import typing
+from datetime import datetime
+from datetime import timedelta
+
+from pymongo.errors import DuplicateKeyError
+from pymongo.errors import PyMongoError
+
+from src.config import config
+from src.database import database
+
+log = logging.getLogger(__name__)
+
+
+class LeaderLease:
+    """Lease of leadership stored in ``leases`` collection.
+
+    Lease is held by one process until it isn't renewed for
+    ``config.LEASE_TTL`` seconds.
+
+    :param name: Name of lease.
+    """
+
+    def __init__(self, name: str):
+        """Create lease owned by current process."""
+        self.name = name
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+
+    async def acquire(self) -> bool:
+        """Acquire or renew lease and return True if it is held."""
+        now = datetime.utcnow()
+        try:
+            await database.leases.update_one(
+                {
+                    "_id": self.name,
+                    "$or": [{"owner": self.owner}, {"expires": {"$lt": now}}],
+                },
+                {
+                    "$set": {
+                        "owner": self.owner,
+                        "expires": now + timedelta(seconds=config.LEASE_TTL),
+                    }
+                },
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            # Lease is held by another process
+            return False
+        except PyMongoError as error:
+            log.warning("Failed to renew lease %s: %s", self.name, error)
+            return False
+        return True
+
+    async def release(self) -> None:
+        """Release lease if it is held."""
+        await database.leases.delete_one({"_id": self.name, "owner": self.owner})
+
+    async def run(self, *jobs: typing.Callable[[], typing.Awaitable]) -> None:
+        """Run ``jobs`` whenever lease is held.
+
+        Lease is renewed while jobs are running. If it is lost, jobs are
+        cancelled and lease is acquired again when it expires.
+        """
+        interval = config.LEASE_TTL / 3
+        while True:
+            if await self.acquire():
+                log.info("Acquired lease %s as %s", self.name, self.owner)
+                tasks = [asyncio.create_task(self._run_job(job)) for job in jobs]
+                try:
+                    while True:
+                        await asyncio.sleep(interval)
+                        if not await self.acquire():
+                            break
+                    log.warning("Lost lease %s", self.name)
+                except asyncio.CancelledError:
+                    await self.release()
+                    raise
+                finally:
+                    for task in tasks:
+                        task.cancel()
+            await asyncio.sleep(interval)
+
+    async def _run_job(self, job: typing.Callable[[], typing.Awaitable]) -> None:
+        try:
+            await job()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("Job %s of lease %s failed", job.__qualname__, self.name)
@@ -0,0 +1,108 @@
+# Copyright (C) 2019  alfred richardsn
+#
+# This file is part of TellerBot.
+#
+# TellerBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with TellerBot.  If not, see <https://www.gnu.org/licenses/>.
+"""Buffered writing of incoming and outgoing history to the database."""
+import asyncio
+import logging
+import typing
+from time import monotonic
+
+from src.config import config
+from src.database import database
+
+log = logging.getLogger(__name__)
+
+
+class LogSink:
+    """Bounded queue of log documents written to the database in batches.
+
+    Documents are inserted with ``insert_many`` when batch is full or
+    when ``DATABASE_LOGGING_INTERVAL`` seconds have passed since the
+    first document of batch was queued. If queue is full, new documents
+    are dropped and counted in ``dropped``.
+    """
+
+    def __init__(self):
+        """Create empty sink."""
+        self._queue: asyncio.Queue = asyncio.Queue(config.DATABASE_LOGGING_QUEUE_SIZE)
+        #: Number of documents dropped because queue was full.
+        self.dropped = 0
+        #: Number of documents written to the database.
+        self.written = 0
+        self._reported_dropped = 0
+        #: Documents taken from queue into batch which is being collected.
+        self._batch: typing.List[typing.Mapping[str, typing.Any]] = []
+
+    @property
+    def queue_size(self) -> int:
+        """Get number of documents waiting to be written."""
+        return self._queue.qsize()
+
+    def put(self, document: typing.Mapping[str, typing.Any]) -> None:
+        """Queue ``document`` without waiting."""
+        try:
+            self._queue.put_nowait(document)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def _get_batch(self) -> typing.List[typing.Mapping[str, typing.Any]]:
+        # Documents are collected in attribute, so that flush can write
+        # them if it's called while batch is being collected
+        self._batch.append(await self._queue.get())
+        deadline = monotonic() + config.DATABASE_LOGGING_INTERVAL
+        while len(self._batch) < config.DATABASE_LOGGING_BATCH_SIZE:
+            timeout = deadline - monotonic()
+            if timeout <= 0:
+                break
+            try:
+                self._batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        batch, self._batch = self._batch, []
+        return batch
+
+    async def _write(self, batch: typing.List[typing.Mapping[str, typing.Any]]):
+        try:
+            await database.logs.insert_many(batch, ordered=False)
+        except Exception:
+            log.exception("Failed to write %d log documents", len(batch))
+            self.dropped += len(batch)
+        else:
+            self.written += len(batch)
+        if self.dropped != self._reported_dropped:
+            log.warning("%d log documents dropped so far", self.dropped)
+            self._reported_dropped = self.dropped
+
+    async def run_loop(self) -> None:
+        """Write queued documents in infinite loop."""
+        while True:
+            await self._write(await self._get_batch())
+
+    async def flush(self) -> None:
+        """Write all queued documents including batch being collected."""
+        batch, self._batch = self._batch, []
+        if batch:
+            await self._write(batch)
+        while not self._queue.empty():
+            batch = []
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                if len(batch) == config.DATABASE_LOGGING_BATCH_SIZE:
+                    break
+            await self._write(batch)
+
+
+log_sink = LogSink()
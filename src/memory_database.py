@@ -0,0 +1,1201 @@
+# Copyright (C) 2019  alfred richardsn
+#
+# This file is part of TellerBot.
+#
+# TellerBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with TellerBot.  If not, see <https://www.gnu.org/licenses/>.
+"""In-memory database implementing the subset of Motor API used by the bot.
+
+It stands in for MongoDB in load tests and local runs. Documents are
+kept in process memory and lost when it exits. Unique indexes are
+enforced, other indexes are only recorded.
+"""
+
+import asyncio
+import copy
+import operator
+import re
+import typing
+from abc import ABC
+from abc import abstractmethod
+from datetime import datetime
+from decimal import Decimal
+
+from bson.decimal128 import Decimal128
+from bson.objectid import ObjectId
+from pymongo import DeleteMany
+from pymongo import DeleteOne
+from pymongo import IndexModel
+from pymongo import InsertOne
+from pymongo import ReplaceOne
+from pymongo import ReturnDocument
+from pymongo import UpdateMany
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from pymongo.errors import DuplicateKeyError
+from pymongo.errors import OperationFailure
+from pymongo.results import BulkWriteResult
+from pymongo.results import DeleteResult
+from pymongo.results import InsertManyResult
+from pymongo.results import InsertOneResult
+from pymongo.results import UpdateResult
+
+Document = typing.Dict[str, typing.Any]
+Filter = typing.Mapping[str, typing.Any]
+SortKeys = typing.List[typing.Tuple[str, int]]
+
+COMPARISONS = {
+    "$gt": operator.gt,
+    "$gte": operator.ge,
+    "$lt": operator.lt,
+    "$lte": operator.le,
+}
+
+
+def _type_rank(value: typing.Any) -> int:
+    """Get rank of ``value`` type in BSON comparison order."""
+    if value is None:
+        return 1
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, (int, float, Decimal, Decimal128)):
+        return 2
+    if isinstance(value, str):
+        return 3
+    if isinstance(value, dict):
+        return 4
+    if isinstance(value, list):
+        return 5
+    if isinstance(value, bytes):
+        return 6
+    if isinstance(value, ObjectId):
+        return 7
+    if isinstance(value, datetime):
+        return 9
+    if isinstance(value, re.Pattern):
+        return 11
+    return 12
+
+
+def _comparable(value: typing.Any) -> typing.Any:
+    if isinstance(value, Decimal128):
+        return value.to_decimal()
+    return value
+
+
+def _sort_key(value: typing.Any) -> typing.Tuple[int, typing.Any]:
+    """Get key ordering values of different types the way MongoDB does."""
+    rank = _type_rank(value)
+    if rank == 1:
+        return (rank, 0)
+    if rank in (4, 5, 11, 12):
+        return (rank, repr(value))
+    return (rank, _comparable(value))
+
+
+def _hashable(value: typing.Any) -> typing.Hashable:
+    if isinstance(value, (dict, list)):
+        return repr(value)
+    if isinstance(value, Decimal128):
+        return value.to_decimal()
+    return value
+
+
+def _get_values(document: typing.Any, path: str) -> typing.List[typing.Any]:
+    """Get all values of dotted ``path`` in ``document`` traversing arrays."""
+    values = [document]
+    for key in path.split("."):
+        found = []
+        for value in values:
+            if isinstance(value, dict):
+                if key in value:
+                    found.append(value[key])
+            elif isinstance(value, list):
+                if key.isdigit():
+                    if int(key) < len(value):
+                        found.append(value[int(key)])
+                else:
+                    found.extend(
+                        element[key]
+                        for element in value
+                        if isinstance(element, dict) and key in element
+                    )
+        values = found
+    return values
+
+
+def _get(document: typing.Any, path: str) -> typing.Any:
+    values = _get_values(document, path)
+    return values[0] if values else None
+
+
+def _parent(
+    document: Document, path: str, create: bool
+) -> typing.Tuple[typing.Any, typing.Union[str, int]]:
+    """Get container of the last field of dotted ``path`` and its key.
+
+    Missing embedded documents are created if ``create`` is true,
+    otherwise container is None.
+    """
+    *parents, key = path.split(".")
+    container: typing.Any = document
+    for parent in parents:
+        if isinstance(container, list) and parent.isdigit():
+            index = int(parent)
+            container = container[index] if index < len(container) else None
+        elif isinstance(container, dict):
+            if parent not in container:
+                if not create:
+                    return None, key
+                container[parent] = {}
+            container = container[parent]
+        else:
+            container = None
+        if container is None:
+            return None, key
+    if isinstance(container, list) and key.isdigit():
+        return container, int(key)
+    return container, key
+
+
+def _is_scalar(value: typing.Any) -> bool:
+    """Check if ``value`` is used as is in keys of unique indexes."""
+    return isinstance(value, (int, str, ObjectId)) and not isinstance(value, bool)
+
+
+def _is_operator_document(value: typing.Any) -> bool:
+    return (
+        isinstance(value, dict)
+        and bool(value)
+        and all(key.startswith("$") for key in value)
+    )
+
+
+def _equals(value: typing.Any, expected: typing.Any) -> bool:
+    if isinstance(expected, re.Pattern):
+        return isinstance(value, str) and expected.search(value) is not None
+    if _type_rank(value) != _type_rank(expected):
+        return False
+    return _comparable(value) == _comparable(expected)
+
+
+def _candidates(values: typing.List[typing.Any]) -> typing.Iterator[typing.Any]:
+    """Get ``values`` and elements of array values which match conditions."""
+    for value in values:
+        yield value
+        if isinstance(value, list):
+            yield from value
+
+
+def _any_equals(values: typing.List[typing.Any], expected: typing.Any) -> bool:
+    if not values:
+        return expected is None
+    return any(_equals(value, expected) for value in _candidates(values))
+
+
+def _compare(
+    value: typing.Any,
+    operand: typing.Any,
+    compare: typing.Callable[[typing.Any, typing.Any], bool],
+) -> bool:
+    rank = _type_rank(value)
+    if rank != _type_rank(operand) or rank in (4, 5, 11, 12):
+        return False
+    if rank == 1:
+        return compare(0, 0)
+    return compare(_comparable(value), _comparable(operand))
+
+
+def _match_condition(values: typing.List[typing.Any], condition: typing.Any) -> bool:
+    """Check if ``values`` of field match query ``condition``."""
+    if not _is_operator_document(condition):
+        return _any_equals(values, condition)
+    for name, operand in condition.items():
+        if name == "$eq":
+            matched = _any_equals(values, operand)
+        elif name == "$ne":
+            matched = not _any_equals(values, operand)
+        elif name == "$in":
+            matched = any(_any_equals(values, element) for element in operand)
+        elif name == "$nin":
+            matched = not any(_any_equals(values, element) for element in operand)
+        elif name == "$exists":
+            matched = bool(values) == bool(operand)
+        elif name in COMPARISONS:
+            matched = any(
+                _compare(value, operand, COMPARISONS[name])
+                for value in _candidates(values)
+            )
+        elif name == "$regex":
+            pattern = re.compile(operand, _regex_flags(condition.get("$options", "")))
+            matched = any(_equals(value, pattern) for value in _candidates(values))
+        elif name == "$options":
+            continue
+        elif name == "$not":
+            matched = not _match_condition(values, operand)
+        elif name == "$size":
+            matched = any(
+                isinstance(value, list) and len(value) == operand for value in values
+            )
+        elif name == "$elemMatch":
+            matched = any(
+                isinstance(value, list)
+                and any(_match_element(element, operand) for element in value)
+                for value in values
+            )
+        else:
+            raise OperationFailure(f"Unsupported query operator: {name}")
+        if not matched:
+            return False
+    return True
+
+
+def _regex_flags(options: str) -> int:
+    flags = 0
+    for option, flag in (("i", re.I), ("m", re.M), ("s", re.S), ("x", re.X)):
+        if option in options:
+            flags |= flag
+    return flags
+
+
+def _match_element(element: typing.Any, condition: typing.Any) -> bool:
+    """Check if array ``element`` matches ``condition`` of array query."""
+    if _is_operator_document(condition):
+        return _match_condition([element], condition)
+    if isinstance(condition, dict):
+        return isinstance(element, dict) and matches(element, condition)
+    return _equals(element, condition)
+
+
+def matches(document: Document, query: Filter) -> bool:
+    """Check if ``document`` matches ``query`` filter."""
+    for key, condition in query.items():
+        if key == "$and":
+            matched = all(matches(document, part) for part in condition)
+        elif key == "$or":
+            matched = any(matches(document, part) for part in condition)
+        elif key == "$nor":
+            matched = not any(matches(document, part) for part in condition)
+        elif key == "$expr":
+            matched = bool(evaluate(condition, document))
+        elif key.startswith("$"):
+            raise OperationFailure(f"Unsupported query operator: {key}")
+        else:
+            matched = _match_condition(_get_values(document, key), condition)
+        if not matched:
+            return False
+    return True
+
+
+def evaluate(expression: typing.Any, document: Document) -> typing.Any:
+    """Evaluate aggregation ``expression`` on ``document``."""
+    if isinstance(expression, str) and expression.startswith("$"):
+        return _get(document, expression[1:])
+    if isinstance(expression, list):
+        return [evaluate(element, document) for element in expression]
+    if not isinstance(expression, dict):
+        return expression
+    if len(expression) != 1 or not next(iter(expression)).startswith("$"):
+        return {key: evaluate(value, document) for key, value in expression.items()}
+    name, operand = next(iter(expression.items()))
+    if name == "$literal":
+        return operand
+    arguments = evaluate(operand, document)
+    if name == "$ifNull":
+        value, replacement = arguments
+        return replacement if value is None else value
+    if name == "$eq":
+        return _sort_key(arguments[0]) == _sort_key(arguments[1])
+    if name == "$ne":
+        return _sort_key(arguments[0]) != _sort_key(arguments[1])
+    if name in COMPARISONS:
+        return COMPARISONS[name](_sort_key(arguments[0]), _sort_key(arguments[1]))
+    if name == "$and":
+        return all(arguments)
+    if name == "$or":
+        return any(arguments)
+    if name == "$not":
+        return not (arguments[0] if isinstance(arguments, list) else arguments)
+    raise OperationFailure(f"Unsupported expression operator: {name}")
+
+
+def _add(value: typing.Any, increment: typing.Any) -> typing.Any:
+    if isinstance(value, Decimal128) or isinstance(increment, Decimal128):
+        return Decimal128(_comparable(value) + _comparable(increment))
+    return value + increment
+
+
+def apply_update(document: Document, update: Filter, inserting: bool = False) -> None:
+    """Apply update operators of ``update`` to ``document``.
+
+    :param inserting: Whether document is being inserted by upsert.
+    """
+    for name, fields in update.items():
+        if name == "$setOnInsert" and not inserting:
+            continue
+        for path, value in fields.items():
+            creating = name not in ("$unset", "$pull")
+            container, key = _parent(document, path, create=creating)
+            if container is None:
+                continue
+            if name in ("$set", "$setOnInsert"):
+                container[key] = copy.deepcopy(value)
+            elif name == "$unset":
+                if isinstance(container, dict):
+                    container.pop(key, None)
+                elif isinstance(key, int) and key < len(container):
+                    container[key] = None
+            elif name == "$inc":
+                current = container.get(key, 0) if isinstance(container, dict) else 0
+                container[key] = _add(current, value)
+            elif name in ("$addToSet", "$push"):
+                array = container.setdefault(key, [])
+                if not isinstance(array, list):
+                    raise OperationFailure(f"Field {path} is not an array")
+                if isinstance(value, dict) and "$each" in value:
+                    elements = value["$each"]
+                else:
+                    elements = [value]
+                for element in elements:
+                    if name == "$push" or not any(
+                        _equals(existing, element) for existing in array
+                    ):
+                        array.append(copy.deepcopy(element))
+            elif name == "$pull":
+                array = container.get(key) if isinstance(container, dict) else None
+                if isinstance(array, list):
+                    container[key] = [
+                        element
+                        for element in array
+                        if not _match_element(element, value)
+                    ]
+            else:
+                raise OperationFailure(f"Unsupported update operator: {name}")
+
+
+def project(
+    document: Document,
+    projection: typing.Union[
+        None, typing.Mapping[str, typing.Any], typing.Iterable[str]
+    ],
+) -> Document:
+    """Get copy of ``document`` with fields selected by ``projection``."""
+    if not projection:
+        return copy.deepcopy(document)
+    if not isinstance(projection, typing.Mapping):
+        projection = {field: True for field in projection}
+    included = [
+        field for field, value in projection.items() if value and field != "_id"
+    ]
+    if not included:
+        result = copy.deepcopy(document)
+        for field, value in projection.items():
+            if not value:
+                container, key = _parent(result, field, create=False)
+                if isinstance(container, dict):
+                    container.pop(key, None)
+        return result
+    result = {}
+    if projection.get("_id", True) and "_id" in document:
+        result["_id"] = copy.deepcopy(document["_id"])
+    for field in included:
+        source: typing.Any = document
+        target = result
+        *parents, key = field.split(".")
+        for parent in parents:
+            source = source.get(parent) if isinstance(source, dict) else None
+            if not isinstance(source, dict):
+                break
+            target = target.setdefault(parent, {})
+        else:
+            if key in source:
+                target[key] = copy.deepcopy(source[key])
+    return result
+
+
+def sort_documents(documents: typing.List[Document], keys: SortKeys) -> None:
+    """Sort ``documents`` in place by ``keys``."""
+    # Stable sorts by keys in reverse order produce lexicographic order
+    for field, direction in reversed(keys):
+        documents.sort(
+            key=lambda document: _sort_key(_get(document, field)),
+            reverse=direction < 0,
+        )
+
+
+def _sort_keys(
+    key_or_list: typing.Union[str, SortKeys, typing.Mapping[str, int]],
+    direction: typing.Optional[int] = None,
+) -> SortKeys:
+    if isinstance(key_or_list, str):
+        return [(key_or_list, 1 if direction is None else direction)]
+    if isinstance(key_or_list, typing.Mapping):
+        return list(key_or_list.items())
+    return list(key_or_list)
+
+
+def _upsert_document(query: Filter) -> Document:
+    """Get document inserted by upsert from equality conditions of ``query``."""
+    document: Document = {}
+    for key, condition in query.items():
+        if key == "$and":
+            for part in condition:
+                document.update(_upsert_document(part))
+        elif key.startswith("$"):
+            continue
+        elif _is_operator_document(condition):
+            if "$eq" in condition:
+                apply_update(document, {"$set": {key: condition["$eq"]}})
+        elif not isinstance(condition, re.Pattern):
+            apply_update(document, {"$set": {key: condition}})
+    return document
+
+
+class _UniqueIndex:
+    """Unique index mapping values of fields to document identifiers."""
+
+    def __init__(self, name: str, keys: SortKeys, sparse: bool):
+        self.name = name
+        self.fields = [field for field, _ in keys]
+        self.sparse = sparse
+        self.entries: typing.Dict[typing.Hashable, typing.Hashable] = {}
+
+    def key(self, document: Document) -> typing.Optional[typing.Hashable]:
+        values = [_get_values(document, field) for field in self.fields]
+        if self.sparse and not any(values):
+            return None
+        return tuple(_hashable(value[0] if value else None) for value in values)
+
+
+class _Cursor(ABC):
+    """Cursor over documents computed on first fetch."""
+
+    def __init__(self):
+        self._buffer: typing.Optional[typing.List[Document]] = None
+        self._next: typing.Optional[Document] = None
+
+    @abstractmethod
+    def _load(self) -> typing.List[Document]:
+        """Compute list of documents of cursor."""
+
+    def _documents(self) -> typing.List[Document]:
+        if self._buffer is None:
+            self._buffer = self._load()
+            self._buffer.reverse()
+        return self._buffer
+
+    async def to_list(self, length: typing.Optional[int]) -> typing.List[Document]:
+        """Get list of at most ``length`` next documents."""
+        await asyncio.sleep(0)
+        documents = self._documents()
+        count = len(documents) if length is None else min(length, len(documents))
+        return [documents.pop() for _ in range(count)]
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Document:
+        await asyncio.sleep(0)
+        documents = self._documents()
+        if not documents:
+            raise StopAsyncIteration
+        return documents.pop()
+
+    @property
+    def fetch_next(self) -> typing.Awaitable[bool]:
+        """Get awaitable which is True if there is next document."""
+        return self._fetch_next()
+
+    async def _fetch_next(self) -> bool:
+        await asyncio.sleep(0)
+        documents = self._documents()
+        if not documents:
+            return False
+        self._next = documents.pop()
+        return True
+
+    def next_object(self) -> typing.Optional[Document]:
+        """Get document fetched by ``fetch_next``."""
+        document, self._next = self._next, None
+        return document
+
+
+class MemoryCursor(_Cursor):
+    """Cursor of ``find`` query."""
+
+    def __init__(
+        self,
+        collection: "MemoryCollection",
+        query: typing.Optional[Filter] = None,
+        projection: typing.Any = None,
+        sort: typing.Optional[SortKeys] = None,
+        skip: int = 0,
+        limit: int = 0,
+    ):
+        super().__init__()
+        self.collection = collection
+        self.query = query or {}
+        self.projection = projection
+        self._sort = sort or []
+        self._skip = skip
+        self._limit = limit
+
+    def sort(
+        self,
+        key_or_list: typing.Union[str, SortKeys],
+        direction: typing.Optional[int] = None,
+    ) -> "MemoryCursor":
+        """Sort results by ``key_or_list``."""
+        self._sort = _sort_keys(key_or_list, direction)
+        return self
+
+    def skip(self, skip: int) -> "MemoryCursor":
+        """Skip first ``skip`` results."""
+        self._skip = skip
+        return self
+
+    def limit(self, limit: int) -> "MemoryCursor":
+        """Return at most ``limit`` results."""
+        self._limit = limit
+        return self
+
+    def _matching(self) -> typing.List[Document]:
+        documents = self.collection._find(self.query)
+        if self._sort:
+            sort_documents(documents, self._sort)
+        documents = documents[self._skip :]
+        if self._limit:
+            documents = documents[: self._limit]
+        return documents
+
+    def _load(self) -> typing.List[Document]:
+        return [project(document, self.projection) for document in self._matching()]
+
+    async def distinct(self, key: str) -> typing.List[typing.Any]:
+        """Get distinct values of ``key`` in results."""
+        await asyncio.sleep(0)
+        values: typing.List[typing.Any] = []
+        for document in self._matching():
+            for value in _candidates(_get_values(document, key)):
+                if not isinstance(value, list) and not any(
+                    _equals(value, existing) for existing in values
+                ):
+                    values.append(copy.deepcopy(value))
+        return values
+
+    async def explain(self) -> Document:
+        """Get query plan in the format of MongoDB.
+
+        Query is planned as an index scan if the first field of some
+        index is used in filter or sort.
+        """
+        await asyncio.sleep(0)
+        fields = {field for field in self.query if not field.startswith("$")}
+        fields.update(field for field, _ in self._sort)
+        indexed = any(
+            info["key"][0][0] in fields
+            for info in self.collection._index_information.values()
+        )
+        if indexed:
+            plan = {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}}
+        else:
+            plan = {"stage": "COLLSCAN"}
+        return {"queryPlanner": {"winningPlan": plan}}
+
+
+class MemoryCommandCursor(_Cursor):
+    """Cursor of aggregation pipeline."""
+
+    def __init__(
+        self,
+        collection: "MemoryCollection",
+        pipeline: typing.List[typing.Mapping[str, typing.Any]],
+    ):
+        super().__init__()
+        self.collection = collection
+        self.pipeline = pipeline
+
+    def _load(self) -> typing.List[Document]:
+        documents = [copy.deepcopy(document) for document in self.collection._find({})]
+        for stage in self.pipeline:
+            name, specification = next(iter(stage.items()))
+            if name == "$match":
+                documents = [
+                    document
+                    for document in documents
+                    if matches(document, specification)
+                ]
+            elif name in ("$addFields", "$set"):
+                for document in documents:
+                    values = {
+                        field: evaluate(expression, document)
+                        for field, expression in specification.items()
+                    }
+                    apply_update(document, {"$set": values})
+            elif name == "$project":
+                documents = [
+                    self._project(document, specification) for document in documents
+                ]
+            elif name == "$sort":
+                sort_documents(documents, _sort_keys(specification))
+            elif name == "$skip":
+                documents = documents[specification:]
+            elif name == "$limit":
+                documents = documents[:specification]
+            elif name == "$group":
+                documents = self._group(documents, specification)
+            elif name == "$count":
+                documents = [{specification: len(documents)}]
+            else:
+                raise OperationFailure(f"Unsupported pipeline stage: {name}")
+        return documents
+
+    @staticmethod
+    def _project(
+        document: Document, specification: typing.Mapping[str, typing.Any]
+    ) -> Document:
+        projection = {}
+        computed = {}
+        for field, value in specification.items():
+            if isinstance(value, (bool, int)):
+                projection[field] = value
+            else:
+                computed[field] = evaluate(value, document)
+        if computed and not any(projection.values()):
+            projection.setdefault("_id", True)
+        result = project(document, projection)
+        apply_update(result, {"$set": computed})
+        return result
+
+    @staticmethod
+    def _group(
+        documents: typing.List[Document], specification: typing.Mapping[str, typing.Any]
+    ) -> typing.List[Document]:
+        groups: typing.Dict[typing.Hashable, Document] = {}
+        values: typing.Dict[typing.Hashable, typing.Dict[str, list]] = {}
+        accumulators = {
+            field: next(iter(accumulator.items()))
+            for field, accumulator in specification.items()
+            if field != "_id"
+        }
+        for document in documents:
+            group_id = evaluate(specification["_id"], document)
+            key = _hashable(group_id)
+            if key not in groups:
+                groups[key] = {"_id": group_id}
+                values[key] = {field: [] for field in accumulators}
+            for field, (_, expression) in accumulators.items():
+                values[key][field].append(evaluate(expression, document))
+        for key, group in groups.items():
+            for field, (name, _) in accumulators.items():
+                group[field] = MemoryCommandCursor._accumulate(name, values[key][field])
+        return list(groups.values())
+
+    @staticmethod
+    def _accumulate(name: str, values: typing.List[typing.Any]) -> typing.Any:
+        if name in ("$sum", "$avg"):
+            numbers = [value for value in values if _type_rank(value) == 2]
+            decimal = any(isinstance(value, Decimal128) for value in numbers)
+            total = sum((_comparable(value) for value in numbers), 0)
+            if name == "$avg":
+                if not numbers:
+                    return None
+                total = total / len(numbers)
+            return Decimal128(Decimal(total)) if decimal else total
+        if name == "$first":
+            return values[0] if values else None
+        if name == "$last":
+            return values[-1] if values else None
+        if name in ("$min", "$max"):
+            present = [value for value in values if value is not None]
+            if not present:
+                return None
+            function = min if name == "$min" else max
+            return function(present, key=_sort_key)
+        if name == "$push":
+            return values
+        if name == "$addToSet":
+            unique: typing.List[typing.Any] = []
+            for value in values:
+                if not any(_equals(value, existing) for existing in unique):
+                    unique.append(value)
+            return unique
+        raise OperationFailure(f"Unsupported accumulator: {name}")
+
+
+class MemoryCollection:
+    """Collection of documents stored in memory.
+
+    :param name: Name of collection.
+    """
+
+    def __init__(self, name: str):
+        """Create empty collection."""
+        self.name = name
+        self._documents: typing.Dict[typing.Hashable, Document] = {}
+        self._index_information: typing.Dict[str, Document] = {
+            "_id_": {"key": [("_id", 1)], "v": 2}
+        }
+        self._unique: typing.List[_UniqueIndex] = []
+
+    def _lookup(self, query: Filter) -> typing.Optional[typing.List[Document]]:
+        """Get candidates matching ``query`` by identifier or unique index.
+
+        None is returned if collection must be scanned.
+        """
+        condition = query.get("_id")
+        if _is_scalar(condition):
+            document = self._documents.get(condition)
+            return [document] if document is not None else []
+        for index in self._unique:
+            if len(index.fields) != 1:
+                continue
+            condition = query.get(index.fields[0])
+            if _is_scalar(condition):
+                identifier = index.entries.get((condition,))
+                if identifier is None:
+                    return []
+                return [self._documents[identifier]]
+        return None
+
+    def _find(self, query: Filter) -> typing.List[Document]:
+        """Get stored documents matching ``query``."""
+        candidates = self._lookup(query)
+        if candidates is None:
+            candidates = list(self._documents.values())
+        return [document for document in candidates if matches(document, query)]
+
+    def _find_first(
+        self, query: Filter, sort: typing.Optional[SortKeys] = None
+    ) -> typing.Optional[Document]:
+        documents = self._find(query)
+        if sort:
+            sort_documents(documents, _sort_keys(sort))
+        return documents[0] if documents else None
+
+    def _check_unique(
+        self, document: Document, previous: typing.Optional[Document] = None
+    ) -> None:
+        identifier = _hashable(document["_id"])
+        if previous is None and identifier in self._documents:
+            raise DuplicateKeyError(
+                f"E11000 duplicate key error collection: {self.name} index: _id_",
+                11000,
+            )
+        for index in self._unique:
+            key = index.key(document)
+            if key is not None and index.entries.get(key, identifier) != identifier:
+                raise DuplicateKeyError(
+                    "E11000 duplicate key error collection: "
+                    f"{self.name} index: {index.name}",
+                    11000,
+                )
+
+    def _store(
+        self, document: Document, previous: typing.Optional[Document] = None
+    ) -> None:
+        """Store ``document`` replacing ``previous`` version of it."""
+        if previous is not None and _hashable(document["_id"]) != _hashable(
+            previous["_id"]
+        ):
+            raise OperationFailure("Performing an update on _id is not allowed")
+        self._check_unique(document, previous)
+        identifier = _hashable(document["_id"])
+        for index in self._unique:
+            if previous is not None:
+                key = index.key(previous)
+                if key is not None:
+                    index.entries.pop(key, None)
+            key = index.key(document)
+            if key is not None:
+                index.entries[key] = identifier
+        self._documents[identifier] = document
+
+    def _remove(self, document: Document) -> None:
+        for index in self._unique:
+            key = index.key(document)
+            if key is not None and index.entries.get(key) == _hashable(document["_id"]):
+                del index.entries[key]
+        del self._documents[_hashable(document["_id"])]
+
+    def _insert(self, document: Document) -> typing.Any:
+        if "_id" not in document:
+            document["_id"] = ObjectId()
+        self._store(copy.deepcopy(document))
+        return document["_id"]
+
+    def _update(
+        self, query: Filter, update: Filter, upsert: bool, multi: bool
+    ) -> UpdateResult:
+        documents = self._find(query)
+        if not multi:
+            documents = documents[:1]
+        if not documents:
+            if not upsert:
+                return UpdateResult({"n": 0, "nModified": 0}, True)
+            document = _upsert_document(query)
+            apply_update(document, update, inserting=True)
+            identifier = self._insert(document)
+            return UpdateResult({"n": 1, "nModified": 0, "upserted": identifier}, True)
+        modified = 0
+        for previous in documents:
+            document = copy.deepcopy(previous)
+            apply_update(document, update)
+            if document != previous:
+                self._store(document, previous)
+                modified += 1
+        return UpdateResult({"n": len(documents), "nModified": modified}, True)
+
+    def _replace(
+        self, query: Filter, replacement: Document, upsert: bool
+    ) -> UpdateResult:
+        previous = self._find_first(query)
+        if previous is None:
+            if not upsert:
+                return UpdateResult({"n": 0, "nModified": 0}, True)
+            document = copy.deepcopy(replacement)
+            if "_id" not in document and "_id" in query:
+                document["_id"] = query["_id"]
+            identifier = self._insert(document)
+            return UpdateResult({"n": 1, "nModified": 0, "upserted": identifier}, True)
+        document = copy.deepcopy(replacement)
+        document["_id"] = previous["_id"]
+        modified = document != previous
+        if modified:
+            self._store(document, previous)
+        return UpdateResult({"n": 1, "nModified": int(modified)}, True)
+
+    def _delete(self, query: Filter, multi: bool) -> DeleteResult:
+        documents = self._find(query)
+        if not multi:
+            documents = documents[:1]
+        for document in documents:
+            self._remove(document)
+        return DeleteResult({"n": len(documents)}, True)
+
+    def find(
+        self,
+        filter: typing.Optional[Filter] = None,
+        projection: typing.Any = None,
+        sort: typing.Optional[SortKeys] = None,
+        skip: int = 0,
+        limit: int = 0,
+        **kwargs,
+    ) -> MemoryCursor:
+        """Find documents matching ``filter``."""
+        return MemoryCursor(self, filter, projection, sort, skip, limit)
+
+    async def find_one(
+        self,
+        filter: typing.Optional[Filter] = None,
+        projection: typing.Any = None,
+        sort: typing.Optional[SortKeys] = None,
+        **kwargs,
+    ) -> typing.Optional[Document]:
+        """Find first document matching ``filter``."""
+        await asyncio.sleep(0)
+        if filter is not None and not isinstance(filter, typing.Mapping):
+            filter = {"_id": filter}
+        document = self._find_first(filter or {}, sort)
+        return project(document, projection) if document is not None else None
+
+    async def find_one_and_update(
+        self,
+        filter: Filter,
+        update: Filter,
+        projection: typing.Any = None,
+        sort: typing.Optional[SortKeys] = None,
+        upsert: bool = False,
+        return_document: bool = ReturnDocument.BEFORE,
+        **kwargs,
+    ) -> typing.Optional[Document]:
+        """Update first document matching ``filter`` and return it."""
+        await asyncio.sleep(0)
+        previous = self._find_first(filter, sort)
+        if previous is None:
+            if not upsert:
+                return None
+            document = _upsert_document(filter)
+            apply_update(document, update, inserting=True)
+            self._insert(document)
+            if return_document == ReturnDocument.BEFORE:
+                return None
+            return project(document, projection)
+        document = copy.deepcopy(previous)
+        apply_update(document, update)
+        self._store(document, previous)
+        result = document if return_document == ReturnDocument.AFTER else previous
+        return project(result, projection)
+
+    async def find_one_and_replace(
+        self,
+        filter: Filter,
+        replacement: Document,
+        projection: typing.Any = None,
+        sort: typing.Optional[SortKeys] = None,
+        upsert: bool = False,
+        return_document: bool = ReturnDocument.BEFORE,
+        **kwargs,
+    ) -> typing.Optional[Document]:
+        """Replace first document matching ``filter`` and return it."""
+        await asyncio.sleep(0)
+        previous = self._find_first(filter, sort)
+        document = copy.deepcopy(replacement)
+        if previous is None:
+            if not upsert:
+                return None
+            if "_id" not in document and "_id" in filter:
+                document["_id"] = filter["_id"]
+            self._insert(document)
+            if return_document == ReturnDocument.BEFORE:
+                return None
+            return project(document, projection)
+        document["_id"] = previous["_id"]
+        self._store(document, previous)
+        result = document if return_document == ReturnDocument.AFTER else previous
+        return project(result, projection)
+
+    async def find_one_and_delete(
+        self,
+        filter: Filter,
+        projection: typing.Any = None,
+        sort: typing.Optional[SortKeys] = None,
+        **kwargs,
+    ) -> typing.Optional[Document]:
+        """Delete first document matching ``filter`` and return it."""
+        await asyncio.sleep(0)
+        document = self._find_first(filter, sort)
+        if document is None:
+            return None
+        self._remove(document)
+        return project(document, projection)
+
+    async def insert_one(self, document: Document, **kwargs) -> InsertOneResult:
+        """Insert ``document`` setting its ``_id`` if it's missing."""
+        await asyncio.sleep(0)
+        return InsertOneResult(self._insert(document), True)
+
+    async def insert_many(
+        self, documents: typing.Iterable[Document], ordered: bool = True, **kwargs
+    ) -> InsertManyResult:
+        """Insert ``documents`` in order if ``ordered`` is true."""
+        await asyncio.sleep(0)
+        inserted_ids = []
+        errors = []
+        for index, document in enumerate(documents):
+            try:
+                inserted_ids.append(self._insert(document))
+            except DuplicateKeyError as error:
+                errors.append(
+                    {"index": index, "code": error.code, "errmsg": str(error)}
+                )
+                if ordered:
+                    break
+        if errors:
+            raise BulkWriteError(
+                {"writeErrors": errors, "nInserted": len(inserted_ids)}
+            )
+        return InsertManyResult(inserted_ids, True)
+
+    async def update_one(
+        self, filter: Filter, update: Filter, upsert: bool = False, **kwargs
+    ) -> UpdateResult:
+        """Update first document matching ``filter``."""
+        await asyncio.sleep(0)
+        return self._update(filter, update, upsert, multi=False)
+
+    async def update_many(
+        self, filter: Filter, update: Filter, upsert: bool = False, **kwargs
+    ) -> UpdateResult:
+        """Update all documents matching ``filter``."""
+        await asyncio.sleep(0)
+        return self._update(filter, update, upsert, multi=True)
+
+    async def replace_one(
+        self, filter: Filter, replacement: Document, upsert: bool = False, **kwargs
+    ) -> UpdateResult:
+        """Replace first document matching ``filter``."""
+        await asyncio.sleep(0)
+        return self._replace(filter, replacement, upsert)
+
+    async def delete_one(self, filter: Filter, **kwargs) -> DeleteResult:
+        """Delete first document matching ``filter``."""
+        await asyncio.sleep(0)
+        return self._delete(filter, multi=False)
+
+    async def delete_many(self, filter: Filter, **kwargs) -> DeleteResult:
+        """Delete all documents matching ``filter``."""
+        await asyncio.sleep(0)
+        return self._delete(filter, multi=True)
+
+    async def count_documents(
+        self, filter: Filter, skip: int = 0, limit: int = 0, **kwargs
+    ) -> int:
+        """Count documents matching ``filter``."""
+        await asyncio.sleep(0)
+        count = max(len(self._find(filter)) - skip, 0)
+        return min(count, limit) if limit else count
+
+    def aggregate(
+        self, pipeline: typing.List[typing.Mapping[str, typing.Any]], **kwargs
+    ) -> MemoryCommandCursor:
+        """Run aggregation ``pipeline`` on collection."""
+        return MemoryCommandCursor(self, pipeline)
+
+    async def bulk_write(
+        self, requests: typing.Iterable[typing.Any], ordered: bool = True, **kwargs
+    ) -> BulkWriteResult:
+        """Execute write operations ``requests``."""
+        await asyncio.sleep(0)
+        result = {
+            "nInserted": 0,
+            "nMatched": 0,
+            "nModified": 0,
+            "nRemoved": 0,
+            "nUpserted": 0,
+            "upserted": [],
+            "writeErrors": [],
+        }
+        for index, request in enumerate(requests):
+            try:
+                if isinstance(request, InsertOne):
+                    self._insert(request._doc)
+                    result["nInserted"] += 1
+                    continue
+                if isinstance(request, (DeleteOne, DeleteMany)):
+                    deleted = self._delete(
+                        request._filter, multi=isinstance(request, DeleteMany)
+                    )
+                    result["nRemoved"] += deleted.deleted_count
+                    continue
+                if isinstance(request, ReplaceOne):
+                    updated = self._replace(
+                        request._filter, request._doc, request._upsert
+                    )
+                elif isinstance(request, (UpdateOne, UpdateMany)):
+                    updated = self._update(
+                        request._filter,
+                        request._doc,
+                        request._upsert,
+                        multi=isinstance(request, UpdateMany),
+                    )
+                else:
+                    raise OperationFailure(f"Unsupported request: {request!r}")
+            except DuplicateKeyError as error:
+                result["writeErrors"].append(
+                    {"index": index, "code": error.code, "errmsg": str(error)}
+                )
+                if ordered:
+                    break
+                continue
+            result["nMatched"] += updated.matched_count
+            result["nModified"] += updated.modified_count
+            if updated.upserted_id is not None:
+                result["nUpserted"] += 1
+                result["upserted"].append({"index": index, "_id": updated.upserted_id})
+        if result["writeErrors"]:
+            raise BulkWriteError(result)
+        return BulkWriteResult(result, True)
+
+    async def create_indexes(
+        self, indexes: typing.List[IndexModel]
+    ) -> typing.List[str]:
+        """Create ``indexes`` enforcing unique ones."""
+        await asyncio.sleep(0)
+        names = []
+        for model in indexes:
+            document = dict(model.document)
+            keys = list(document.pop("key").items())
+            name = document.pop("name")
+            self._index_information[name] = {"key": keys, "v": 2, **document}
+            if document.get("unique"):
+                index = _UniqueIndex(name, keys, document.get("sparse", False))
+                for stored in self._documents.values():
+                    key = index.key(stored)
+                    if key is not None:
+                        if key in index.entries:
+                            raise DuplicateKeyError(
+                                "E11000 duplicate key error collection: "
+                                f"{self.name} index: {name}",
+                                11000,
+                            )
+                        index.entries[key] = _hashable(stored["_id"])
+                self._unique.append(index)
+            names.append(name)
+        return names
+
+    async def index_information(self) -> typing.Dict[str, Document]:
+        """Get information about indexes of collection."""
+        await asyncio.sleep(0)
+        return copy.deepcopy(self._index_information)
+
+    def watch(self, *args, **kwargs):
+        """Fail because change streams aren't supported."""
+        raise OperationFailure("Change streams are not supported by memory database")
+
+
+class MemoryDatabase:
+    """Database of collections stored in memory.
+
+    :param name: Name of database.
+    """
+
+    def __init__(self, name: str):
+        """Create empty database."""
+        self.name = name
+        self._collections: typing.Dict[str, MemoryCollection] = {}
+
+    def __getitem__(self, name: str) -> MemoryCollection:
+        """Get collection ``name`` creating it on first use."""
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = self._collections[name] = MemoryCollection(name)
+        return collection
+
+    def __getattr__(self, name: str) -> MemoryCollection:
+        """Get collection ``name`` creating it on first use."""
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    async def list_collection_names(self) -> typing.List[str]:
+        """Get names of created collections."""
+        return list(self._collections)
+
+    async def drop_collection(self, name: str) -> None:
+        """Remove collection ``name`` with its documents and indexes."""
+        self._collections.pop(name, None)
+
+
+class MemoryClient:
+    """Client of databases stored in memory of current process."""
+
+    def __init__(self):
+        """Create client without databases."""
+        self._databases: typing.Dict[str, MemoryDatabase] = {}
+
+    def __getitem__(self, name: str) -> MemoryDatabase:
+        """Get database ``name`` creating it on first use."""
+        database = self._databases.get(name)
+        if database is None:
+            database = self._databases[name] = MemoryDatabase(name)
+        return database
+
+    def __getattr__(self, name: str) -> MemoryDatabase:
+        """Get database ``name`` creating it on first use."""
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def close(self) -> None:
+        """Do nothing as there are no connections."""
@@ -15,7 +15,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with TellerBot.  If not, see <https://www.gnu.org/licenses/>.
 import decimal
-import re
+import typing
 from decimal import Decimal
 
 from src.i18n import i18n
@@ -24,9 +24,29 @@ HIGH_EXP = Decimal("1e15")
 LOW_EXP = Decimal("1e-8")
 
 
-def gateway_currency_regexp(currency):
-    """Return regexp that ignores gateway if it isn't specified."""
-    return currency if "." in currency else re.compile(fr"^(\w+\.)?{currency}$")
+def currency_query(field: str, currency: str) -> typing.Dict[str, str]:
+    """Return query to ``field`` of order that ignores gateway if it isn't specified.
+
+    Base currency is always matched with ``<field>_base`` field so that
+    query can use index on it.
+    """
+    gateway, _, base = currency.rpartition(".")
+    query = {f"{field}_base": base}
+    if gateway:
+        query[field] = currency
+    return query
+
+
+def currency_fields(
+    order: typing.Mapping[str, typing.Any]
+) -> typing.Dict[str, typing.Optional[str]]:
+    """Get currencies of ``order`` split into base currencies and gateways."""
+    fields: typing.Dict[str, typing.Optional[str]] = {}
+    for field in ("buy", "sell"):
+        gateway, _, base = order[field].rpartition(".")
+        fields[f"{field}_base"] = base
+        fields[f"{field}_gateway"] = gateway or None
+    return fields
 
 
 def normalize(money: Decimal, exp: Decimal = LOW_EXP) -> Decimal:
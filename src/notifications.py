@@ -15,44 +15,327 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with TellerBot.  If not, see <https://www.gnu.org/licenses/>.
 import asyncio
+import heapq
+import logging
+import math
 import typing
+from time import monotonic
 from time import time
 
+import pymongo
+from aiogram import types
 from aiogram.utils.exceptions import TelegramAPIError
+from bson.objectid import ObjectId
 
 from src.bot import tg
+from src.config import config
 from src.database import database
+from src.database import profile_cache
+from src.handlers.base import order_keyboard
+from src.handlers.base import order_text
 from src.handlers.base import show_order
 from src.i18n import i18n
-from src.money import gateway_currency_regexp
+from src.indexes import index_registry
+from src.subscriptions import subscription_index
+from src.throttling import bulk_sending
+
+log = logging.getLogger(__name__)
+
+index_registry.add(
+    "orders",
+    [("notify", pymongo.ASCENDING), ("expiration_time", pymongo.ASCENDING)],
+    query={"expiration_time": {"$lte": 0}, "notify": True},
+)
+index_registry.add_query(
+    "orders",
+    {"expiration_time": {"$gt": 0}, "notify": True},
+    sort=[("expiration_time", pymongo.ASCENDING)],
+)
+index_registry.add(
+    "orders",
+    "notify.at",
+    query={"notify.at": {"$lt": 0}},
+    sparse=True,
+)
+
+
+async def claim_expired() -> typing.List[typing.Mapping[str, typing.Any]]:
+    """Claim batch of expired orders which weren't notified about.
+
+    ``notify`` field of claimed orders is set to claim ID and time, so
+    that concurrent processes claim every order only once. Claims which
+    weren't finished in ``config.EXPIRATION_CLAIM_TIMEOUT`` seconds
+    because claiming process has stopped are claimed again.
+    """
+    current_time = time()
+    unclaimed = {
+        "$or": [
+            {"notify": True},
+            {"notify.at": {"$lt": current_time - config.EXPIRATION_CLAIM_TIMEOUT}},
+        ]
+    }
+    cursor = database.orders.find(
+        {"expiration_time": {"$lte": current_time}, **unclaimed},
+        projection={"_id": True},
+    ).limit(config.EXPIRATION_BATCH_SIZE)
+    order_ids = [order["_id"] async for order in cursor]
+    if not order_ids:
+        return []
+    claim = {"claim": ObjectId(), "at": current_time}
+    await database.orders.update_many(
+        {"_id": {"$in": order_ids}, **unclaimed}, {"$set": {"notify": claim}}
+    )
+    cursor = database.orders.find({"_id": {"$in": order_ids}, "notify": claim})
+    return await cursor.to_list(length=None)
+
+
+async def notify_owner(
+    user: typing.Mapping[str, typing.Any],
+    orders: typing.List[typing.Mapping[str, typing.Any]],
+):
+    """Notify ``user`` that their ``orders`` have expired."""
+    message = i18n("order_expired", locale=user["locale"])
+    for order in orders:
+        message += "\nID: {}".format(order["_id"])
+    try:
+        await tg.send_message(user["chat"], message)
+        for order in orders:
+            await show_order(order, user["chat"], user["id"], locale=user["locale"])
+    except TelegramAPIError:
+        pass
+
+
+async def notify_expired():
+    """Notify order creators about orders which have expired by now.
+
+    Expired orders are processed in batches. Owners of orders in batch
+    are queried at once and notified concurrently with one message
+    listing their expired orders.
+    """
+    bulk_sending.set(True)
+    semaphore = asyncio.Semaphore(config.NOTIFICATION_WORKERS)
+
+    async def notify(user, orders):
+        async with semaphore:
+            try:
+                await notify_owner(user, orders)
+            except Exception:
+                log.exception("Failed to notify %d about expired orders", user["id"])
+
+    while True:
+        orders = await claim_expired()
+        if not orders:
+            return
+        grouped: typing.Dict[int, typing.List[typing.Mapping[str, typing.Any]]] = {}
+        for order in orders:
+            grouped.setdefault(order["user_id"], []).append(order)
+        users = await profile_cache.get_many(grouped)
+        await asyncio.gather(
+            *[
+                notify(users[user_id], user_orders)
+                for user_id, user_orders in grouped.items()
+                if user_id in users
+            ]
+        )
+        await database.orders.update_many(
+            {"_id": {"$in": [order["_id"] for order in orders]}},
+            {"$set": {"notify": False}},
+        )
+
+
+class ExpirationScheduler:
+    """Scheduler waking up exactly when the nearest order expires.
+
+    Expiration times of up to ``size`` nearest orders are kept in a
+    min-heap. Entries are only used as wake-up times: expired orders are
+    always queried from the database, so entries of orders which were
+    changed or archived since being scheduled are harmless. Heap is
+    reloaded every ``config.EXPIRATION_SCHEDULER_RELOAD_INTERVAL``
+    seconds to find orders scheduled by other processes.
+    """
+
+    def __init__(self, size: int):
+        """Create scheduler with empty heap."""
+        self.size = size
+        self._heap: typing.List[typing.Tuple[float, ObjectId]] = []
+        #: Expiration time after which orders are not loaded into heap.
+        self._horizon = math.inf
+        self._reload_time = 0.0
+        self._wakeup = asyncio.Event()
+
+    def schedule(self, order: typing.Mapping[str, typing.Any]) -> None:
+        """Wake up when ``order`` expires.
+
+        Should be called when order's expiration time or notification
+        flag is changed.
+        """
+        expiration_time = order.get("expiration_time")
+        if expiration_time is None or expiration_time > self._horizon:
+            return
+        heapq.heappush(self._heap, (expiration_time, order["_id"]))
+        if len(self._heap) > self.size:
+            self._heap = heapq.nsmallest(self.size, self._heap)
+            self._horizon = self._heap[-1][0]
+        if self._heap[0][1] == order["_id"]:
+            self._wakeup.set()
+
+    async def _load(self) -> None:
+        cursor = (
+            database.orders.find(
+                {"expiration_time": {"$gt": time()}, "notify": True},
+                projection={"expiration_time": True},
+            )
+            .sort("expiration_time", pymongo.ASCENDING)
+            .limit(self.size)
+        )
+        orders = await cursor.to_list(length=self.size)
+        self._reload_time = monotonic() + config.EXPIRATION_SCHEDULER_RELOAD_INTERVAL
+        self._heap = [(order["expiration_time"], order["_id"]) for order in orders]
+        if len(orders) == self.size:
+            self._horizon = orders[-1]["expiration_time"]
+        else:
+            self._horizon = math.inf
+
+    async def run(self) -> None:
+        """Notify about expired orders when they expire in infinite loop."""
+        await notify_expired()
+        await self._load()
+        while True:
+            self._wakeup.clear()
+            if self._heap:
+                timeout: typing.Optional[float] = self._heap[0][0] - time()
+            else:
+                timeout = None
+            if timeout is None or timeout > 0:
+                reload_timeout = self._reload_time - monotonic()
+                if reload_timeout <= 0:
+                    await self._load()
+                    continue
+                if timeout is None or timeout > reload_timeout:
+                    timeout = reload_timeout
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            current_time = time()
+            while self._heap and self._heap[0][0] <= current_time:
+                heapq.heappop(self._heap)
+            await notify_expired()
+            if not self._heap:
+                await self._load()
+
+
+expiration_scheduler = ExpirationScheduler(config.EXPIRATION_SCHEDULER_SIZE)
 
 
 async def run_loop():
     """Notify order creators about expired orders in infinite loop."""
-    while True:
-        cursor = database.orders.find(
-            {"expiration_time": {"$lte": time()}, "notify": True}
+    await expiration_scheduler.run()
+
+
+class OrderFanOut:
+    """Sender of one order to many recipients through a pool of workers.
+
+    Order message is rendered once per locale and order is checked for
+    being archived at most once in ``NOTIFICATION_ARCHIVE_CHECK_INTERVAL``
+    seconds instead of before every message.
+    """
+
+    def __init__(self, order: typing.Mapping[str, typing.Any], creator):
+        """Prepare fan-out of ``order`` created by ``creator``."""
+        self.order = order
+        self.creator = creator
+        self.invert = creator.get("invert_order", False)
+        self.has_location = (
+            order.get("lat") is not None and order.get("lon") is not None
+        )
+        self._texts: typing.Dict[str, str] = {}
+        self._keyboards: typing.Dict[str, types.InlineKeyboardMarkup] = {}
+        self._checked = monotonic()
+        self._active = True
+
+    def _text(self, locale: str) -> str:
+        text = self._texts.get(locale)
+        if text is None:
+            text = order_text(
+                self.order, self.creator, True, self.invert, False, locale
+            )
+            self._texts[locale] = text
+        return text
+
+    def _keyboard(
+        self, locale: str, location_message_id: int
+    ) -> types.InlineKeyboardMarkup:
+        if location_message_id != -1:
+            return order_keyboard(
+                self.order, location_message_id, self.invert, False, False, locale
+            )
+        keyboard = self._keyboards.get(locale)
+        if keyboard is None:
+            keyboard = order_keyboard(self.order, -1, self.invert, False, False, locale)
+            self._keyboards[locale] = keyboard
+        return keyboard
+
+    async def is_active(self) -> bool:
+        """Check if order still exists and is not archived."""
+        if not self._active:
+            return False
+        if monotonic() - self._checked >= config.NOTIFICATION_ARCHIVE_CHECK_INTERVAL:
+            self._checked = monotonic()
+            order = await database.orders.find_one(
+                {"_id": self.order["_id"]}, projection={"archived": True}
+            )
+            self._active = order is not None and not order.get("archived")
+        return self._active
+
+    async def send(self, recipient: typing.Mapping[str, typing.Any]) -> None:
+        """Send order to ``recipient``."""
+        locale = recipient.get("locale", i18n.default)
+        chat_id = recipient["chat"]
+        location_message_id = -1
+        if self.has_location:
+            location_message = await tg.send_location(
+                chat_id, self.order["lat"], self.order["lon"]
+            )
+            location_message_id = location_message.message_id
+        await tg.send_message(
+            chat_id,
+            self._text(locale),
+            reply_markup=self._keyboard(locale, location_message_id),
+            parse_mode=types.ParseMode.MARKDOWN,
+            disable_web_page_preview=True,
         )
-        sent = False
-        async for order in cursor:
-            user = await database.users.find_one({"id": order["user_id"]})
-            message = i18n("order_expired", locale=user["locale"])
-            message += "\nID: {}".format(order["_id"])
+
+    async def _worker(self, queue: asyncio.Queue) -> None:
+        while True:
+            recipient = await queue.get()
             try:
-                if sent:
-                    await asyncio.sleep(1)  # Avoid Telegram limit
-                await tg.send_message(user["chat"], message)
+                if await self.is_active():
+                    await self.send(recipient)
             except TelegramAPIError:
                 pass
-            else:
-                await show_order(order, user["chat"], user["id"], locale=user["locale"])
-                sent = True
+            except Exception:
+                log.exception("Failed to notify %s", recipient["id"])
             finally:
-                await database.orders.update_one(
-                    {"_id": order["_id"]}, {"$set": {"notify": False}}
-                )
-        if not sent:
-            await asyncio.sleep(1)  # Reduce database load
+                queue.task_done()
+
+    async def run(self, recipients: typing.Iterable) -> None:
+        """Send order to every recipient from ``recipients``."""
+        queue: asyncio.Queue = asyncio.Queue(config.NOTIFICATION_WORKERS * 2)
+        workers = [
+            asyncio.create_task(self._worker(queue))
+            for _ in range(config.NOTIFICATION_WORKERS)
+        ]
+        try:
+            for recipient in recipients:
+                if not await self.is_active():
+                    break
+                await queue.put(recipient)
+            await queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
 
 
 async def order_notification(order: typing.Mapping[str, typing.Any]):
@@ -62,23 +345,9 @@ async def order_notification(order: typing.Mapping[str, typing.Any]):
     **/subscribe** or **/unsubscribe** commands of ``start_menu``
     handlers.
     """
-    users = database.subscriptions.find(
-        {
-            "subscriptions": {
-                "$elemMatch": {
-                    "buy": {"$in": [gateway_currency_regexp(order["buy"]), None]},
-                    "sell": {"$in": [gateway_currency_regexp(order["sell"]), None]},
-                }
-            },
-        }
-    )
-    async for user in users:
-        if user["id"] == order["user_id"]:
-            continue
-        order = await database.orders.find_one({"_id": order["_id"]})  # Update order
-        if not order or order.get("archived"):
-            return
-        await show_order(
-            order, user["chat"], user["id"], show_id=True, locale=user["locale"]
-        )
-        await asyncio.sleep(1)  # Avoid Telegram limit
+    bulk_sending.set(True)
+    users = subscription_index.match(order)
+    if not users:
+        return
+    creator = await profile_cache.get(order["user_id"])
+    await OrderFanOut(order, creator).run(users)
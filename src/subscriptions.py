@@ -0,0 +1,183 @@
+# Copyright (C) 2019  alfred richardsn
+#
+# This file is part of TellerBot.
+#
+# TellerBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with TellerBot.  If not, see <https://www.gnu.org/licenses/>.
+"""In-memory index of subscriptions to currency pairs."""
+import asyncio
+import logging
+import typing
+from collections import Counter
+from collections import defaultdict
+
+from pymongo.errors import PyMongoError
+
+from src.config import config
+from src.database import database
+
+log = logging.getLogger(__name__)
+
+PairKey = typing.Tuple[typing.Optional[str], typing.Optional[str]]
+
+
+def currency_base(currency: str) -> str:
+    """Strip gateway from ``currency``."""
+    return currency.rsplit(".", 1)[-1]
+
+
+class SubscriptionIndex:
+    """Inverted index of subscribers keyed by subscribed (sell, buy) pair.
+
+    ``None`` in subscribed pair is a wildcard. Order currency without
+    gateway matches subscriptions to the currency with any gateway,
+    while order currency with gateway matches only the same currency.
+    """
+
+    def __init__(self):
+        """Create empty index."""
+        self.clear()
+
+    def clear(self) -> None:
+        """Remove all subscriptions from index."""
+        self._pairs: typing.DefaultDict[PairKey, typing.Set[int]] = defaultdict(set)
+        #: Subscribed currencies grouped by currency without gateway.
+        self._variants: typing.DefaultDict[str, typing.Counter[str]] = defaultdict(
+            Counter
+        )
+        self._subscribers: typing.Dict[int, typing.Dict[str, typing.Any]] = {}
+        self._subscriptions: typing.DefaultDict[
+            int, typing.Set[PairKey]
+        ] = defaultdict(set)
+
+    def add(
+        self,
+        subscriber: typing.Mapping[str, typing.Any],
+        subscription: typing.Mapping[str, typing.Optional[str]],
+    ) -> None:
+        """Add ``subscription`` of ``subscriber`` to index."""
+        user_id = subscriber["id"]
+        record = self._subscribers.setdefault(user_id, {"id": user_id})
+        for field in ("chat", "locale"):
+            if field in subscriber:
+                record[field] = subscriber[field]
+        key = (subscription["sell"], subscription["buy"])
+        if key in self._subscriptions[user_id]:
+            return
+        self._subscriptions[user_id].add(key)
+        self._pairs[key].add(user_id)
+        for currency in key:
+            if currency is not None:
+                self._variants[currency_base(currency)][currency] += 1
+
+    def remove(
+        self, user_id: int, subscription: typing.Mapping[str, typing.Optional[str]]
+    ) -> None:
+        """Remove ``subscription`` of user with Telegram ID ``user_id`` from index."""
+        key = (subscription["sell"], subscription["buy"])
+        if key not in self._subscriptions.get(user_id, ()):
+            return
+        self._subscriptions[user_id].remove(key)
+        self._pairs[key].discard(user_id)
+        if not self._pairs[key]:
+            del self._pairs[key]
+        for currency in key:
+            if currency is not None:
+                variants = self._variants[currency_base(currency)]
+                variants[currency] -= 1
+                if variants[currency] <= 0:
+                    del variants[currency]
+
+    def replace(self, document: typing.Mapping[str, typing.Any]) -> None:
+        """Replace subscriptions of user with ones from subscriptions ``document``."""
+        user_id = document["id"]
+        for key in list(self._subscriptions.get(user_id, ())):
+            self.remove(user_id, {"sell": key[0], "buy": key[1]})
+        for subscription in document.get("subscriptions", []):
+            self.add(document, subscription)
+
+    def set_locale(self, user_id: int, locale: str) -> None:
+        """Change locale of subscriber with Telegram ID ``user_id``."""
+        subscriber = self._subscribers.get(user_id)
+        if subscriber is not None:
+            subscriber["locale"] = locale
+
+    def _candidates(self, currency: str) -> typing.List[typing.Optional[str]]:
+        candidates: typing.List[typing.Optional[str]] = [None]
+        if "." in currency:
+            candidates.append(currency)
+        else:
+            candidates.extend(self._variants.get(currency, ()))
+        return candidates
+
+    def match(
+        self, order: typing.Mapping[str, typing.Any]
+    ) -> typing.List[typing.Mapping[str, typing.Any]]:
+        """Get subscribers to currency pair of ``order`` except its creator."""
+        user_ids: typing.Set[int] = set()
+        for sell in self._candidates(order["sell"]):
+            for buy in self._candidates(order["buy"]):
+                user_ids.update(self._pairs.get((sell, buy), ()))
+        user_ids.discard(order["user_id"])
+        return [self._subscribers[user_id] for user_id in user_ids]
+
+    async def load(self) -> None:
+        """Build index from subscriptions collection.
+
+        Locales of subscribers are taken from users collection.
+        """
+        self.clear()
+        async for document in database.subscriptions.find():
+            self.replace(document)
+        users = database.users.find(
+            {"id": {"$in": list(self._subscribers)}, "locale": {"$exists": True}},
+            projection={"id": True, "locale": True},
+        )
+        async for user in users:
+            self._subscribers[user["id"]]["locale"] = user["locale"]
+
+    async def watch(self) -> None:
+        """Apply changes of subscriptions made by other processes.
+
+        Requires MongoDB replica set. If change stream fails, it's opened
+        again after ``config.SUBSCRIPTIONS_WATCH_RETRY_DELAY`` seconds
+        and index is reloaded to apply changes missed in between.
+        """
+        reload = False
+        while True:
+            try:
+                async with database.subscriptions.watch(
+                    full_document="updateLookup"
+                ) as stream:
+                    if reload:
+                        await self.load()
+                    async for change in stream:
+                        document = change.get("fullDocument")
+                        if document is not None:
+                            self.replace(document)
+            except PyMongoError as error:
+                log.error("Subscriptions change stream failed: %s", error)
+                reload = True
+                await asyncio.sleep(config.SUBSCRIPTIONS_WATCH_RETRY_DELAY)
+
+
+async def change_streams_available() -> bool:
+    """Check if database supports change streams."""
+    try:
+        async with database.subscriptions.watch():
+            return True
+    except PyMongoError:
+        return False
+
+
+subscription_index = SubscriptionIndex()
@@ -0,0 +1,165 @@
+# Copyright (C) 2019  alfred richardsn
+#
+# This file is part of TellerBot.
+#
+# TellerBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with TellerBot.  If not, see <https://www.gnu.org/licenses/>.
+"""Rate limiting of messages sent to Telegram."""
+import asyncio
+import typing
+from contextvars import ContextVar
+from time import monotonic
+
+from src.cache import TTLCache
+from src.config import config
+
+#: Whether messages sent in current context are bulk notifications.
+#: Bulk messages are sent only when no interactive replies are waiting.
+bulk_sending: ContextVar[bool] = ContextVar("bulk_sending", default=False)
+
+
+class TokenBucket:
+    """Token bucket refilled with ``rate`` tokens per second up to ``capacity``."""
+
+    def __init__(self, rate: float, capacity: float):
+        """Create full bucket."""
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = monotonic()
+        self._paused_until = 0.0
+
+    def _refill(self) -> None:
+        now = monotonic()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def delay(self) -> float:
+        """Get number of seconds until token is available."""
+        self._refill()
+        if self._tokens >= 1:
+            return max(0, self.pause_delay())
+        return max((1 - self._tokens) / self.rate, self.pause_delay())
+
+    def pause_delay(self) -> float:
+        """Get number of seconds until bucket is resumed after pause."""
+        return self._paused_until - monotonic()
+
+    def consume(self) -> None:
+        """Take one token from bucket."""
+        self._refill()
+        self._tokens -= 1
+
+    def pause(self, seconds: float) -> None:
+        """Make bucket empty for ``seconds``."""
+        self._refill()
+        self._tokens = min(self._tokens, 0) - seconds * self.rate
+        self._paused_until = max(self._paused_until, monotonic() + seconds)
+
+
+class SendGovernor:
+    """Governor of global and per-chat message quotas of Telegram."""
+
+    def __init__(self):
+        """Create governor with full buckets.
+
+        Global limit is shared equally by ``config.WORKERS`` processes.
+        """
+        global_limit = config.TELEGRAM_GLOBAL_LIMIT / config.WORKERS
+        self._global = TokenBucket(global_limit, global_limit)
+        self._chats: TTLCache[int, TokenBucket] = TTLCache(
+            config.USER_CACHE_SIZE, 60
+        )
+        self._interactive_waiting = 0
+        self._bulk_waiting = 0
+        self._interactive_idle = asyncio.Event()
+        self._interactive_idle.set()
+
+    @property
+    def queue_depth(self) -> typing.Tuple[int, int]:
+        """Get numbers of waiting interactive and bulk messages.
+
+        Only interactive messages waiting for global quota are counted.
+        """
+        return self._interactive_waiting, self._bulk_waiting
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if chat_id < 0:
+                rate = config.TELEGRAM_GROUP_LIMIT / 60
+            else:
+                rate = config.TELEGRAM_CHAT_LIMIT / 60
+            bucket = TokenBucket(rate, config.TELEGRAM_CHAT_BURST)
+        # Refresh lifetime on every use
+        self._chats.set(chat_id, bucket)
+        return bucket
+
+    def _wait_global(self, waiting: bool) -> None:
+        if waiting:
+            self._interactive_waiting += 1
+            self._interactive_idle.clear()
+        else:
+            self._interactive_waiting -= 1
+            if not self._interactive_waiting:
+                self._interactive_idle.set()
+
+    async def acquire(self, chat_id: int) -> None:
+        """Wait until message can be sent to chat with ID ``chat_id``.
+
+        Only bulk messages wait for chat's quota. Interactive replies are
+        limited per chat by users themselves and wait only when chat is
+        paused by flood control, but still take tokens of chat's bucket.
+        Interactive replies have priority over bulk messages only on
+        global quota: bulk messages don't wait for replies which are
+        waiting for quota of another chat.
+        """
+        bulk = bulk_sending.get()
+        if bulk:
+            self._bulk_waiting += 1
+        waiting_global = False
+        try:
+            while True:
+                if bulk and self._interactive_waiting:
+                    await self._interactive_idle.wait()
+                    continue
+                chat_bucket = self._chat_bucket(chat_id)
+                if bulk:
+                    delay = chat_bucket.delay()
+                else:
+                    delay = chat_bucket.pause_delay()
+                chat_ready = delay <= 0
+                if chat_ready:
+                    delay = self._global.delay()
+                    if delay <= 0:
+                        self._global.consume()
+                        chat_bucket.consume()
+                        return
+                if not bulk and waiting_global != chat_ready:
+                    waiting_global = chat_ready
+                    self._wait_global(waiting_global)
+                await asyncio.sleep(delay)
+        finally:
+            if bulk:
+                self._bulk_waiting -= 1
+            elif waiting_global:
+                self._wait_global(False)
+
+    def retry_after(self, chat_id: int, seconds: float) -> None:
+        """Stop sending messages to chat with ID ``chat_id`` for ``seconds``."""
+        self._chat_bucket(chat_id).pause(seconds)
+
+
+send_governor = SendGovernor()
@@ -43,8 +43,9 @@ CRYPTOCURRENCY: Mapping[str, Tuple[str, ...]] = {
 }
 
 
-def currency_keyboard(currency_type: str) -> ReplyKeyboardMarkup:
-    """Get keyboard with currencies from whitelists."""
+@i18n.cache
+def currency_keyboard(currency_type: str) -> str:
+    """Get serialized keyboard with currencies from whitelists."""
     keyboard = ReplyKeyboardMarkup(
         row_width=5, one_time_keyboard=currency_type == "sell"
     )
@@ -58,11 +59,12 @@ def currency_keyboard(currency_type: str) -> ReplyKeyboardMarkup:
         )
     else:
         keyboard.row(cancel_button)
-    return keyboard
+    return keyboard.as_json()
 
 
-def gateway_keyboard(currency: str, currency_type: str) -> ReplyKeyboardMarkup:
-    """Get keyboard with gateways of ``currency`` from whitelist."""
+@i18n.cache
+def gateway_keyboard(currency: str, currency_type: str) -> str:
+    """Get serialized keyboard with gateways of ``currency`` from whitelist."""
     keyboard = ReplyKeyboardMarkup(
         row_width=5, one_time_keyboard=currency_type == "sell"
     )
@@ -72,4 +74,4 @@ def gateway_keyboard(currency: str, currency_type: str) -> ReplyKeyboardMarkup:
         KeyboardButton(emojize(":fast_forward: ") + i18n("without_gateway")),
         KeyboardButton(emojize(":x: ") + i18n("cancel")),
     )
-    return keyboard
+    return keyboard.as_json()
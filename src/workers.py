@@ -0,0 +1,130 @@
+# Copyright (C) 2019  alfred richardsn
+#
+# This file is part of TellerBot.
+#
+# TellerBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with TellerBot.  If not, see <https://www.gnu.org/licenses/>.
+"""Routing of webhook updates to worker processes."""
+import bisect
+import hashlib
+import json
+import logging
+import typing
+
+import aiohttp
+from aiohttp import web
+
+log = logging.getLogger(__name__)
+
+
+def update_chat_id(update: typing.Mapping[str, typing.Any]) -> typing.Optional[int]:
+    """Get ID of chat or user which ``update`` belongs to."""
+    for field in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        if field in update:
+            return update[field]["chat"]["id"]
+    if "callback_query" in update:
+        callback_query = update["callback_query"]
+        if "message" in callback_query:
+            return callback_query["message"]["chat"]["id"]
+        return callback_query["from"]["id"]
+    for field in (
+        "inline_query",
+        "chosen_inline_result",
+        "shipping_query",
+        "pre_checkout_query",
+    ):
+        if field in update:
+            return update[field]["from"]["id"]
+    if "poll_answer" in update:
+        return update["poll_answer"]["user"]["id"]
+    return None
+
+
+class HashRing:
+    """Consistent hash ring mapping keys to nodes.
+
+    Every node is placed on ring ``replicas`` times, so that keys are
+    evenly distributed and only keys of changed node move when nodes
+    are added or removed.
+
+    :param nodes: Names of nodes.
+    :param replicas: Number of points of every node on ring.
+    """
+
+    def __init__(self, nodes: typing.Iterable[str], replicas: int = 100):
+        """Place ``nodes`` on ring."""
+        self._ring = sorted(
+            (self._hash(f"{node}#{replica}"), node)
+            for node in nodes
+            for replica in range(replicas)
+        )
+        self._points = [point for point, _ in self._ring]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+    def node(self, key: typing.Any) -> str:
+        """Get node responsible for ``key``."""
+        index = bisect.bisect(self._points, self._hash(str(key)))
+        return self._ring[index % len(self._ring)][1]
+
+
+class UpdateRouter:
+    """Web application forwarding webhook updates to workers.
+
+    Updates of the same chat are always forwarded to the same worker,
+    so they are processed in order of arrival and caches of worker
+    stay relevant.
+
+    :param worker_urls: URLs of webhooks of workers.
+    """
+
+    def __init__(self, worker_urls: typing.Iterable[str]):
+        """Create router without opening connections."""
+        self.ring = HashRing(worker_urls)
+        self._session: typing.Optional[aiohttp.ClientSession] = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        """Forward update from ``request`` to its worker and return its response."""
+        body = await request.read()
+        update = json.loads(body)
+        chat_id = update_chat_id(update)
+        url = self.ring.node(chat_id if chat_id is not None else update["update_id"])
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+        try:
+            async with self._session.post(
+                url, data=body, headers={"Content-Type": "application/json"}
+            ) as response:
+                return web.Response(
+                    body=await response.read(),
+                    status=response.status,
+                    content_type=response.content_type,
+                )
+        except aiohttp.ClientError as error:
+            log.error("Failed to forward update to %s: %s", url, error)
+            # Telegram will send update again
+            return web.Response(status=502)
+
+    async def close(self, *args) -> None:
+        """Close connections to workers."""
+        if self._session is not None:
+            await self._session.close()
+
+    def app(self, path: str) -> web.Application:
+        """Create web application receiving updates on ``path``."""
+        application = web.Application()
+        application.router.add_post(path, self.handle)
+        application.on_cleanup.append(self.close)
+        return application